@@ -3,49 +3,80 @@
 from flask import Blueprint, request
 from twilio.twiml.messaging_response import MessagingResponse
 
-from models import Playlist
-from spotify import add_tracks_to_playlist, get_or_create_guest_user, get_playlist_key_from_message, get_track_ids_from_message
-from sms import ask_for_playlist_key, invalid_playlist_key_notification, playlist_key_success_notification
-from app import db
+from cache import get_playlist, get_playlist_by_key, invalidate_guest_user
+from coalesce import buffer_tracks, coalescing
+from jobs import receive_message
+from message_parser import parse_message, resolve_short_links
+from models import db
+from spotify import MAX_TRACKS_PER_MESSAGE, add_tracks_to_playlist, get_message_track_ids, get_or_create_guest_user
+from sms import ask_for_playlist_key, invalid_playlist_key_notification, playlist_key_success_notification, track_limit_notification
 
 api = Blueprint("api", __name__)
 
 @api.route('/receive_sms', methods=['POST'])
 def receive_sms():
-  """Route for Twilio to pass in recieved messages"""
+  """Route for Twilio to pass in recieved messages
+
+  The message is saved to the queue and handled by a worker so Twilio gets a response right away.
+  A delivery Twilio retries is recognized by its MessageSid and only gets the first response again"""
 
   phone_number = request.form['From']
   message = request.form['Body']
-  
-  track_ids = get_track_ids_from_message(message) # Scan message for track_ids
-  playlist_key = get_playlist_key_from_message(message) # Scan message for playlist keys
+  parsed = parse_message(message)
+
+  return receive_message(
+    message_sid=request.form.get('MessageSid'),
+    phone_number=phone_number,
+    body=message,
+    response=str(MessagingResponse()),
+    queue=bool(parsed), # Only queue messages that contain a playlist key or Spotify link
+    key=parsed.key # Picks the message's lane
+  )
+
+
+def handle_message(phone_number, message, tracks_done=0, record_progress=None):
+  """Act on a received message. Called by the worker for every message in the queue
+
+  Nothing is committed here, the worker commits the message's changes together with its
+  removal from the queue. tracks_done and record_progress are passed on to
+  add_tracks_to_playlist, so a retried message doesn't add its tracks twice"""
+
+  parsed = resolve_short_links(parse_message(message)) # Scan message for playlist keys and track links
+  has_links = parsed.track_ids or parsed.album_ids or parsed.playlist_ids # Track, album or playlist links
+  playlist_key = parsed.key
 
-  # If the message contained either a playlist key or track id
-  if playlist_key or track_ids:
+  # If the message contained either a playlist key or links
+  if playlist_key or has_links:
     guest_user = get_or_create_guest_user(phone_number=phone_number) # Get the guest user object
 
     # If the message contined a playlist key
     if playlist_key:
-      playlist = Playlist.query.filter_by(key=playlist_key).first() # Get phone number's first playlist
+      playlist = get_playlist_by_key(playlist_key) # Get the playlist with that key
       
       # If the key belongs to a playlist
       if playlist:
         guest_user.active_playlist_id = playlist.id # Set the guest user's active playlist to that playlist
         db.session.add(guest_user)
-        db.session.commit()
+        invalidate_guest_user(phone_number)
         playlist_key_success_notification(phone_number=phone_number, playlist=playlist) # Send a message to the user
       else:
         invalid_playlist_key_notification(phone_number, playlist_key)
 
-    # If the message contained track ids
-    if track_ids:
+    # If the message contained links
+    if has_links:
       # If the guest user has an active playlist
       if guest_user.active_playlist_id:
-        playlist = Playlist.query.filter_by(id=guest_user.active_playlist_id).first() # Get phone number's first playlist
+        playlist = get_playlist(guest_user.active_playlist_id) # Get phone number's active playlist
         # If playlist in valid
         if playlist:
-          add_tracks_to_playlist(playlist=playlist, track_ids=track_ids, added_by=phone_number) # Add the tracks to the playlist
+          # Add the tracks, expanding albums and playlists a page at a time
+          track_ids = get_message_track_ids(host_user=playlist.owner, parsed=parsed)
+          if coalescing():
+            received = buffer_tracks(playlist=playlist, track_ids=track_ids, added_by=phone_number) # Added with the rest of the burst by the worker
+          else:
+            received = len(add_tracks_to_playlist(playlist=playlist, track_ids=track_ids, added_by=phone_number,
+                                                  tracks_done=tracks_done, record_progress=record_progress))
+          if received >= MAX_TRACKS_PER_MESSAGE:
+            track_limit_notification(phone_number, MAX_TRACKS_PER_MESSAGE)
       else:
         ask_for_playlist_key(phone_number) # Ask the guest user for a playlist key
-    
-  return str(MessagingResponse())
\ No newline at end of file
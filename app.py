@@ -1,10 +1,19 @@
-"""Spotify GroupChat app"""
+"""Spotify GroupChat app
 
+Build the app with create_app(). Nothing here connects to the database or to Spotify or
+Twilio, so creating the app is fast and safe to do before gunicorn forks its workers. The
+schema is only ever changed by the explicit `flask db upgrade` (or `flask create-db` for a
+new development database). `flask sync-playlists` syncs playlists with Spotify right away."""
+
+import click
 from flask import Flask, redirect
 # from flask_debugtoolbar import DebugToolbarExtension
 from flask_bootstrap import Bootstrap5
+from flask_migrate import Migrate, stamp
 import os
 
+import metrics
+import sync
 # from my_secrets import SECRET_KEY
 from models import connect_db, db
 from demo.demo_routes import demo
@@ -12,37 +21,65 @@ from auth.auth_routes import auth
 from ui.ui_routes import ui
 from api.api_routes import api
 
-app = Flask(__name__) # Create Flask object
-app.register_blueprint(demo, url_prefix="/demo")
-app.register_blueprint(auth, url_prefix="/auth")
-app.register_blueprint(ui, url_prefix="/user")
-app.register_blueprint(api, url_prefix="/api")
+bootstrap = Bootstrap5() # Create bootstrap object
+migrate = Migrate() # Schema changes are versioned in migrations/, apply them with `flask db upgrade`
+
+
+def create_app(config=None):
+  """Create the Flask app. config overrides the settings read from the environment"""
+
+  app = Flask(__name__) # Create Flask object
+  app.register_blueprint(demo, url_prefix="/demo")
+  app.register_blueprint(auth, url_prefix="/auth")
+  app.register_blueprint(ui, url_prefix="/user")
+  app.register_blueprint(api, url_prefix="/api")
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL','postgres:///spotify_sms_playlist').replace("://", "ql://", 1) # PSQL database
+  app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL','postgres:///spotify_sms_playlist').replace("://", "ql://", 1) # PSQL database
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # Don't track modifications
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'calebshouse') # SECRET_KEY for debug toolbar
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False # Disable intercepting redirects
+  app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # Don't track modifications
+  app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'calebshouse') # SECRET_KEY for debug toolbar
+  # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False # Disable intercepting redirects
+  app.config.update(config or {})
 
-# toolbar = DebugToolbarExtension(app) # Create debug toolbar object
-bootsrap =Bootstrap5(app) # Create bootstrap object
+  # toolbar = DebugToolbarExtension(app) # Create debug toolbar object
+  bootstrap.init_app(app)
 
-connect_db(app) # Connect database to Flask object 
-db.create_all() # Create all tables
+  connect_db(app) # Connect database to Flask object
+  migrate.init_app(app, db)
+  metrics.init_app(app) # Time every request and serve /metrics
+
+  app.add_url_rule('/', view_func=root)
+  app.cli.command('create-db')(create_db)
+  app.cli.command('sync-playlists')(click.argument('playlist_ids', nargs=-1)(sync_playlists))
+
+  return app
 
 
-@app.route('/')
 def root():
   """Redirect to auth /auth"""
 
   return redirect('/auth')
 
+
+def create_db():
+  """Create every table in a new, empty database and mark it as up to date with the migrations"""
+
+  db.create_all()
+  stamp() # Later migrations apply on top of this with `flask db upgrade`
+
+
+def sync_playlists(playlist_ids):
+  """Sync the given playlists with Spotify now, or every playlist if none are given"""
+
+  changed = sync.sync_playlists(list(playlist_ids) or None)
+  click.echo(f"{changed} playlists had changed")
+
 # @app.errorhandler(404)
 # def page_not_found(error):
-  
+
 #   return redirect('/user')
 
 # @app.errorhandler(500)
 # def internal_error(error):
 
-#   return redirect('/user')
\ No newline at end of file
+#   return redirect('/user')
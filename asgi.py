@@ -0,0 +1,153 @@
+"""Async entry point for the Twilio webhook
+
+A plain ASGI app that answers POST /api/receive_sms like the Flask route does, with the
+same parsing (message_parser.py) and the same dedup and queueing SQL (jobs.py), run on an
+asyncpg connection pool. The webhook's only I/O is that one short transaction, since the
+Spotify and Twilio calls are made by worker.py, so one process can hold hundreds of
+deliveries open at once where a sync gunicorn worker holds one.
+
+Run it next to the Flask UI and point Twilio's messaging webhook at it:
+
+  uvicorn --factory asgi:create_app --port 8001
+
+It also serves /metrics, for this process. Everything else is left to the Flask app."""
+
+import os
+import time
+from urllib.parse import parse_qsl
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy.ext.asyncio import create_async_engine
+from twilio.twiml.messaging_response import MessagingResponse
+
+import metrics
+from jobs import receive_message_async
+from message_parser import parse_message
+
+RECEIVE_SMS_PATH = '/api/receive_sms'
+DB_POOL_SIZE = int(os.environ.get('ASGI_DB_POOL_SIZE', 10)) # Connections shared by every request in the process
+DB_MAX_OVERFLOW = int(os.environ.get('ASGI_DB_MAX_OVERFLOW', 10)) # Extra connections allowed during a burst
+MAX_BODY_BYTES = 64 * 1024 # Twilio's form posts are a few KB
+
+
+def create_app(config=None):
+  """Create the ASGI app. config overrides the settings read from the environment"""
+
+  config = {
+    'DATABASE_URL': os.environ.get('DATABASE_URL', 'postgres:///spotify_sms_playlist'),
+    **(config or {})
+  }
+  engine = create_async_engine(
+    config['DATABASE_URL'].replace('postgres://', 'postgresql://', 1).replace('postgresql://', 'postgresql+asyncpg://', 1),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True
+  ) # Doesn't connect until the first request
+
+  async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await lifespan(receive, send, engine)
+    elif scope['type'] == 'http':
+      start = time.perf_counter()
+      status, route = await route_request(scope, receive, send, engine)
+      metrics.HTTP_REQUEST_SECONDS.labels(method=scope['method'], route=route, status=status).observe(time.perf_counter() - start)
+
+  app.engine = engine
+  return app
+
+
+async def route_request(scope, receive, send, engine):
+  """Answer one request. Returns its status and route, for the metrics"""
+
+  path = scope['path']
+
+  if path == RECEIVE_SMS_PATH and scope['method'] == 'POST':
+    return await receive_sms(receive, send, engine), RECEIVE_SMS_PATH
+
+  if path == '/metrics' and scope['method'] == 'GET':
+    return await serve_metrics(scope, send), '/metrics'
+
+  status = 405 if path in (RECEIVE_SMS_PATH, '/metrics') else 404
+  await respond(send, status, b'')
+  return status, 'unmatched'
+
+
+async def receive_sms(receive, send, engine):
+  """Route for Twilio to pass in received messages, see api.api_routes.receive_sms"""
+
+  body = await read_body(receive)
+  if body is None:
+    await respond(send, 413, b'')
+    return 413
+
+  form = dict(parse_qsl(body.decode('utf-8', 'replace'), keep_blank_values=True))
+  if 'From' not in form or 'Body' not in form:
+    await respond(send, 400, b'')
+    return 400
+
+  parsed = parse_message(form['Body'])
+
+  async with engine.connect() as connection:
+    response = await receive_message_async(
+      connection,
+      message_sid=form.get('MessageSid'),
+      phone_number=form['From'],
+      body=form['Body'],
+      response=str(MessagingResponse()),
+      queue=bool(parsed), # Only queue messages that contain a playlist key or Spotify link
+      key=parsed.key # Picks the message's lane
+    )
+
+  await respond(send, 200, response.encode(), content_type=b'text/xml; charset=utf-8')
+  return 200
+
+
+async def serve_metrics(scope, send):
+  """Metrics for Prometheus to scrape, see metrics.init_app"""
+
+  headers = dict(scope['headers'])
+  if metrics.METRICS_TOKEN and headers.get(b'authorization', b'').decode('latin-1') != f"Bearer {metrics.METRICS_TOKEN}":
+    await respond(send, 401, b'')
+    return 401
+
+  await respond(send, 200, generate_latest(metrics.registry()), content_type=CONTENT_TYPE_LATEST.encode())
+  return 200
+
+
+async def read_body(receive):
+  """The request body, or None if it's larger than MAX_BODY_BYTES"""
+
+  chunks = []
+  size = 0
+  while True:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      break
+    chunks.append(message.get('body', b''))
+    size += len(chunks[-1])
+    if size > MAX_BODY_BYTES:
+      return None
+    if not message.get('more_body'):
+      break
+  return b''.join(chunks)
+
+
+async def respond(send, status, body, content_type=b'text/plain; charset=utf-8'):
+  await send({
+    'type': 'http.response.start',
+    'status': status,
+    'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+  })
+  await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send, engine):
+  """Close the connection pool when the server shuts down"""
+
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      await engine.dispose()
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
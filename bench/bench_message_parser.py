@@ -0,0 +1,45 @@
+"""Micro-benchmark for parsing inbound text messages
+
+Compares message_parser.parse_message with the two regex scans it replaced.
+Run from the repository root:
+
+  python bench/bench_message_parser.py"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_parser import parse_message
+
+MESSAGES = [
+  "#party",
+  "hey can you add this https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC?si=1a2b3c4d5e6f",
+  "https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC https://open.spotify.com/track/7ouMYWpwJ422jRcDASZB7P "
+  "https://open.spotify.com/track/0VjIjW4GlUZAMYd2vXMi3b #Party",
+  "lol ok see you there",
+  "spotify:track:4uLU6hMCjMI75M1A2tKUQC and https://open.spotify.com/intl-de/album/1ATL5GLyefJaxhQzSPVrLX",
+  "this one's a banger → https://spotify.link/aBc123XyZ",
+]
+
+
+def legacy_parse(message):
+  """The track and key scans parse_message replaced"""
+
+  track_ids = [url.replace('https://open.spotify.com/track/', '') for url in re.findall('https:\/\/open.spotify.com\/track\/+[^? ]*', message)]
+  keys = re.findall('#+[^? ]*', message)
+  return track_ids, keys[0].replace('#', '').lower() if keys else None
+
+
+def bench(function, number=20000):
+  """Messages parsed per second"""
+
+  seconds = min(timeit.repeat(lambda: [function(message) for message in MESSAGES], number=number // len(MESSAGES), repeat=5))
+  return number // len(MESSAGES) * len(MESSAGES) / seconds
+
+
+if __name__ == '__main__':
+  for name, function in [('legacy', legacy_parse), ('parse_message', parse_message)]:
+    print(f"{name:>14}: {bench(function):>10,.0f} messages/s")
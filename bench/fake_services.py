@@ -0,0 +1,162 @@
+"""Local stand-ins for Spotify and Twilio, for load testing
+
+Each fake is an HTTP server on its own thread that answers the handful of endpoints the app
+uses. Every response can be delayed by `latency` seconds (plus up to `jitter`), and a
+fraction of them replaced with a server error (`error_rate`) or a 429 (`rate_limit_rate`).
+Point the app at them with SPOTIFY_API_URL, SPOTIFY_AUTH_BASE_URL and TWILIO_API_URL."""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeService:
+  """An HTTP server on 127.0.0.1 that routes requests to methods named `handle_<name>`"""
+
+  routes = [] # (method, path regex, handler name)
+
+  def __init__(self, latency=0, jitter=0, error_rate=0, rate_limit_rate=0, port=0):
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.rate_limit_rate = rate_limit_rate
+    self.calls = Counter() # handler name or injected status -> count
+    self.lock = threading.Lock()
+    self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+    self.server.daemon_threads = True
+
+  @property
+  def url(self):
+    return f"http://127.0.0.1:{self.server.server_port}"
+
+  def start(self):
+    threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def count(self, name):
+    with self.lock:
+      self.calls[name] += 1
+
+  def stats(self):
+    with self.lock:
+      return dict(self.calls)
+
+  def reset(self):
+    with self.lock:
+      self.calls.clear()
+
+  def respond(self, method, path, query, body):
+    """Return (status, headers, json body) for a request"""
+
+    time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    roll = random.random()
+    if roll < self.error_rate:
+      self.count('injected_503')
+      return 503, {}, {"error": {"status": 503, "message": "Injected error"}}
+    if roll < self.error_rate + self.rate_limit_rate:
+      self.count('injected_429')
+      return 429, {'Retry-After': '1'}, {"error": {"status": 429, "message": "Injected rate limit"}}
+
+    for route_method, pattern, name in self.routes:
+      match = re.fullmatch(pattern, path)
+      if route_method == method and match:
+        self.count(name)
+        return getattr(self, f"handle_{name}")(query, body, *match.groups())
+
+    self.count('not_found')
+    return 404, {}, {"error": {"status": 404, "message": f"No fake for {method} {path}"}}
+
+  def handler_class(self):
+    service = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1' # Keep-alive, like the real services
+
+      def handle_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        status, headers, payload = service.respond(self.command, url.path, parse_qs(url.query), body)
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+          self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+      do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+      def log_message(self, format, *args):
+        pass # Don't print every request
+
+    return Handler
+
+
+class FakeSpotify(FakeService):
+  """Spotify's token endpoint, /me, several tracks and add items to playlist"""
+
+  routes = [
+    ('POST', r'/api/token', 'token'),
+    ('GET', r'/v1/me', 'me'),
+    ('GET', r'/v1/tracks', 'tracks'),
+    ('POST', r'/v1/playlists/([^/]+)/tracks', 'add_tracks'),
+  ]
+
+  def handle_token(self, query, body):
+    return 200, {}, {
+      "access_token": f"fake-access-token-{random.getrandbits(32)}",
+      "token_type": "Bearer",
+      "expires_in": 3600,
+      "refresh_token": "fake-refresh-token",
+      "scope": "user-read-email playlist-modify-public playlist-modify-private"
+    }
+
+  def handle_me(self, query, body):
+    return 200, {}, {
+      "id": "loadtest_host",
+      "display_name": "Load Test",
+      "email": "loadtest@example.com",
+      "external_urls": {"spotify": "https://open.spotify.com/user/loadtest_host"}
+    }
+
+  def handle_tracks(self, query, body):
+    ids = query.get('ids', [''])[0].split(',')
+    return 200, {}, {"tracks": [{"id": id, "name": f"Song {id[:6]}", "artists": [{"name": "Fake Artist"}]} for id in ids]}
+
+  def handle_add_tracks(self, query, body, playlist_id):
+    uris = json.loads(body or '{}').get('uris', [])
+    if len(uris) > 100:
+      return 400, {}, {"error": {"status": 400, "message": "Too many uris"}}
+    return 201, {}, {"snapshot_id": f"snapshot-{random.getrandbits(32)}"}
+
+
+class FakeTwilio(FakeService):
+  """Twilio's create message endpoint"""
+
+  routes = [
+    ('POST', r'/2010-04-01/Accounts/([^/]+)/Messages\.json', 'create_message'),
+  ]
+
+  def handle_create_message(self, query, body, account_sid):
+    form = {name: values[0] for name, values in parse_qs(body).items()}
+    return 201, {}, {
+      "sid": f"SM{random.getrandbits(128):032x}",
+      "account_sid": account_sid,
+      "to": form.get('To'),
+      "from": form.get('From'),
+      "body": form.get('Body'),
+      "status": "queued"
+    }
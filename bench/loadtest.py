@@ -0,0 +1,344 @@
+"""Load test for the /api/receive_sms webhook
+
+Starts fake Spotify and Twilio servers (bench/fake_services.py), then the web app under
+gunicorn and a queue worker, both pointed at the fakes. It then posts realistic mixes of text
+messages to the webhook. For each scenario it reports:
+
+- the webhook's throughput and p50/p95/p99 latency;
+- how long the worker took to drain the queue;
+- the calls each fake received.
+
+Results are saved as JSON so runs can be compared. Run from the repository root:
+
+  python bench/loadtest.py --requests 2000 --concurrency 32 --spotify-latency 0.05
+
+The load test uses its own database (--database-url), which is dropped and recreated at the start
+of every run."""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import string
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import requests
+
+from fake_services import FakeSpotify, FakeTwilio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLAYLIST_ID = 'loadtest'
+PLAYLIST_KEY = 'loadtest'
+
+CHATTER = ["lol", "see you there!", "what's the password?", "who's bringing ice", "omw", "this song slaps"]
+
+# Share of each kind of message in a scenario
+SCENARIOS = {
+  'chatter': {'chatter': 1}, # Nothing to queue
+  'tracks': {'track': 1}, # One new song per text
+  'party': {'track': 0.45, 'hit': 0.2, 'tracks': 0.05, 'key': 0.15, 'chatter': 0.15}, # The same hit texted over and over
+  'twilio_retries': {'track': 0.5, 'retry': 0.5}, # Half the deliveries are Twilio retrying the one before
+}
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+  parser.add_argument('--requests', type=int, default=1000, help='Webhook requests per scenario')
+  parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once')
+  parser.add_argument('--guests', type=int, default=200, help='Phone numbers texting the playlist')
+  parser.add_argument('--web-workers', type=int, default=2, help='gunicorn worker processes')
+  parser.add_argument('--worker-concurrency', type=int, default=4, help='Queue worker threads')
+  parser.add_argument('--spotify-app-rate', type=float, default=10, help="Each process's Spotify requests per second, as in production")
+  parser.add_argument('--spotify-user-rate', type=float, default=3, help='Spotify requests per second per host user. Every message goes to one host, so this bounds the drain rate')
+  parser.add_argument('--spotify-latency', type=float, default=0.05, help='Seconds added to every Spotify response')
+  parser.add_argument('--spotify-error-rate', type=float, default=0, help='Fraction of Spotify responses that are 503s')
+  parser.add_argument('--spotify-rate-limit-rate', type=float, default=0, help='Fraction of Spotify responses that are 429s')
+  parser.add_argument('--twilio-latency', type=float, default=0.1, help='Seconds added to every Twilio response')
+  parser.add_argument('--twilio-error-rate', type=float, default=0, help='Fraction of Twilio responses that are 503s')
+  parser.add_argument('--coalesce-window', type=float, default=0, help='COALESCE_WINDOW_SECONDS for the worker, 0 adds every text on its own')
+  parser.add_argument('--jitter', type=float, default=0.02, help='Up to this many seconds are added to every fake response')
+  parser.add_argument('--drain-timeout', type=float, default=300, help='Longest to wait for the worker to empty the queue')
+  parser.add_argument('--database-url', default=os.environ.get('LOADTEST_DATABASE_URL', 'postgres:///spotify_sms_playlist_loadtest'))
+  parser.add_argument('--port', type=int, default=5055, help='Port for the web app')
+  parser.add_argument('--seed', type=int, default=0, help='Seed for the message mix')
+  parser.add_argument('--output', help='JSON file for the results, default bench/results/loadtest-<time>.json')
+  return parser.parse_args()
+
+
+# -------------------------- SETUP ---------------------------
+
+def app_environment(args, spotify, twilio):
+  """Environment variables that point the app at the fakes and the load test database"""
+
+  return {
+    "DATABASE_URL": args.database_url,
+    "SPOTIFY_API_URL": spotify.url + '/v1',
+    "SPOTIFY_AUTH_BASE_URL": spotify.url,
+    "SPOTIFY_CLIENT_ID": 'loadtest',
+    "SPOTIFY_CLIENT_SECRET": 'loadtest',
+    "TWILIO_API_URL": twilio.url,
+    "TWILIO_ACCOUNT_SID": 'ACloadtest',
+    "TWILIO_AUTH_TOKEN": 'loadtest',
+    "MY_TWILIO_NUMBER": '+15550000000',
+    "SMS_MESSAGES_PER_SECOND": '0', # The fake doesn't need sends spaced out
+    "RESOLVE_SHORT_LINKS": 'false',
+    "SPOTIFY_APP_REQUESTS_PER_SECOND": str(args.spotify_app_rate),
+    "SPOTIFY_USER_REQUESTS_PER_SECOND": str(args.spotify_user_rate),
+    "WORKER_CONCURRENCY": str(args.worker_concurrency),
+    "WORKER_POLL_INTERVAL_SECONDS": '0.1',
+    "COALESCE_WINDOW_SECONDS": str(args.coalesce_window),
+  }
+
+
+loadtest_app = None
+
+def get_app():
+  """The app, created on first use once the environment points at the load test database"""
+
+  global loadtest_app
+  if loadtest_app is None:
+    from app import create_app
+    loadtest_app = create_app()
+  return loadtest_app
+
+
+def reset_database(args, spotify):
+  """Recreate the load test database with a host, their playlist and guests who have it active"""
+
+  from models import GuestUser, HostUser, Playlist, db
+
+  with get_app().app_context():
+    db.drop_all()
+    db.create_all()
+
+    host_user = HostUser(id='loadtest_host', display_name='Load Test', email='loadtest@example.com',
+      url='https://open.spotify.com/user/loadtest_host', access_token='fake-access-token', refresh_token='fake-refresh-token',
+      token_expires_at=datetime.utcnow() + timedelta(days=1))
+    playlist = Playlist(id=PLAYLIST_ID, title='Load Test', key=PLAYLIST_KEY, url=f"https://open.spotify.com/playlist/{PLAYLIST_ID}",
+      endpoint=f"{spotify.url}/v1/playlists/{PLAYLIST_ID}", owner=host_user)
+    guest_users = [GuestUser(id=phone_number, phone_number=phone_number, active_playlist_id=PLAYLIST_ID) for phone_number in guest_phone_numbers(args)]
+    db.session.add_all([host_user, playlist, *guest_users])
+    db.session.commit()
+
+
+def clear_between_scenarios():
+  """Empty the queue, the playlist and the recorded MessageSids"""
+
+  from models import InboundMessage, PendingAdd, PlaylistTrack, ReceivedMessage, db
+
+  with get_app().app_context():
+    for model in (InboundMessage, PendingAdd, PlaylistTrack, ReceivedMessage):
+      model.query.delete()
+    db.session.commit()
+
+
+def queue_state():
+  """Messages (and coalesced tracks) still waiting in the queue, and messages that were dead-lettered"""
+
+  from jobs import DEAD
+  from models import InboundMessage, PendingAdd, db
+
+  with get_app().app_context():
+    waiting = InboundMessage.query.filter(InboundMessage.status != DEAD).count() + PendingAdd.query.count()
+    dead = InboundMessage.query.filter(InboundMessage.status == DEAD).count()
+    db.session.remove()
+  return waiting, dead
+
+
+def start_processes(args, environment):
+  """Start the web app and the queue worker, and wait for the web app to answer"""
+
+  web = subprocess.Popen(
+    [sys.executable, '-m', 'gunicorn', '--workers', str(args.web_workers), '--bind', f"127.0.0.1:{args.port}", '--log-level', 'warning', 'app:create_app()'],
+    cwd=ROOT, env=environment
+  )
+  worker = subprocess.Popen([sys.executable, 'worker.py'], cwd=ROOT, env=environment, stderr=subprocess.DEVNULL)
+
+  for i in range(100):
+    try:
+      requests.get(f"http://127.0.0.1:{args.port}/", allow_redirects=False, timeout=1)
+      return [web, worker]
+    except requests.ConnectionError:
+      time.sleep(0.1)
+
+  stop_processes([web, worker])
+  raise RuntimeError('The web app did not start')
+
+
+def stop_processes(processes):
+  for process in processes:
+    process.terminate()
+  for process in processes:
+    process.wait(timeout=30)
+
+
+# -------------------------- MESSAGES ---------------------------
+
+def guest_phone_numbers(args):
+  return [f"+1555{i:07d}" for i in range(args.guests)]
+
+
+def track_link(track_id):
+  return f"https://open.spotify.com/track/{track_id}?si={uuid.uuid4().hex[:16]}"
+
+
+def build_messages(scenario, args, rng):
+  """The webhook form posts for a scenario, in the order they'll be sent"""
+
+  kinds, weights = zip(*SCENARIOS[scenario].items())
+  phone_numbers = guest_phone_numbers(args)
+  track_ids = [''.join(rng.choice(string.ascii_letters + string.digits) for i in range(22)) for i in range(args.requests)]
+  hit = track_ids[0]
+
+  forms = []
+  for kind in rng.choices(kinds, weights, k=args.requests):
+    if kind == 'retry' and forms:
+      forms.append(dict(forms[-1])) # Same MessageSid
+      continue
+
+    if kind == 'key':
+      body = f"#{PLAYLIST_KEY}"
+    elif kind == 'hit':
+      body = f"play this!! {track_link(hit)}"
+    elif kind == 'tracks':
+      body = ' '.join(track_link(rng.choice(track_ids)) for i in range(3))
+    elif kind == 'track' or kind == 'retry':
+      body = track_link(rng.choice(track_ids))
+    else:
+      body = rng.choice(CHATTER)
+
+    forms.append({'From': rng.choice(phone_numbers), 'Body': body, 'MessageSid': f"SM{uuid.uuid4().hex}"})
+
+  return forms
+
+
+# -------------------------- RUN ---------------------------
+
+def post_messages(args, forms):
+  """Post every form to the webhook, concurrency at a time. Returns each request's latency and the status codes"""
+
+  url = f"http://127.0.0.1:{args.port}/api/receive_sms"
+  sessions = threading.local() # A keep-alive session per thread, like Twilio's
+
+  def post(form):
+    if not hasattr(sessions, 'session'):
+      sessions.session = requests.Session()
+    start = time.perf_counter()
+    try:
+      status = sessions.session.post(url, data=form, timeout=15).status_code
+    except requests.RequestException:
+      status = 'error'
+    return time.perf_counter() - start, status
+
+  with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    results = list(executor.map(post, forms))
+
+  latencies = [latency for latency, status in results]
+  status_codes = {}
+  for latency, status in results:
+    status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+  return latencies, status_codes
+
+
+def wait_for_drain(args):
+  """Seconds until the worker emptied the queue, or None if it didn't within drain_timeout"""
+
+  start = time.perf_counter()
+  while time.perf_counter() - start < args.drain_timeout:
+    waiting, dead = queue_state()
+    if not waiting:
+      return time.perf_counter() - start
+    time.sleep(0.2)
+  return None
+
+
+def percentiles(latencies):
+  """p50, p95 and p99 in milliseconds"""
+
+  if len(latencies) < 2:
+    return {"p50_ms": latencies[0] * 1000 if latencies else None, "p95_ms": None, "p99_ms": None}
+
+  cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+  return {"p50_ms": cuts[49] * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+def run_scenario(scenario, args, spotify, twilio):
+  rng = random.Random(f"{args.seed}-{scenario}")
+  forms = build_messages(scenario, args, rng)
+
+  clear_between_scenarios()
+  spotify.reset()
+  twilio.reset()
+
+  start = time.perf_counter()
+  latencies, status_codes = post_messages(args, forms)
+  webhook_seconds = time.perf_counter() - start
+
+  drain_seconds = wait_for_drain(args)
+  total_seconds = time.perf_counter() - start
+  waiting, dead = queue_state()
+
+  return {
+    "requests": len(forms),
+    "status_codes": status_codes,
+    "webhook_seconds": webhook_seconds,
+    "webhook_requests_per_second": len(forms) / webhook_seconds,
+    **percentiles(latencies),
+    "max_ms": max(latencies) * 1000,
+    "drain_seconds": drain_seconds, # After the last webhook response, None if it timed out
+    "end_to_end_messages_per_second": len(forms) / total_seconds if drain_seconds is not None else None,
+    "messages_left": waiting,
+    "messages_dead": dead,
+    "spotify_calls": spotify.stats(),
+    "twilio_calls": twilio.stats(),
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  args = parse_args()
+
+  spotify = FakeSpotify(latency=args.spotify_latency, jitter=args.jitter, error_rate=args.spotify_error_rate,
+    rate_limit_rate=args.spotify_rate_limit_rate).start()
+  twilio = FakeTwilio(latency=args.twilio_latency, jitter=args.jitter, error_rate=args.twilio_error_rate).start()
+
+  environment = app_environment(args, spotify, twilio)
+  os.environ.update(environment) # For the app imported here to reset the database
+  sys.path.insert(0, ROOT)
+  reset_database(args, spotify)
+
+  results = {"started_at": datetime.now(timezone.utc).isoformat(), "commit": git_commit(), "config": vars(args), "scenarios": {}}
+  processes = start_processes(args, {**os.environ, **environment})
+  try:
+    for scenario in args.scenarios:
+      result = results["scenarios"][scenario] = run_scenario(scenario, args, spotify, twilio)
+      print(f"{scenario:>15}: {result['webhook_requests_per_second']:8.1f} req/s  "
+            f"p50 {result['p50_ms']:7.1f}ms  p95 {result['p95_ms']:7.1f}ms  p99 {result['p99_ms']:7.1f}ms  "
+            f"drained in {result['drain_seconds'] or float('nan'):.1f}s", flush=True)
+  finally:
+    stop_processes(processes)
+    spotify.stop()
+    twilio.stop()
+
+  output = args.output or os.path.join(ROOT, 'bench', 'results', f"loadtest-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json")
+  os.makedirs(os.path.dirname(output), exist_ok=True)
+  with open(output, 'w') as file:
+    json.dump(results, file, indent=2)
+  print(f"Saved results to {output}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,262 @@
+"""In-process cache for the lookups made for every text message
+
+Playlists (by key and by id) and guest users (by phone number) almost never change, so
+each process keeps a copy of their column values in a bounded LRU cache with a TTL. Cached
+rows are merged back into the session without a query.
+
+Anything that changes a cached row must call invalidate_playlist or invalidate_guest_user
+before committing. The entry is forgotten once the change is committed, since a lookup by
+another thread in the meantime would cache the old row again. When CACHE_NOTIFY_CHANNEL is
+set, invalidations are also sent to every other process with Postgres NOTIFY, and each
+process LISTENs for them on a background thread."""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from select import select as wait_until_readable
+import psycopg2
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from models import GuestUser, Playlist, db
+
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', 10000)) # Entries kept per cache
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', 300)) # Upper bound on how stale an entry can be
+CACHE_NOTIFY_CHANNEL = os.environ.get('CACHE_NOTIFY_CHANNEL') # Postgres channel for invalidations between processes, off if not set
+
+logger = logging.getLogger(__name__)
+MISSING = object() # Returned by TTLCache.get when there's no entry
+
+
+class TTLCache:
+  """Thread safe LRU cache whose entries expire ttl seconds after they were set"""
+
+  def __init__(self, maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL_SECONDS):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.entries = OrderedDict() # key -> (expires_at, value), least recently used first
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or entry[0] < time.monotonic():
+        self.entries.pop(key, None)
+        self.misses += 1
+        return MISSING
+
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries[key] = (time.monotonic() + self.ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False) # Evict the least recently used entry
+
+  def pop(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def pop_where(self, predicate):
+    """Remove every entry whose value matches predicate"""
+
+    with self.lock:
+      for key in [key for key, (expires_at, value) in self.entries.items() if predicate(value)]:
+        del self.entries[key]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+playlists_by_key = TTLCache() # lowercased key -> playlist row
+playlists_by_id = TTLCache() # id -> playlist row
+guest_users_by_phone = TTLCache() # phone number -> guest user row
+caches = {"playlists_by_key": playlists_by_key, "playlists_by_id": playlists_by_id, "guest_users_by_phone": guest_users_by_phone}
+
+
+# -------------------------- LOOKUPS ---------------------------
+
+def get_playlist_by_key(key):
+  """Get the Playlist with a #key, or None"""
+
+  return cached_lookup(playlists_by_key, key, lambda: Playlist.query.filter(func.lower(Playlist.key) == key).first())
+
+
+def get_playlist(id):
+  """Get the Playlist with an id, or None"""
+
+  return cached_lookup(playlists_by_id, id, lambda: Playlist.query.filter_by(id=id).first())
+
+
+def get_guest_user_by_phone(phone_number):
+  """Get the GuestUser (or HostUser) with a phone number, or None"""
+
+  return cached_lookup(guest_users_by_phone, phone_number, lambda: GuestUser.query.filter_by(phone_number=phone_number).first())
+
+
+def cached_lookup(cache, key, query):
+  """Return the cached row for key merged into the session, or run query and cache its result
+
+  Rows that weren't found aren't cached, so new rows show up right away"""
+
+  start_invalidation_listener()
+
+  row = cache.get(key)
+  if row is not MISSING:
+    return restore(row)
+
+  instance = query()
+  if instance is not None:
+    cache.set(key, snapshot(instance))
+  return instance
+
+
+def snapshot(instance):
+  """The class and column values of an instance, safe to share between sessions and threads
+
+  Only the base table's columns are kept, so a HostUser's tokens are never cached. They are
+  loaded from the database if they're used."""
+
+  base_mapper = inspect(instance).mapper.base_mapper
+  return type(instance), {attr.key: getattr(instance, attr.key) for attr in base_mapper.column_attrs}
+
+
+def restore(row):
+  """Merge a snapshot into the session as a persistent instance, without querying"""
+
+  cls, values = row
+  instance = cls(**values)
+  make_transient_to_detached(instance) # Treat the values as loaded from the database
+  return db.session.merge(instance, load=False)
+
+
+# -------------------------- INVALIDATION ---------------------------
+
+def invalidate_playlist(playlist):
+  """Forget a playlist, and the guest users who have it as their active playlist, when the change is committed
+
+  Call before committing the change, so other processes are notified when it's committed"""
+
+  forget_after_commit(forget_playlist, playlist.id)
+  notify({"playlist_id": playlist.id})
+
+
+def invalidate_guest_user(phone_number):
+  """Forget the guest user with a phone number, when the change is committed
+
+  Call before committing the change, so other processes are notified when it's committed"""
+
+  if phone_number:
+    forget_after_commit(forget_guest_user, phone_number)
+    notify({"phone_number": phone_number})
+
+
+def forget_after_commit(forget, key):
+  """Call forget(key) once the session's transaction commits"""
+
+  db.session.info.setdefault('forget_after_commit', []).append((forget, key))
+
+
+@event.listens_for(Session, 'after_commit')
+def forget_committed(session):
+  for forget, key in session.info.pop('forget_after_commit', []):
+    forget(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def keep_rolled_back(session):
+  session.info.pop('forget_after_commit', None) # The cached rows are still right
+
+
+def forget_playlist(id):
+  playlists_by_id.pop(id)
+  playlists_by_key.pop_where(lambda row: row[1]["id"] == id)
+  guest_users_by_phone.pop_where(lambda row: row[1]["active_playlist_id"] == id)
+
+
+def forget_guest_user(phone_number):
+  guest_users_by_phone.pop(phone_number)
+
+
+def clear_caches():
+  for cache in caches.values():
+    cache.clear()
+
+
+def cache_stats():
+  """Hit and miss counts for every cache, for metrics"""
+
+  return {name: cache.stats() for name, cache in caches.items()}
+
+
+def notify(payload):
+  """Send an invalidation to the other processes when the session's transaction commits"""
+
+  if CACHE_NOTIFY_CHANNEL:
+    db.session.execute(select(func.pg_notify(CACHE_NOTIFY_CHANNEL, json.dumps(payload))))
+
+
+def apply_invalidation(payload):
+  """Act on an invalidation sent by notify"""
+
+  if "playlist_id" in payload:
+    forget_playlist(payload["playlist_id"])
+  if "phone_number" in payload:
+    forget_guest_user(payload["phone_number"])
+
+
+listener_pid = None # Process the invalidation listener is running in
+listener_lock = threading.Lock()
+
+def start_invalidation_listener():
+  """Start listening for invalidations from other processes, once per process"""
+
+  global listener_pid
+
+  if not CACHE_NOTIFY_CHANNEL or listener_pid == os.getpid():
+    return
+
+  with listener_lock:
+    if listener_pid != os.getpid():
+      listener_pid = os.getpid()
+      url = db.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+      threading.Thread(target=listen, args=(url,), name='cache-invalidation', daemon=True).start()
+
+
+def listen(url):
+  """LISTEN for invalidations forever, reconnecting if the connection drops"""
+
+  while True:
+    connection = None
+    try:
+      connection = psycopg2.connect(url)
+      connection.autocommit = True
+      connection.cursor().execute(f'LISTEN "{CACHE_NOTIFY_CHANNEL}"')
+      clear_caches() # Invalidations may have been missed while we weren't listening
+
+      while True:
+        # Wait for a notification to arrive
+        if not wait_until_readable([connection], [], [], 60)[0]:
+          continue
+
+        connection.poll()
+        while connection.notifies:
+          apply_invalidation(json.loads(connection.notifies.pop(0).payload))
+
+    except Exception:
+      logger.exception('Cache invalidation listener lost its connection')
+      if connection:
+        connection.close()
+      time.sleep(5)
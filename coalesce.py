@@ -0,0 +1,173 @@
+"""Coalescing window for bursts of links from the same people
+
+Guests often text five links as five texts a few seconds apart. When COALESCE_WINDOW_SECONDS
+is set, handle_message saves their tracks to the pending_adds table instead of adding them
+to Spotify one text at a time. The worker's flush thread adds a playlist's pending tracks
+once the oldest has waited COALESCE_WINDOW_SECONDS, or as soon as COALESCE_MAX_TRACKS are
+waiting, in as few Spotify requests as possible and in the order they arrived. With
+COALESCE_SUMMARY_TEXTS set, everyone whose tracks were flushed then gets a single text
+summing them up.
+
+A flush that fails is retried with the queue's exponential backoff (see jobs.py). After
+MAX_ATTEMPTS failures the playlist's pending tracks are dead-lettered, kept for inspection,
+and their senders are told they couldn't be added."""
+
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import timedelta
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import get_playlist
+from jobs import MAX_ATTEMPTS, retry_delay
+from models import PendingAdd, db
+from sms import tracks_added_notification, tracks_failed_notification
+from spotify import MAX_TRACKS_PER_ADD, TRACK_ADDED, TRACK_FAILED, TRACK_ON_PLAYLIST, add_tracks_to_playlist, batched, try_lock_playlist, unique
+from spotify_client import SpotifyDeferred
+
+COALESCE_WINDOW_SECONDS = float(os.environ.get('COALESCE_WINDOW_SECONDS', 0)) # How long to hold tracks before adding them, off when 0
+COALESCE_MAX_TRACKS = int(os.environ.get('COALESCE_MAX_TRACKS', MAX_TRACKS_PER_ADD)) # Add early once this many are waiting, one request's worth by default
+COALESCE_SUMMARY_TEXTS = os.environ.get('COALESCE_SUMMARY_TEXTS', 'false').lower() == 'true' # Text senders what was added, off since adds aren't confirmed otherwise
+
+logger = logging.getLogger(__name__)
+
+deferred_until = {} # playlist id -> time.monotonic() Spotify asked us to wait until before flushing it again
+deferred_lock = threading.Lock()
+
+
+def coalescing():
+  """Check if tracks should be buffered instead of added right away"""
+
+  return COALESCE_WINDOW_SECONDS > 0
+
+
+def buffer_tracks(playlist, track_ids, added_by):
+  """Save track_ids to be added to the playlist by a later flush, without committing
+
+  Returns the number of tracks saved"""
+
+  rows = [{"playlist_id": playlist.id, "track_id": track_id, "added_by": added_by} for track_id in unique(track_ids)]
+  if rows:
+    db.session.execute(insert(PendingAdd).values(rows)) # Ids are given out in the order of the rows, which keeps the arrival order
+  return len(rows)
+
+
+def due_playlist_ids():
+  """Ids of the playlists with pending tracks that have waited long enough, or enough of them"""
+
+  return db.session.scalars(
+    select(PendingAdd.playlist_id)
+      .where(PendingAdd.attempts < MAX_ATTEMPTS) # Not dead-lettered
+      .group_by(PendingAdd.playlist_id)
+      .having(and_(
+        or_(
+          func.min(PendingAdd.created_at) <= func.now() - timedelta(seconds=COALESCE_WINDOW_SECONDS),
+          func.count() >= COALESCE_MAX_TRACKS
+        ),
+        func.max(PendingAdd.run_at) <= func.now() # Backing off after a failed flush
+      ))
+  ).all()
+
+
+def flush_due():
+  """Flush every playlist that is due and that Spotify hasn't asked us to wait for
+
+  Returns the number of tracks flushed"""
+
+  flushed = 0
+
+  for playlist_id in due_playlist_ids():
+    with deferred_lock:
+      if deferred_until.get(playlist_id, 0) > time.monotonic():
+        continue
+      deferred_until.pop(playlist_id, None)
+
+    try:
+      flushed += flush_playlist(playlist_id)
+    except SpotifyDeferred as error:
+      logger.warning('Deferring pending adds for playlist %s for %.1fs: %s', playlist_id, error.retry_after, error)
+      with deferred_lock:
+        deferred_until[playlist_id] = time.monotonic() + error.retry_after
+    except Exception:
+      logger.exception('Failed to flush pending adds for playlist %s', playlist_id)
+      fail_pending(playlist_id, error=traceback.format_exc())
+
+  return flushed
+
+
+def flush_playlist(playlist_id):
+  """Add a playlist's pending tracks to Spotify in the order they arrived and text each sender a summary
+
+  Each batch's pending rows are deleted along with recording it, and the batches Spotify
+  added are committed even if a later batch fails. Returns the number of tracks flushed"""
+
+  # One transaction adds to a playlist at a time, without locking its row against the web app
+  playlist = get_playlist(playlist_id)
+  if not playlist or not try_lock_playlist(playlist_id):
+    db.session.rollback()
+    return 0
+
+  pending = db.session.execute(
+    select(PendingAdd.id, PendingAdd.track_id, PendingAdd.added_by)
+      .where(PendingAdd.playlist_id == playlist_id, PendingAdd.attempts < MAX_ATTEMPTS)
+      .order_by(PendingAdd.id)
+  ).all()
+
+  summaries = {} # phone number -> Counter of outcomes
+  flushed = 0
+  try:
+    for batch in batched(pending, MAX_TRACKS_PER_ADD):
+      added_by = {} # track_id -> the first person to send it
+      for row in batch:
+        added_by.setdefault(row.track_id, row.added_by)
+
+      outcomes = add_tracks_to_playlist(playlist=playlist, track_ids=[row.track_id for row in batch], added_by=added_by)
+      db.session.execute(delete(PendingAdd).where(PendingAdd.id.in_([row.id for row in batch])))
+
+      for track_id, outcome in outcomes.items():
+        summaries.setdefault(added_by[track_id], Counter())[outcome] += 1
+      flushed += len(batch)
+  finally:
+    # Keep the batches that made it to Spotify, so they aren't added again
+    try:
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      summaries = {}
+      flushed = 0
+
+    for phone_number, outcomes in summaries.items():
+      if phone_number and COALESCE_SUMMARY_TEXTS:
+        tracks_added_notification(phone_number, playlist, added=outcomes[TRACK_ADDED], on_playlist=outcomes[TRACK_ON_PLAYLIST], failed=outcomes[TRACK_FAILED])
+
+  return flushed
+
+
+def fail_pending(playlist_id, error):
+  """Schedule a playlist's pending tracks to be flushed again with exponential backoff, or
+  dead-letter the ones that have failed MAX_ATTEMPTS times and tell their senders"""
+
+  rows = db.session.execute(
+    update(PendingAdd)
+      .where(PendingAdd.playlist_id == playlist_id, PendingAdd.attempts < MAX_ATTEMPTS)
+      .values(attempts=PendingAdd.attempts + 1, last_error=error)
+      .returning(PendingAdd.id, PendingAdd.added_by, PendingAdd.attempts)
+  ).all()
+  if rows:
+    delay = retry_delay(max(row.attempts for row in rows))
+    db.session.execute(
+      update(PendingAdd).where(PendingAdd.id.in_([row.id for row in rows])).values(run_at=func.now() + timedelta(seconds=delay))
+    )
+  db.session.commit()
+
+  dead = Counter(row.added_by for row in rows if row.attempts >= MAX_ATTEMPTS)
+  if dead:
+    logger.error('Gave up on %s pending adds for playlist %s', sum(dead.values()), playlist_id)
+    playlist = get_playlist(playlist_id)
+    for phone_number, failed in dead.items():
+      if phone_number and playlist:
+        tracks_failed_notification(phone_number, playlist, failed=failed)
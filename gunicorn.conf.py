@@ -0,0 +1,29 @@
+"""gunicorn settings, loaded from the working directory by `gunicorn 'app:create_app()'`
+
+The app is created once in the master process and forked into every worker, so workers boot
+without importing anything. Every worker writes its metrics to PROMETHEUS_MULTIPROC_DIR so
+/metrics can add them up across workers (see metrics.py)."""
+
+import os
+import shutil
+import tempfile
+
+# Must be set before prometheus_client is imported, here and in the workers forked from here
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'prometheus_multiproc'))
+
+from prometheus_client import multiprocess
+
+preload_app = True # Creating the app doesn't connect to anything, so it's safe to share
+
+
+def on_starting(server):
+  """Start without the metrics of a previous run"""
+
+  shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+  os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+  """Stop reporting live gauges for a worker that exited. Its counters and histograms are kept"""
+
+  multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,242 @@
+"""Durable queue of received text messages
+
+The /api/receive_sms webhook only saves messages here. Worker processes (worker.py) claim
+them one at a time with SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers can
+drain the queue without processing a message twice.
+
+Every message is given a lane when it's saved: the playlist it's headed for, as far as we
+can tell then, or else its phone number. A worker only claims a message once every earlier
+message in its lane, and every earlier message from the same phone, is finished. So each
+playlist's adds happen in the order they arrived, while messages for different playlists
+are processed in parallel.
+
+Each delivery's MessageSid is recorded in the same transaction as the queued message, so a
+delivery Twilio retries is answered with the first delivery's response and not queued again.
+receive_message_async does the same for the async webhook in asgi.py, with the same SQL."""
+
+import os
+import random
+from datetime import timedelta
+from sqlalchemy import and_, exists, func, or_, select, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import MISSING, TTLCache
+from models import GuestUser, InboundMessage, Playlist, ReceivedMessage, db
+
+PENDING = 'pending' # Waiting for a worker
+PROCESSING = 'processing' # Claimed by a worker
+DEAD = 'dead' # Gave up after MAX_ATTEMPTS, kept for inspection
+
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5)) # Attempts before a message is dead-lettered
+BACKOFF_SECONDS = float(os.environ.get('JOB_BACKOFF_SECONDS', 5)) # Delay before the first retry, doubled for every retry after
+MAX_BACKOFF_SECONDS = float(os.environ.get('JOB_MAX_BACKOFF_SECONDS', 300))
+LOCK_TIMEOUT_SECONDS = int(os.environ.get('JOB_LOCK_TIMEOUT_SECONDS', 300)) # Reclaim messages from workers that died mid-message. Live workers keep extending their locks
+MESSAGE_SID_TTL_SECONDS = int(os.environ.get('MESSAGE_SID_TTL_SECONDS', 86400)) # How long to remember deliveries, well past Twilio's retries
+
+received_responses = TTLCache(ttl=MESSAGE_SID_TTL_SECONDS) # MessageSid -> response, in front of the received_messages table
+
+
+def receive_message(message_sid, phone_number, body, response, queue=True, key=None):
+  """Record a delivery from Twilio and, if queue is set, save its text message to the queue
+
+  key is the playlist key in the message, if any, to find its lane. Returns the TwiML to answer with. That's response, unless Twilio already delivered
+  message_sid, in which case it's the response recorded for the first delivery and nothing
+  is queued"""
+
+  if message_sid:
+    first_response = received_responses.get(message_sid)
+    if first_response is not MISSING:
+      return first_response
+
+    recorded = db.session.execute(record_delivery(message_sid, response)).first()
+
+    # Twilio retried a delivery we already have
+    if not recorded:
+      db.session.rollback()
+      first_response = db.session.scalar(recorded_response(message_sid))
+      received_responses.set(message_sid, first_response)
+      return first_response
+
+  if queue:
+    db.session.add(InboundMessage(phone_number=phone_number, body=body, status=PENDING, lane=message_lane(phone_number, key)))
+  db.session.commit() # The delivery and its queued message are saved together
+
+  if message_sid:
+    received_responses.set(message_sid, response)
+  return response
+
+
+async def receive_message_async(connection, message_sid, phone_number, body, response, queue=True, key=None):
+  """receive_message for the ASGI webhook (asgi.py), on an AsyncConnection in a transaction"""
+
+  if message_sid:
+    first_response = received_responses.get(message_sid)
+    if first_response is not MISSING:
+      return first_response
+
+    recorded = (await connection.execute(record_delivery(message_sid, response))).first()
+
+    # Twilio retried a delivery we already have
+    if not recorded:
+      await connection.rollback()
+      first_response = await connection.scalar(recorded_response(message_sid))
+      received_responses.set(message_sid, first_response)
+      return first_response
+
+  if queue:
+    await connection.execute(insert(InboundMessage).values(phone_number=phone_number, body=body, status=PENDING, lane=message_lane(phone_number, key)))
+  await connection.commit() # The delivery and its queued message are saved together
+
+  if message_sid:
+    received_responses.set(message_sid, response)
+  return response
+
+
+def record_delivery(message_sid, response):
+  """INSERT that records a delivery and returns its sid, or nothing if message_sid was already recorded"""
+
+  return insert(ReceivedMessage).values(sid=message_sid, response=response).on_conflict_do_nothing().returning(ReceivedMessage.sid)
+
+
+def recorded_response(message_sid):
+  """SELECT of the response recorded for a delivery"""
+
+  return select(ReceivedMessage.response).where(ReceivedMessage.sid == message_sid)
+
+
+def message_lane(phone_number, key=None):
+  """SQL for a message's lane, worked out in the INSERT so it costs no extra round trip
+
+  That's the playlist with the message's key, or else the sender's active playlist, or else
+  the phone number itself"""
+
+  guest_users = GuestUser.__table__
+  active_playlist_id = select(guest_users.c.active_playlist_id).where(guest_users.c.phone_number == phone_number).scalar_subquery()
+
+  if key:
+    playlist_id = select(Playlist.id).where(func.lower(Playlist.key) == key).scalar_subquery()
+    return func.coalesce(playlist_id, active_playlist_id, phone_number)
+
+  return func.coalesce(active_playlist_id, phone_number)
+
+
+
+def claim_message():
+  """Claim the oldest message that is ready to be processed and is first in its lane
+
+  Returns a row with the message's id, phone_number, body, attempts and tracks_done or None if the queue is empty"""
+
+  ready = or_(
+    and_(InboundMessage.status == PENDING, InboundMessage.run_at <= func.now()),
+    and_(InboundMessage.status == PROCESSING, InboundMessage.locked_at <= func.now() - timedelta(seconds=LOCK_TIMEOUT_SECONDS))
+  )
+  # An earlier message in the same lane or from the same phone is waiting, being processed or waiting to be retried
+  earlier = aliased(InboundMessage)
+  behind_another = exists().where(
+    earlier.id < InboundMessage.id,
+    earlier.status != DEAD,
+    or_(earlier.lane == InboundMessage.lane, earlier.phone_number == InboundMessage.phone_number)
+  )
+  next_id = select(InboundMessage.id) \
+    .where(ready, ~behind_another) \
+    .order_by(InboundMessage.id) \
+    .limit(1) \
+    .with_for_update(skip_locked=True) \
+    .scalar_subquery()
+
+  claimed = db.session.execute(
+    update(InboundMessage)
+      .where(InboundMessage.id == next_id)
+      .values(status=PROCESSING, locked_at=func.now(), attempts=InboundMessage.attempts + 1)
+      .returning(InboundMessage.id, InboundMessage.phone_number, InboundMessage.body, InboundMessage.attempts, InboundMessage.tracks_done)
+      .execution_options(synchronize_session=False)
+  ).first()
+  db.session.commit()
+  return claimed
+
+
+def extend_locks(message_ids):
+  """Keep the messages a worker is still processing from being reclaimed after LOCK_TIMEOUT_SECONDS
+
+  A message whose row its worker's transaction has locked can't be claimed anyway, and is
+  skipped rather than waited for"""
+
+  still_locked = select(InboundMessage.id) \
+    .where(InboundMessage.id.in_(message_ids), InboundMessage.status == PROCESSING) \
+    .with_for_update(skip_locked=True)
+
+  db.session.execute(
+    update(InboundMessage)
+      .where(InboundMessage.id.in_(still_locked.scalar_subquery()))
+      .values(locked_at=func.now())
+      .execution_options(synchronize_session=False)
+  )
+  db.session.commit()
+
+
+def record_progress(message_id, tracks_done):
+  """Save how many of a message's tracks have been added, so a retry starts after them. The caller commits
+
+  Called by add_tracks_to_playlist as it records each batch, so the count is committed with the batch"""
+
+  db.session.execute(update(InboundMessage).where(InboundMessage.id == message_id).values(tracks_done=tracks_done))
+
+
+def complete_message(message_id):
+  """Remove a processed message from the queue"""
+
+  InboundMessage.query.filter_by(id=message_id).delete()
+  db.session.commit()
+
+
+def fail_message(message_id, attempts, error):
+  """Schedule a failed message to be retried with exponential backoff, or dead-letter it"""
+
+  values = {"locked_at": None, "last_error": error}
+
+  if attempts >= MAX_ATTEMPTS:
+    values["status"] = DEAD
+  else:
+    values["status"] = PENDING
+    values["run_at"] = func.now() + timedelta(seconds=retry_delay(attempts))
+
+  db.session.execute(update(InboundMessage).where(InboundMessage.id == message_id).values(**values))
+  db.session.commit()
+
+
+def defer_message(message_id, delay):
+  """Put a message back in the queue for `delay` seconds without counting the attempt
+
+  Used when Spotify asked us to slow down, which says nothing about the message itself"""
+
+  db.session.execute(
+    update(InboundMessage)
+      .where(InboundMessage.id == message_id)
+      .values(
+        status=PENDING,
+        locked_at=None,
+        attempts=InboundMessage.attempts - 1,
+        run_at=func.now() + timedelta(seconds=delay)
+      )
+  )
+  db.session.commit()
+
+
+def retry_delay(attempts):
+  """Seconds to wait before retrying a message that has failed `attempts` times"""
+
+  delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1))
+  return delay * random.uniform(0.5, 1) # Jitter so messages that failed together don't retry together
+
+
+def purge_received_messages():
+  """Forget deliveries older than MESSAGE_SID_TTL_SECONDS, so received_messages stays small
+
+  Returns the number of rows deleted"""
+
+  deleted = db.session.execute(
+    ReceivedMessage.__table__.delete().where(ReceivedMessage.received_at < func.now() - timedelta(seconds=MESSAGE_SID_TTL_SECONDS))
+  ).rowcount
+  db.session.commit()
+  return deleted
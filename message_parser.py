@@ -0,0 +1,114 @@
+"""Find playlist keys and Spotify links in text messages"""
+
+import os
+import re
+from dataclasses import dataclass, field
+
+from cache import MISSING, TTLCache
+from spotify_client import spotify_client
+
+RESOLVE_SHORT_LINKS = os.environ.get('RESOLVE_SHORT_LINKS', 'true').lower() == 'true' # Follow spotify.link short links to find what they point to
+SHORT_LINK_CACHE_TTL_SECONDS = float(os.environ.get('SHORT_LINK_CACHE_TTL_SECONDS', 86400)) # Short links never change where they point
+
+# Everything we look for, matched in one pass over the message. Every Spotify link, uri and short
+# link has "poti" in it, so the scan only stops at a "p" or a "#" and the rest of each link is
+# checked around that; phones sometimes capitalize the first letter. One group per kind of id,
+# so findall hands back which kind each match is
+TOKEN_PATTERN = re.compile(r"""
+    poti(?:
+        (?:
+            (?<=[Oo]pen\.spoti)fy\.com/                       # Spotify link
+              (?:intl-[a-z]{2}(?:[-_][a-zA-Z]{2})?/)?          #   optional country path, e.g. intl-de/ or intl-pt_br/
+              (?:embed/)?
+          | (?<=[Ss]poti)fy:                                   # Spotify uri
+        )
+        (?:track[/:]([0-9A-Za-z]{22}) | album[/:]([0-9A-Za-z]{22}) | playlist[/:]([0-9A-Za-z]{22}))
+      | (?<=[Ss]poti)((?:fy\.link|\.fi)/[0-9A-Za-z_-]+)        # Short link from the share sheet, after "spoti"
+    )
+  | \#+(?<![^\s\#]\#)([\w@+-]+(?:\.[\w@+-]+)*)               # Playlist #key, at the start of a word. Not a trailing "."
+""", re.VERBOSE)
+
+short_links = TTLCache(ttl=SHORT_LINK_CACHE_TTL_SECONDS) # short link -> ParsedMessage of the url it redirects to
+
+
+@dataclass
+class ParsedMessage:
+  """The playlist keys and Spotify ids found in a message, in the order they appeared"""
+
+  keys: list = field(default_factory=list)
+  track_ids: list = field(default_factory=list)
+  album_ids: list = field(default_factory=list)
+  playlist_ids: list = field(default_factory=list)
+  short_links: list = field(default_factory=list) # Not resolved yet
+
+  def __bool__(self):
+    return bool(self.keys or self.track_ids or self.album_ids or self.playlist_ids or self.short_links)
+
+  @property
+  def key(self):
+    """The first playlist key, or None"""
+
+    return self.keys[0] if self.keys else None
+
+  def add_id(self, type, id):
+    ids = getattr(self, f"{type}_ids")
+    if id not in ids:
+      ids.append(id)
+
+  def extend(self, other):
+    """Add the keys and ids found in another message"""
+
+    for type in ('track', 'album', 'playlist'):
+      for id in getattr(other, f"{type}_ids"):
+        self.add_id(type, id)
+
+
+def parse_message(message):
+  """Find every playlist key, Spotify link and short link in a message"""
+
+  parsed = ParsedMessage()
+
+  for track_id, album_id, playlist_id, short_link, key in TOKEN_PATTERN.findall(message):
+    if track_id:
+      if track_id not in parsed.track_ids:
+        parsed.track_ids.append(track_id)
+    elif key:
+      parsed.keys.append(key.lower())
+    elif album_id:
+      if album_id not in parsed.album_ids:
+        parsed.album_ids.append(album_id)
+    elif playlist_id:
+      if playlist_id not in parsed.playlist_ids:
+        parsed.playlist_ids.append(playlist_id)
+    else:
+      parsed.short_links.append('https://spoti' + short_link)
+
+  return parsed
+
+
+def resolve_short_links(parsed):
+  """Add the Spotify ids the message's short links point to. Does nothing if RESOLVE_SHORT_LINKS is off"""
+
+  if not RESOLVE_SHORT_LINKS:
+    return parsed
+
+  for short_link in parsed.short_links:
+    parsed.extend(resolve_short_link(short_link))
+
+  parsed.short_links = []
+  return parsed
+
+
+def resolve_short_link(short_link):
+  """Follow a short link's redirects and parse where it lands. Results are cached"""
+
+  resolved = short_links.get(short_link)
+  if resolved is MISSING:
+    try:
+      response = spotify_client.request('HEAD', short_link, allow_redirects=True)
+      resolved = parse_message(response.url)
+    except Exception:
+      return ParsedMessage() # Try again next time
+    short_links.set(short_link, resolved)
+
+  return resolved
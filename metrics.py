@@ -0,0 +1,170 @@
+"""Prometheus metrics for the hot path
+
+Times every Flask request, Spotify API call, Twilio send and SQL statement, and serves them
+at /metrics in the Prometheus text format, along with the Spotify client's circuit breakers
+and rate limits and the lookup caches' hit rates.
+
+gunicorn runs several worker processes, so when PROMETHEUS_MULTIPROC_DIR is set (see
+gunicorn.conf.py) every process writes its samples there and /metrics adds them up across
+all of them. Without it, /metrics only reports the process that serves it. The circuit
+breakers, rate limits and caches are always read from the process that serves /metrics. The queue worker
+is a separate dyno; it serves its own metrics on WORKER_METRICS_PORT."""
+
+import os
+import re
+import time
+from urllib.parse import urlsplit
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import cache_stats
+from spotify_client import CircuitBreaker, spotify_client
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # Bearer token /metrics requires, open if not set
+
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time to handle a request', ['method', 'route', 'status'])
+SPOTIFY_CALL_SECONDS = Histogram('spotify_api_call_duration_seconds', 'Time for an authorized Spotify API call, including token refreshes and retries',
+                                 ['method', 'endpoint', 'outcome'])
+TWILIO_SEND_SECONDS = Histogram('twilio_send_duration_seconds', 'Time for one attempt at sending a text message', ['outcome'])
+SMS_MESSAGES_SHED = Counter('sms_messages_shed_total', 'Text messages dropped because the send queue stayed full')
+DB_QUERY_SECONDS = Histogram('db_query_duration_seconds', 'Time to execute a SQL statement', ['operation'],
+                             buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, float('inf')))
+DB_QUERY_ERRORS = Counter('db_query_errors_total', 'SQL statements that raised an error', ['operation'])
+
+ID_SEGMENT = re.compile(r'/(albums|artists|playlists|tracks|users)/[^/]+') # Collection followed by an id
+
+
+def endpoint_template(url):
+  """A Spotify url with its ids replaced, so calls to the same endpoint share a label
+
+  https://api.spotify.com/v1/playlists/37i9dQ/tracks -> /v1/playlists/{id}/tracks"""
+
+  return ID_SEGMENT.sub(r'/\1/{id}', urlsplit(url).path)
+
+
+class Timer:
+  """Context manager that observes how long its block took in a histogram
+
+  The labels can be changed inside the block, e.g. once the outcome is known"""
+
+  def __init__(self, histogram, **labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, traceback):
+    if exc_type and self.labels.get('outcome') is None:
+      self.labels['outcome'] = exc_type.__name__
+    self.histogram.labels(**self.labels).observe(time.perf_counter() - self.start)
+
+
+class StateCollector:
+  """Reports SpotifyClient.state() and cache_stats() as they are when /metrics is scraped"""
+
+  def collect(self):
+    state = spotify_client.state()
+
+    breaker_state = GaugeMetricFamily('spotify_circuit_breaker_state', '1 for the state each host\'s circuit breaker is in', labels=['host', 'state'])
+    breaker_failures = GaugeMetricFamily('spotify_circuit_breaker_failures', 'Failed requests in a row to each host', labels=['host'])
+    for host, breaker in state['breakers'].items():
+      for name in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+        breaker_state.add_metric([host, name], int(breaker['state'] == name))
+      breaker_failures.add_metric([host], breaker['failures'])
+    yield breaker_state
+    yield breaker_failures
+
+    yield GaugeMetricFamily('spotify_rate_limit_tokens', 'Tokens left in the app wide rate limit bucket', value=state['app_bucket']['tokens'])
+    yield GaugeMetricFamily('spotify_rate_limit_paused_seconds', 'How much longer a Retry-After holds every request', value=state['app_bucket']['paused_for'])
+    yield GaugeMetricFamily('spotify_rate_limited_users', 'Host users whose requests are held by a Retry-After', value=state['rate_limited_users'])
+
+    hits = CounterMetricFamily('cache_hits', 'Lookups answered by the cache', labels=['cache'])
+    misses = CounterMetricFamily('cache_misses', 'Lookups that went to the database', labels=['cache'])
+    entries = GaugeMetricFamily('cache_entries', 'Entries in the cache', labels=['cache'])
+    for name, stats in cache_stats().items():
+      hits.add_metric([name], stats['hits'])
+      misses.add_metric([name], stats['misses'])
+      entries.add_metric([name], stats['size'])
+    yield hits
+    yield misses
+    yield entries
+
+
+REGISTRY.register(StateCollector())
+
+
+# -------------------------- SQL ---------------------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def observe_query(conn, cursor, statement, parameters, context, executemany):
+  start = conn.info['query_start_times'].pop()
+  DB_QUERY_SECONDS.labels(operation=statement_operation(statement)).observe(time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'handle_error')
+def count_query_error(context):
+  start_times = context.connection.info.get('query_start_times') if context.connection is not None else None
+  if start_times:
+    start_times.pop()
+  DB_QUERY_ERRORS.labels(operation=statement_operation(context.statement or '')).inc()
+
+
+def statement_operation(statement):
+  """SELECT, INSERT, UPDATE, ... from a SQL statement"""
+
+  words = statement.lstrip().split(None, 1)
+  return words[0].upper() if words else 'UNKNOWN'
+
+
+# -------------------------- FLASK ---------------------------
+
+def init_app(app):
+  """Time every request to app and add the /metrics route"""
+
+  @app.before_request
+  def start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+  @app.after_request
+  def observe_request(response):
+    if 'request_start_time' in g:
+      route = request.url_rule.rule if request.url_rule else 'unmatched' # The template, not the url, to keep the labels bounded
+      HTTP_REQUEST_SECONDS.labels(method=request.method, route=route, status=response.status_code).observe(time.perf_counter() - g.request_start_time)
+    return response
+
+  @app.route('/metrics')
+  def serve_metrics():
+    """Metrics for Prometheus to scrape"""
+
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+      return Response(status=401)
+
+    return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def registry():
+  """The registry to export: every process's samples in multiprocess mode, else this process's"""
+
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(StateCollector())
+    return registry
+
+  return REGISTRY
+
+
+def start_metrics_server(port):
+  """Serve /metrics on its own port, for processes that aren't the web app"""
+
+  start_http_server(port, registry=registry())
@@ -0,0 +1,28 @@
+"""inbound message progress
+
+Counts the tracks each queued message has already added, so a message retried after a
+failure part way through doesn't add them again to a playlist that allows duplicates. The
+default isn't volatile, so Postgres adds the column without rewriting the table.
+
+Revision ID: 1e8c5a3f9b24
+Revises: 7d41c2e9a8f5
+Create Date: 2026-10-20 10:14:52.183077
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e8c5a3f9b24'
+down_revision = '7d41c2e9a8f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('inbound_messages', sa.Column('tracks_done', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('inbound_messages', 'tracks_done')
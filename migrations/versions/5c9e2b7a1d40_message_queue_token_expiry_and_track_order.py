@@ -0,0 +1,50 @@
+"""message queue, token expiry and track order
+
+Revision ID: 5c9e2b7a1d40
+Revises: a3f1c07d52e8
+Create Date: 2026-10-18 14:31:47.504391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c9e2b7a1d40'
+down_revision = 'a3f1c07d52e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('inbound_messages',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('phone_number', sa.Text(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('run_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('locked_at', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_inbound_messages_status_run_at', 'inbound_messages', ['status', 'run_at'], unique=False)
+
+    op.add_column('host_users', sa.Column('token_expires_at', sa.DateTime(), nullable=True))
+
+    # Existing rows are numbered in whatever order Postgres reads them
+    op.execute(sa.schema.CreateSequence(sa.Sequence('playlist_tracks_seq_seq')))
+    op.add_column('playlist_tracks', sa.Column('seq', sa.BigInteger(), server_default=sa.text("nextval('playlist_tracks_seq_seq')"), nullable=False))
+    op.add_column('playlist_tracks', sa.Column('added_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False))
+    op.create_index('ix_playlist_tracks_playlist_id_seq', 'playlist_tracks', ['playlist_id', 'seq'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_playlist_tracks_playlist_id_seq', table_name='playlist_tracks')
+    op.drop_column('playlist_tracks', 'added_at')
+    op.drop_column('playlist_tracks', 'seq')
+    op.execute(sa.schema.DropSequence(sa.Sequence('playlist_tracks_seq_seq')))
+    op.drop_column('host_users', 'token_expires_at')
+    op.drop_index('ix_inbound_messages_status_run_at', table_name='inbound_messages')
+    op.drop_table('inbound_messages')
@@ -0,0 +1,32 @@
+"""pending adds retries
+
+Counts the failed flushes of each pending track and when it can next be flushed, so a
+playlist that keeps failing backs off and is dead-lettered like a message in the queue.
+The defaults aren't volatile, so Postgres adds the columns without rewriting the table.
+
+Revision ID: 7d41c2e9a8f5
+Revises: b3d5f8a19e62
+Create Date: 2026-10-19 09:02:17.406518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d41c2e9a8f5'
+down_revision = 'b3d5f8a19e62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('pending_adds', sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('pending_adds', sa.Column('run_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False))
+    op.add_column('pending_adds', sa.Column('last_error', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('pending_adds', 'last_error')
+    op.drop_column('pending_adds', 'run_at')
+    op.drop_column('pending_adds', 'attempts')
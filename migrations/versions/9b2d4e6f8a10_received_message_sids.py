@@ -0,0 +1,34 @@
+"""received message sids
+
+Remembers the MessageSid of every delivery from Twilio so retried webhooks aren't handled
+twice. Rows older than MESSAGE_SID_TTL_SECONDS are purged by the worker.
+
+Revision ID: 9b2d4e6f8a10
+Revises: e71b4d09c3a6
+Create Date: 2026-10-18 16:02:47.215390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2d4e6f8a10'
+down_revision = 'e71b4d09c3a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('received_messages',
+    sa.Column('sid', sa.String(length=64), nullable=False),
+    sa.Column('response', sa.Text(), nullable=False),
+    sa.Column('received_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('sid')
+    )
+    op.create_index(op.f('ix_received_messages_received_at'), 'received_messages', ['received_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_received_messages_received_at'), table_name='received_messages')
+    op.drop_table('received_messages')
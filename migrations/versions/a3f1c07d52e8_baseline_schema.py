@@ -0,0 +1,75 @@
+"""baseline schema
+
+The tables as they were when the app created them with db.create_all(). Databases that
+were created that way already have them: run `flask db stamp a3f1c07d52e8` once, then
+`flask db upgrade`.
+
+Revision ID: a3f1c07d52e8
+Revises: 
+Create Date: 2026-10-18 14:30:02.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c07d52e8'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('guest_users',
+    sa.Column('id', sa.Text(), nullable=False),
+    sa.Column('phone_number', sa.Text(), nullable=True),
+    sa.Column('active_playlist_id', sa.Text(), nullable=True),
+    sa.Column('user_type', sa.String(length=32), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('phone_number')
+    )
+    op.create_table('tracks',
+    sa.Column('id', sa.Text(), nullable=False),
+    sa.Column('name', sa.Text(), nullable=False),
+    sa.Column('artist', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('host_users',
+    sa.Column('id', sa.Text(), nullable=False),
+    sa.Column('display_name', sa.Text(), nullable=False),
+    sa.Column('email', sa.Text(), nullable=False),
+    sa.Column('url', sa.Text(), nullable=False),
+    sa.Column('access_token', sa.Text(), nullable=True),
+    sa.Column('refresh_token', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['id'], ['guest_users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email')
+    )
+    op.create_table('playlists',
+    sa.Column('id', sa.Text(), nullable=False),
+    sa.Column('title', sa.Text(), nullable=False),
+    sa.Column('key', sa.Text(), nullable=False),
+    sa.Column('url', sa.Text(), nullable=False),
+    sa.Column('endpoint', sa.Text(), nullable=False),
+    sa.Column('owner_id', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['owner_id'], ['host_users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('key')
+    )
+    op.create_table('playlist_tracks',
+    sa.Column('playlist_id', sa.Text(), nullable=False),
+    sa.Column('track_id', sa.Text(), nullable=False),
+    sa.Column('added_by', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['playlist_id'], ['playlists.id'], ),
+    sa.ForeignKeyConstraint(['track_id'], ['tracks.id'], ),
+    sa.PrimaryKeyConstraint('playlist_id', 'track_id')
+    )
+
+
+def downgrade():
+    op.drop_table('playlist_tracks')
+    op.drop_table('playlists')
+    op.drop_table('host_users')
+    op.drop_table('tracks')
+    op.drop_table('guest_users')
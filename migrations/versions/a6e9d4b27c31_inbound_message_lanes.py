@@ -0,0 +1,38 @@
+"""inbound message lanes
+
+Messages headed for the same playlist, or sent from the same phone, are processed one at a
+time in the order they arrived. The lane column holds the playlist, and the indexes let a
+worker check for earlier unfinished messages. They are built CONCURRENTLY so the webhook
+can keep queueing messages meanwhile.
+
+Revision ID: a6e9d4b27c31
+Revises: f2b7c9e04d13
+Create Date: 2026-10-18 21:05:12.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e9d4b27c31'
+down_revision = 'f2b7c9e04d13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('inbound_messages', sa.Column('lane', sa.Text(), nullable=True))
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_inbound_messages_lane_id', 'inbound_messages', ['lane', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_inbound_messages_phone_number_id', 'inbound_messages', ['phone_number', 'id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_inbound_messages_phone_number_id', table_name='inbound_messages', postgresql_concurrently=True)
+        op.drop_index('ix_inbound_messages_lane_id', table_name='inbound_messages', postgresql_concurrently=True)
+
+    op.drop_column('inbound_messages', 'lane')
@@ -0,0 +1,30 @@
+"""playlist snapshot sync
+
+Remembers each playlist's Spotify snapshot_id and when it was last synced, so unchanged
+playlists are skipped with one request. Both columns are nullable, so Postgres adds them
+without rewriting the table.
+
+Revision ID: b3d5f8a19e62
+Revises: a6e9d4b27c31
+Create Date: 2026-10-18 22:14:50.731264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d5f8a19e62'
+down_revision = 'a6e9d4b27c31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('playlists', sa.Column('snapshot_id', sa.Text(), nullable=True))
+    op.add_column('playlists', sa.Column('synced_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('playlists', 'synced_at')
+    op.drop_column('playlists', 'snapshot_id')
@@ -0,0 +1,27 @@
+"""playlist allow duplicates
+
+Lets a host choose to add songs that are already on their playlist again. The constant
+default means Postgres adds the column without rewriting the table.
+
+Revision ID: c4a81f2e6b93
+Revises: 9b2d4e6f8a10
+Create Date: 2026-10-18 17:20:05.604112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a81f2e6b93'
+down_revision = '9b2d4e6f8a10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('playlists', sa.Column('allow_duplicates', sa.Boolean(), server_default=sa.text('false'), nullable=False))
+
+
+def downgrade():
+    op.drop_column('playlists', 'allow_duplicates')
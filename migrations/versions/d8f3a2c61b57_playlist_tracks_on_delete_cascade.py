@@ -0,0 +1,34 @@
+"""playlist tracks on delete cascade
+
+Deleting a playlist deletes its playlist_tracks rows in Postgres, instead of the ORM loading
+them first. The new constraint is added NOT VALID, which only holds the table's lock for a
+moment, and committed. It's then validated in a transaction of its own, which checks the
+existing rows without blocking writes to playlist_tracks.
+
+Revision ID: d8f3a2c61b57
+Revises: c4a81f2e6b93
+Create Date: 2026-10-18 19:02:41.377215
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8f3a2c61b57'
+down_revision = 'c4a81f2e6b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('playlist_tracks_playlist_id_fkey', 'playlist_tracks', type_='foreignkey')
+    op.create_foreign_key('playlist_tracks_playlist_id_fkey', 'playlist_tracks', 'playlists', ['playlist_id'], ['id'],
+                          ondelete='CASCADE', postgresql_not_valid=True)
+    # Commits the drop and add first, so their ACCESS EXCLUSIVE lock isn't held while every row is checked
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE playlist_tracks VALIDATE CONSTRAINT playlist_tracks_playlist_id_fkey')
+
+
+def downgrade():
+    op.drop_constraint('playlist_tracks_playlist_id_fkey', 'playlist_tracks', type_='foreignkey')
+    op.create_foreign_key('playlist_tracks_playlist_id_fkey', 'playlist_tracks', 'playlists', ['playlist_id'], ['id'])
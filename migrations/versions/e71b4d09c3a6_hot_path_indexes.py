@@ -0,0 +1,36 @@
+"""hot path indexes
+
+Indexes for the lookups the webhook and UI make on every request. They are built
+CONCURRENTLY so the tables stay writable while the indexes are created.
+
+Revision ID: e71b4d09c3a6
+Revises: 5c9e2b7a1d40
+Create Date: 2026-10-18 14:33:12.863150
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e71b4d09c3a6'
+down_revision = '5c9e2b7a1d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_guest_users_active_playlist_id', 'guest_users', ['active_playlist_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_playlist_tracks_track_id', 'playlist_tracks', ['track_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_playlists_owner_id', 'playlists', ['owner_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_playlists_lower_key', 'playlists', [sa.text('lower(key)')], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_playlists_lower_key', table_name='playlists', postgresql_concurrently=True)
+        op.drop_index('ix_playlists_owner_id', table_name='playlists', postgresql_concurrently=True)
+        op.drop_index('ix_playlist_tracks_track_id', table_name='playlist_tracks', postgresql_concurrently=True)
+        op.drop_index('ix_guest_users_active_playlist_id', table_name='guest_users', postgresql_concurrently=True)
@@ -0,0 +1,37 @@
+"""pending adds
+
+Buffer of tracks waiting to be added to a playlist, so a burst of links can be added to
+Spotify in one request when COALESCE_WINDOW_SECONDS is set.
+
+Revision ID: f2b7c9e04d13
+Revises: d8f3a2c61b57
+Create Date: 2026-10-18 20:11:36.518042
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b7c9e04d13'
+down_revision = 'd8f3a2c61b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pending_adds',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('playlist_id', sa.Text(), nullable=False),
+    sa.Column('track_id', sa.Text(), nullable=False),
+    sa.Column('added_by', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['playlist_id'], ['playlists.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_pending_adds_playlist_id_id', 'pending_adds', ['playlist_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_pending_adds_playlist_id_id', table_name='pending_adds')
+    op.drop_table('pending_adds')
@@ -7,7 +7,6 @@ db = SQLAlchemy() # Create database object
 def connect_db(app):
   """Connect database to the Flask app"""
 
-  db.app = app # Connect database to Flask object
   db.init_app(app) # Initialize database
 
 class GuestUser(db.Model):
@@ -17,12 +16,14 @@ class GuestUser(db.Model):
 
   id = db.Column(db.Text, primary_key=True)
   phone_number = db.Column(db.Text, unique=True)
-  active_playlist_id = db.Column(db.Text)
+  active_playlist_id = db.Column(db.Text, index=True)
   user_type = db.Column(db.String(32), nullable=False)
 
-  @property
-  def active_playlist(self):
-    return Playlist.query.filter_by(id=self.active_playlist_id).first()
+  active_playlist = db.relationship( # No foreign key, deleting a playlist clears it (see ui_routes.delete_playlist)
+    'Playlist',
+    primaryjoin='foreign(GuestUser.active_playlist_id) == Playlist.id',
+    viewonly=True
+  )
 
   __mapper_args__ = {
     "polymorphic_identity": "guest_users",
@@ -41,6 +42,7 @@ class HostUser(GuestUser):
   url = db.Column(db.Text, nullable=False)
   access_token = db.Column(db.Text)
   refresh_token = db.Column(db.Text)
+  token_expires_at = db.Column(db.DateTime) # When the access token expires (UTC)
 
   playlists = db.relationship('Playlist', backref='owner', cascade='all, delete-orphan')
 
@@ -63,24 +65,40 @@ class Playlist(db.Model):
   key = db.Column(db.Text, unique=True, nullable=False)
   url = db.Column(db.Text, nullable=False)
   endpoint = db.Column(db.Text, nullable=False)
+  allow_duplicates = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false()) # Add songs that are already on the playlist again
+  snapshot_id = db.Column(db.Text) # Spotify's version of the playlist when it was last synced (see sync.py)
+  synced_at = db.Column(db.DateTime) # When a sync last started, None if it's never been synced or a sync was asked for
 
-  owner_id = db.Column(db.Text, db.ForeignKey('host_users.id'), nullable=False)
+  owner_id = db.Column(db.Text, db.ForeignKey('host_users.id'), nullable=False, index=True)
   
   tracks = db.relationship(
     'Track',
     secondary="playlist_tracks",
-    cascade="all, delete",
+    passive_deletes=True, # Postgres deletes the playlist_tracks rows, the tracks may be on other playlists
     backref="playlists"
   )
 
+
+db.Index('ix_playlists_lower_key', db.func.lower(Playlist.key)) # Keys are looked up lowercased
+
+
 class PlaylistTrack(db.Model):
   """A track in a playlist that was added by someone with a text message"""
 
   __tablename__ = "playlist_tracks"
 
-  playlist_id = db.Column(db.Text, db.ForeignKey('playlists.id'), primary_key=True)
-  track_id = db.Column(db.Text, db.ForeignKey('tracks.id'), primary_key=True)
+  playlist_id = db.Column(db.Text, db.ForeignKey('playlists.id', ondelete='CASCADE'), primary_key=True)
+  track_id = db.Column(db.Text, db.ForeignKey('tracks.id'), primary_key=True, index=True)
   added_by = db.Column(db.Text)
+  seq = db.Column( # Insertion order, used to page through a playlist
+    db.BigInteger,
+    db.Sequence('playlist_tracks_seq_seq'),
+    server_default=db.text("nextval('playlist_tracks_seq_seq')"),
+    nullable=False
+  )
+  added_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+  __table_args__ = (db.Index('ix_playlist_tracks_playlist_id_seq', 'playlist_id', 'seq'),)
 
 
 class Track(db.Model):
@@ -91,9 +109,60 @@ class Track(db.Model):
   id = db.Column(db.Text, primary_key=True)
   name = db.Column(db.Text, nullable=False)
   artist = db.Column(db.Text, nullable=False)
-  
-  # @property
-  def added_by(self, playlist):
-    playlist_track = PlaylistTrack.query.filter_by(track_id=self.id,playlist_id=playlist.id).first()
-    if playlist_track:
-      return playlist_track.added_by
+
+
+class InboundMessage(db.Model):
+  """A text message received from Twilio, waiting in the queue to be processed by a worker"""
+
+  __tablename__ = 'inbound_messages'
+
+  id = db.Column(db.BigInteger, primary_key=True)
+  phone_number = db.Column(db.Text, nullable=False)
+  body = db.Column(db.Text, nullable=False)
+  lane = db.Column(db.Text) # Playlist the message is headed for, or the phone number. Processed in order within a lane (see jobs.py)
+  status = db.Column(db.String(16), nullable=False, default='pending') # pending, processing or dead
+  attempts = db.Column(db.Integer, nullable=False, default=0)
+  run_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now()) # Don't process before this time
+  locked_at = db.Column(db.DateTime) # When a worker claimed the message
+  tracks_done = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Tracks added by earlier attempts, skipped by a retry (see add_tracks_to_playlist)
+  last_error = db.Column(db.Text)
+  created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+  __table_args__ = (
+    db.Index('ix_inbound_messages_status_run_at', 'status', 'run_at'),
+    db.Index('ix_inbound_messages_lane_id', 'lane', 'id'),
+    db.Index('ix_inbound_messages_phone_number_id', 'phone_number', 'id'),
+  )
+
+
+class ReceivedMessage(db.Model):
+  """The MessageSid of a text message Twilio delivered and the TwiML we answered with
+
+  Twilio retries the webhook when it times out, so a retried delivery is answered from here
+  instead of being handled again. Rows are purged after MESSAGE_SID_TTL_SECONDS"""
+
+  __tablename__ = 'received_messages'
+
+  sid = db.Column(db.String(64), primary_key=True) # Twilio's MessageSid
+  response = db.Column(db.Text, nullable=False)
+  received_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now(), index=True)
+
+
+class PendingAdd(db.Model):
+  """A track waiting to be added to a playlist, when adds are coalesced (see coalesce.py)
+
+  The id orders the tracks by arrival. Rows are deleted once their batch is added to Spotify,
+  and kept for inspection once flushing them has failed MAX_ATTEMPTS times"""
+
+  __tablename__ = 'pending_adds'
+
+  id = db.Column(db.BigInteger, primary_key=True)
+  playlist_id = db.Column(db.Text, db.ForeignKey('playlists.id', ondelete='CASCADE'), nullable=False)
+  track_id = db.Column(db.Text, nullable=False)
+  added_by = db.Column(db.Text)
+  created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+  attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Failed flushes
+  run_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now()) # Not flushed before, to back off after a failure
+  last_error = db.Column(db.Text)
+
+  __table_args__ = (db.Index('ix_pending_adds_playlist_id_id', 'playlist_id', 'id'),)
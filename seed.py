@@ -1,7 +1,9 @@
 """Seed file to make sample data for spotify_group_chat db"""
 
+from app import create_app
 from models import db
-# Create all tables
 
-db.drop_all()
-db.create_all()
\ No newline at end of file
+# Create all tables
+with create_app().app_context():
+  db.drop_all()
+  db.create_all()
\ No newline at end of file
@@ -1,61 +1,226 @@
 """Functions to send messages to users"""
 
+import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from requests.exceptions import ConnectionError, Timeout
+from twilio.base.exceptions import TwilioRestException
 from twilio.rest import Client
 
+from metrics import SMS_MESSAGES_SHED, TWILIO_SEND_SECONDS, Timer
+
 TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
 MY_TWILIO_NUMBER = os.environ.get('MY_TWILIO_NUMBER')
 MY_PHONE_NUMBER = os.environ.get('MY_PHONE_NUMBER')
+TWILIO_API_URL = os.environ.get('TWILIO_API_URL') # Overridden to point at a fake Twilio for load tests
+
+SMS_SEND_CONCURRENCY = int(os.environ.get('SMS_SEND_CONCURRENCY', 4)) # Messages being sent at the same time
+SMS_MESSAGES_PER_SECOND = float(os.environ.get('SMS_MESSAGES_PER_SECOND', 1)) # Twilio queues anything faster than 1/s on a long code
+SMS_MAX_RETRIES = int(os.environ.get('SMS_MAX_RETRIES', 3)) # Retries after a transient Twilio error
+SMS_MAX_QUEUED = int(os.environ.get('SMS_MAX_QUEUED', 1000)) # Messages waiting for a sending thread before send() blocks
+SMS_QUEUE_WAIT_SECONDS = float(os.environ.get('SMS_QUEUE_WAIT_SECONDS', 30)) # How long send() blocks for room in the queue before dropping the message
+
+client = None # Twilio Client, created on first use by twilio_client()
+client_lock = threading.Lock()
+held = threading.local() # Messages hold_messages is holding back on each thread
+logger = logging.getLogger(__name__)
+
+
+def twilio_client():
+  """The Twilio Client, created the first time a message is sent so importing this module stays cheap"""
+
+  global client
+
+  with client_lock:
+    if client is None:
+      client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+      if TWILIO_API_URL:
+        client.api.base_url = TWILIO_API_URL
+    return client
+
+
+class SmsDispatcher:
+  """Sends text messages in the background on a bounded thread pool
+
+  Sends are spaced out to stay under messages_per_second and retried with backoff when
+  Twilio is rate limiting or having problems. Call flush() to wait for everything sent so far.
+
+  At most max_queued messages wait for a thread. Past that send() blocks the caller for up to
+  queue_wait seconds, so a burst slows down whoever is sending, and then drops the message."""
+
+  def __init__(self, max_workers=SMS_SEND_CONCURRENCY, messages_per_second=SMS_MESSAGES_PER_SECOND, max_retries=SMS_MAX_RETRIES,
+               max_queued=SMS_MAX_QUEUED, queue_wait=SMS_QUEUE_WAIT_SECONDS):
+    self.max_workers = max_workers
+    self.interval = 1 / messages_per_second if messages_per_second > 0 else 0 # Seconds between sends
+    self.max_retries = max_retries
+    self.executor = None # Created on first send, so forked processes get their own threads
+    self.pending = set() # Futures of messages that haven't been sent yet
+    self.lock = threading.Lock()
+    self.next_send_at = 0 # time.monotonic() of the next free send slot
+    self.queue_wait = queue_wait
+    self.room = threading.BoundedSemaphore(max_workers + max_queued) # Taken by every message being sent or waiting to be
+
+  def send(self, to, body):
+    """Queue a message to be sent. Returns a Future for the Twilio message, or None if the queue stayed full"""
+
+    if not self.room.acquire(timeout=self.queue_wait):
+      SMS_MESSAGES_SHED.inc()
+      logger.warning('Dropped message to %s, %s messages are already waiting to be sent', to, len(self.pending))
+      return None
+
+    with self.lock:
+      if not self.executor:
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sms')
+      future = self.executor.submit(self.deliver, to, body)
+      self.pending.add(future)
+
+    future.add_done_callback(self.sent)
+    return future
+
+  def sent(self, future):
+    """Make room in the queue once a message has been sent or given up on"""
+
+    self.pending.discard(future)
+    self.room.release()
+
+  def flush(self, timeout=None):
+    """Wait until every queued message has been sent or given up on. Returns True if none are left"""
+
+    not_done = wait(list(self.pending), timeout=timeout).not_done
+    return not not_done
+
+  def deliver(self, to, body):
+    """Send a message, retrying transient errors"""
+
+    for attempt in range(self.max_retries + 1):
+      self.wait_for_send_slot()
+      try:
+        with Timer(TWILIO_SEND_SECONDS, outcome=None) as timer: # The error's name if create raises
+          message = twilio_client().messages.create(body=body, from_=MY_TWILIO_NUMBER, to=to)
+          timer.labels['outcome'] = 'sent'
+        return message
+      except (TwilioRestException, ConnectionError, Timeout) as error:
+        if attempt == self.max_retries or not is_transient(error):
+          logger.exception('Could not send message to %s', to)
+          raise
+        time.sleep(2 ** attempt * random.uniform(0.5, 1)) # Back off before trying again
+
+  def wait_for_send_slot(self):
+    """Block until sending another message stays under the messages per second cap"""
 
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    with self.lock:
+      now = time.monotonic()
+      send_at = max(now, self.next_send_at)
+      self.next_send_at = send_at + self.interval
+
+    if send_at > now:
+      time.sleep(send_at - now)
+
+
+def is_transient(error):
+  """Check if a failed send is worth retrying"""
+
+  if isinstance(error, TwilioRestException):
+    return error.status == 429 or error.status >= 500 # Rate limited or a Twilio server error
+
+  return True # Connection problems
+
+
+dispatcher = SmsDispatcher()
+
+def send_message(phone_number, body):
+  """Send a text message from our Twilio number through the dispatcher
+
+  Inside hold_messages the message is held back instead, and None is returned"""
+
+  if getattr(held, 'messages', None) is not None:
+    held.messages.append((phone_number, body))
+    return None
+
+  return dispatcher.send(to=phone_number, body=body)
+
+@contextmanager
+def hold_messages():
+  """Hold back the messages sent on this thread inside the block, so they can be sent once the
+  changes they tell people about are committed. Yields the list of (phone_number, body) held"""
+
+  held.messages = []
+  try:
+    yield held.messages
+  finally:
+    held.messages = None
+
+def send_held(messages):
+  """Send the messages hold_messages held back"""
+
+  for phone_number, body in messages:
+    send_message(phone_number, body)
 
 def ask_for_playlist_key(phone_number):
   """Send a message to a user asking for a playlist #password"""
 
-  client.messages \
-    .create(
-      body="Which playlist do you want to add songs to? Ask the playlist's owner for the #password.",
-      from_= MY_TWILIO_NUMBER,
-      to= phone_number
-    )
+  send_message(
+    phone_number,
+    body="Which playlist do you want to add songs to? Ask the playlist's owner for the #password."
+  )
 
 def invalid_playlist_key_notification(phone_number, key):
   """Send a message to a user to notify them thier #key was invlaid"""
 
-  client.messages \
-    .create(
-      body=f"Sorry, I couldn't find a playlist with a #password of #{key}",
-      from_= MY_TWILIO_NUMBER,
-      to= phone_number
-    )
+  send_message(
+    phone_number,
+    body=f"Sorry, I couldn't find a playlist with a #password of #{key}"
+  )
 
 def playlist_key_success_notification(phone_number, playlist):
   """Send a message to a user to notify them thier #password was invlaid"""
 
-  client.messages \
-    .create(
-      body=f"Success! Spotify links received from you will be added to {playlist.title} #{playlist.key} {playlist.url}",
-      from_= MY_TWILIO_NUMBER,
-      to= phone_number
-    )
+  send_message(
+    phone_number,
+    body=f"Success! Spotify links received from you will be added to {playlist.title} #{playlist.key} {playlist.url}"
+  )
+
+def track_limit_notification(phone_number, limit):
+  """Send a message to a user telling them only some of the songs they sent were added"""
+
+  send_message(
+    phone_number,
+    body=f"That's a lot of songs! Only the first {limit} were added."
+  )
+
+def tracks_added_notification(phone_number, playlist, added, on_playlist=0, failed=0):
+  """Send a message to a user summing up the songs they sent that were just added together"""
+
+  body = f"Added {added} song{'' if added == 1 else 's'} to {playlist.title} #{playlist.key}."
+  if on_playlist:
+    body += f" {on_playlist} {'was' if on_playlist == 1 else 'were'} already on it."
+  if failed:
+    body += f" {failed} couldn't be added."
+
+  send_message(phone_number, body=body)
+
+def tracks_failed_notification(phone_number, playlist, failed):
+  """Send a message to a user whose songs we gave up trying to add"""
+
+  send_message(phone_number, body=f"Sorry, {failed} song{'' if failed == 1 else 's'} you sent couldn't be added to {playlist.title} #{playlist.key}.")
 
 def key_instructions_notification(phone_number, playlist):
   """Send a message to a user telling them how to add other people"""
 
-  client.messages \
-    .create(
-      body=f"Tell your friends to text #{playlist.key} to {MY_TWILIO_NUMBER} and Spotify links recieved from them will be added to your playlist",
-      from_= MY_TWILIO_NUMBER,
-      to= phone_number
-    )
+  send_message(
+    phone_number,
+    body=f"Tell your friends to text #{playlist.key} to {MY_TWILIO_NUMBER} and Spotify links recieved from them will be added to your playlist"
+  )
 
 def send_request_access_message(email):
   """Send a message to a user telling them how to add other people"""
 
-  client.messages \
-    .create(
-      body=f"{email} has requested access to spotify text message playlists",
-      from_= MY_TWILIO_NUMBER,
-      to= MY_PHONE_NUMBER
-    )
\ No newline at end of file
+  send_message(
+    MY_PHONE_NUMBER,
+    body=f"{email} has requested access to spotify text message playlists"
+  )
@@ -2,11 +2,20 @@
 
 import os
 import json
-import requests
-import re
 from urllib.parse import urlencode
 import base64
-
+import threading
+from itertools import chain, islice
+from datetime import datetime, timedelta
+from requests.exceptions import ConnectionError, Timeout
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.attributes import set_committed_value
+
+from cache import get_guest_user_by_phone, invalidate_guest_user
+from message_parser import parse_message
+from metrics import SPOTIFY_CALL_SECONDS, Timer, endpoint_template
+from spotify_client import SPOTIFY_SERVER_ERROR_RETRY_SECONDS, SpotifyServerError, spotify_client
 from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
 from sms import key_instructions_notification, playlist_key_success_notification
 
@@ -19,12 +28,41 @@ REDIRECT_URI = os.environ.get('REDIRECT_URI','http://localhost:5000/auth/login')
 CLIENT_INFO_BASE64_ENCODED = base64.b64encode((f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}").encode()) 
 SPOTIFY_CLIENT_HEADER = {"Authorization": f"Basic {CLIENT_INFO_BASE64_ENCODED.decode()}"}
 
-SPOTIFY_AUTH_BASE_URL = 'https://accounts.spotify.com'
+SPOTIFY_AUTH_BASE_URL = os.environ.get('SPOTIFY_AUTH_BASE_URL', 'https://accounts.spotify.com') # Overridden to point at a fake Spotify for load tests
 SPOTIFY_AUTH_URL= SPOTIFY_AUTH_BASE_URL + '/authorize/'
 SPOTIFY_TOKEN_URL = SPOTIFY_AUTH_BASE_URL + '/api/token'
 
-SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get('TOKEN_REFRESH_MARGIN_SECONDS', 60)) # Refresh access tokens this long before they expire
+
+REFRESH_LOCK_STRIPES = int(os.environ.get('REFRESH_LOCK_STRIPES', 64)) # Locks shared out among host users for token refreshes
+
+refresh_locks = [threading.Lock() for i in range(REFRESH_LOCK_STRIPES)] # Held while refreshing the access tokens of the users hashed to each
+
+
+class SpotifyAuthError(Exception):
+  """Spotify rejected our request for an access token"""
+
+
+class SpotifyPageError(Exception):
+  """Spotify wouldn't return a page that was required"""
+
+
+MAX_TRACKS_PER_ADD = 100 # Spotify accepts at most 100 uris per "add items to playlist" request
+
+TRACKS_PER_LOOKUP = 50 # Spotify returns at most 50 tracks per "get several tracks" request
+
+ALBUM_TRACKS_PER_PAGE = 50 # Most tracks Spotify returns per page of an album
+PLAYLIST_TRACKS_PER_PAGE = 100 # Most tracks Spotify returns per page of a playlist
+
+MAX_TRACKS_PER_MESSAGE = int(os.environ.get('MAX_TRACKS_PER_MESSAGE', 1000)) # Most tracks one text can add, counting linked albums and playlists
+
+PLAYLIST_LOCK_NAMESPACE = 1 # First key of the advisory locks taken by lock_playlist
 
+TRACK_ADDED = 'added' # Outcomes reported by add_tracks_to_playlist
+TRACK_FAILED = 'failed'
+TRACK_ON_PLAYLIST = 'on_playlist' # Skipped because it was already added
 
 SCOPE = 'user-read-email playlist-modify-public playlist-modify-private' # Scope of authorization
 
@@ -60,7 +98,7 @@ def get_auth_tokens(code):
   }
 
   # Pass authorization code and client secret key to the Spotify Accounts Service
-  auth_response = requests.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER , data=data)
+  auth_response = spotify_client.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER , data=data)
 
   # Tokens returned 
   # if spotify gave us a sccessful status code
@@ -70,41 +108,111 @@ def get_auth_tokens(code):
   return None
 
 
-def refresh_access_token(user):
-  """Get a new access token when the old access token is expired"""
+def refresh_access_token(user, force=False):
+  """Get a new access token when the old access token is expired or about to expire
+
+  Concurrent refreshes for the same user are coalesced into one request to Spotify: threads in
+  this process wait on a lock for the user, and processes wait on a row lock on the user's
+  host_users row. Whoever gets the lock second finds the token already refreshed and uses it.
+  Pass force=True when Spotify rejected the current token even though it hadn't expired."""
+
+  stale_token = user.access_token # The token we want to replace
+
+  with refresh_lock(user.id):
+    # Use our own connection so the caller's unit of work isn't committed along with the new token
+    with db.engine.begin() as connection:
+      host_users = HostUser.__table__
+      row = connection.execute(
+        select(host_users.c.access_token, host_users.c.refresh_token, host_users.c.token_expires_at)
+          .where(host_users.c.id == user.id)
+          .with_for_update()
+      ).first()
+
+      # The saved token is still good, and either Spotify didn't reject it or it isn't the one it rejected
+      # (someone else refreshed it while we were waiting for the lock)
+      if row and not token_expires_soon(row.token_expires_at) and (row.access_token != stale_token or not force):
+        tokens = dict(row._mapping)
+
+      else:
+        data = {
+          "grant_type": "refresh_token",
+          "refresh_token": row.refresh_token if row else user.refresh_token
+        }
+        auth_response = spotify_client.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER, data=data)
+
+        if auth_response.status_code != 200:
+          raise SpotifyAuthError(f"Could not refresh the access token for {user.id}: {auth_response.status_code} {auth_response.text}")
+
+        auth_data = auth_response.json()
+        tokens = {
+          "access_token": auth_data["access_token"],
+          "refresh_token": auth_data.get("refresh_token", data["refresh_token"]), # Spotify only sometimes sends a new refresh token
+          "token_expires_at": token_expiry(auth_data)
+        }
+        connection.execute(host_users.update().where(host_users.c.id == user.id).values(**tokens))
+
+  # Update the user without marking it as changed, the tokens are already saved
+  for key, value in tokens.items():
+    set_committed_value(user, key, value)
 
-  data = {
-    "grant_type": "refresh_token",
-    "refresh_token": user.refresh_token
-  }
+  return user
 
-  auth_response = requests.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER, data=data)
-  auth_data = json.loads(auth_response.text)
 
-  user.access_token = auth_data["access_token"]
+def ensure_fresh_access_token(user):
+  """Refresh the user's access token ahead of time if it's about to expire"""
 
-  db.session.add(user)
-  db.session.commit()
-  return user
+  if token_expires_soon(user.token_expires_at):
+    refresh_access_token(user)
 
 
-def make_authorized_api_call(host_user, endpoint, method='POST', data=None, params=None):
-  """Make an authorized api call with protection against expired access tokens.
+def token_expires_soon(token_expires_at):
+  """Check if a token expires within TOKEN_REFRESH_MARGIN_SECONDS. Tokens without an expiry are treated as expired"""
+
+  return not token_expires_at or token_expires_at <= datetime.utcnow() + timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS)
+
 
-  Return the responce in a python dictionary"""
-  if method == 'POST':
-    request_method = requests.post
-  elif method == 'GET':
-    request_method = requests.get
+def token_expiry(auth_data):
+  """When the access token in a token response expires (UTC)"""
 
-  request = request_method(endpoint, headers=host_user.auth_header, data=data,params=params)
-  # Check for expired access token (error code 401)
-  if request.status_code == 401:
-    refresh_access_token(host_user) #refresh the owner's access_token
-    request = request_method(endpoint, headers=host_user.auth_header, data=data,params=params) # make the request again
+  return datetime.utcnow() + timedelta(seconds=auth_data.get("expires_in", 3600))
+
+
+def refresh_lock(user_id):
+  """Lock held by the thread refreshing a user's access token in this process
+
+  Users share a fixed number of locks, so there's nothing to clean up as hosts come and go.
+  Two users on the same lock only means one refresh waits for the other"""
+
+  return refresh_locks[hash(user_id) % len(refresh_locks)]
+
+
+def make_authorized_api_call(host_user, endpoint, method='POST', data=None, params=None, json=None, defer_server_errors=False):
+  """Make an authorized api call with protection against expired access tokens.
+
+  Return the responce in a python dictionary, or None if Spotify rejected the request.
+  Raises SpotifyDeferred when Spotify is rate limiting or down and the call should be retried later.
+  With defer_server_errors, a 5xx or a request that couldn't reach Spotify raises SpotifyServerError
+  too, for calls whose failure would otherwise lose something, like the tracks in an add"""
+
+  try:
+    with Timer(SPOTIFY_CALL_SECONDS, method=method, endpoint=endpoint_template(endpoint), outcome=None) as timer:
+      ensure_fresh_access_token(host_user) # Refresh before the request instead of after a 401
+
+      request = spotify_client.request(method, endpoint, rate_limit_key=host_user.id, headers=host_user.auth_header, data=data, params=params, json=json)
+      # Check for expired access token (error code 401)
+      if request.status_code == 401:
+        refresh_access_token(host_user, force=True) #refresh the owner's access_token
+        request = spotify_client.request(method, endpoint, rate_limit_key=host_user.id, headers=host_user.auth_header, data=data, params=params, json=json) # make the request again
+      timer.labels['outcome'] = str(request.status_code)
+  except (ConnectionError, Timeout) as error:
+    if not defer_server_errors:
+      raise
+    raise SpotifyServerError(f"Couldn't reach Spotify for {method} {endpoint}: {error}", retry_after=SPOTIFY_SERVER_ERROR_RETRY_SECONDS) from error
 
   if request.status_code < 400:
-    return json.loads(request.text) # Unpack response
+    return request.json() # Unpack response
+  elif request.status_code >= 500 and defer_server_errors:
+    raise SpotifyServerError(f"Spotify responded {request.status_code} to {method} {endpoint}", retry_after=SPOTIFY_SERVER_ERROR_RETRY_SECONDS)
   else:
     return None
 
@@ -122,11 +230,12 @@ def get_or_create_host_user(auth_data):
 
   access_token = auth_data["access_token"]
   refresh_token = auth_data["refresh_token"]
+  token_expires_at = token_expiry(auth_data)
   auth_header = {"Authorization": f"Bearer {access_token}"}
 
 
   USER_PROFILE_ENDPOINT = SPOTIFY_API_URL + '/me'
-  profile_response = requests.get(USER_PROFILE_ENDPOINT, headers=auth_header) # .json() to unpack
+  profile_response = spotify_client.get(USER_PROFILE_ENDPOINT, headers=auth_header) # .json() to unpack
 
   # If we got 403 "forbidden" (if the spotify account is not added to our app, required because the spotify app is in development mode) 
   if profile_response.status_code == 403: 
@@ -142,48 +251,58 @@ def get_or_create_host_user(auth_data):
     url = profile_data['external_urls']['spotify']
     id = profile_data['id'] # Use same id as spotify
 
-    guest_user = GuestUser.query.filter_by(id=id).first() # Check if there GuestUser in the database 
-    
-    # If there is already guest user in the database with the same id
-    if guest_user:
-      db.session.delete(guest_user) # Delete the guest user from the database so we can create a host user with the same id
-      db.session.commit() 
-    
-    host_user = HostUser.query.filter_by(id=id).first() # Check if the HostUser is already in the database
-
-    # If the user is not in the database
-    if not host_user:
-      # Create HostUser object.query.filter_by(id=id).first()
-      host_user = HostUser(display_name=display_name, email=email, url=url, id=id, access_token=access_token, refresh_token=refresh_token)
-      db.session.add(host_user) # Add HostUser to database
-      db.session.commit() 
-
-    # If the HostUser already exits update the access token and refresh token 
-    else:
-      host_user.access_token = access_token # Update access_token
-      host_user.refresh_token = refresh_token # Update access_token
-      db.session.add(host_user) # Update HostUser
-      db.session.commit() 
+    host_user = upsert_host_user(id=id, display_name=display_name, email=email, url=url,
+      access_token=access_token, refresh_token=refresh_token, token_expires_at=token_expires_at)
+    db.session.commit()
 
     return host_user # return the HostUser object
 
 
+def upsert_host_user(id, **columns):
+  """Insert or update the HostUser with a Spotify id, without committing
+
+  A guest user with the same id is turned into a host user in place, keeping their phone
+  number and active playlist. Returns the HostUser"""
+
+  guest_users = GuestUser.__table__
+  host_users = HostUser.__table__
+
+  # Both statements lock the rows they touch, so logging in twice at once can't collide
+  insert_guest_user = insert(guest_users).values(id=id, user_type='host_users')
+  phone_number = db.session.scalar(
+    insert_guest_user
+      .on_conflict_do_update(index_elements=[guest_users.c.id], set_={"user_type": insert_guest_user.excluded.user_type})
+      .returning(guest_users.c.phone_number)
+  )
+  insert_host_user = insert(host_users).values(id=id, **columns)
+  db.session.execute(
+    insert_host_user.on_conflict_do_update(index_elements=[host_users.c.id], set_={name: insert_host_user.excluded[name] for name in columns})
+  )
+  invalidate_guest_user(phone_number) # A guest with this phone number may be cached
+
+  return db.session.query(HostUser).populate_existing().get(id)
+
+
 def get_or_create_guest_user(phone_number):
-  """Get or create a guest user object"""
+  """Get or create a guest user object, without committing
 
-  guest_user = GuestUser.query.filter_by(phone_number=phone_number).first() # Check if the HostUser is already in the Database using email address
+  Inserting is an upsert, so two first texts from the same phone at once get the same row"""
+
+  guest_user = get_guest_user_by_phone(phone_number) # Check if the user is already in the Database using their phone number
 
   # If the user is not in the database
   if not guest_user:
-    # Create HostUser object
-    guest_user = GuestUser(id=phone_number, phone_number=phone_number)
-    db.session.add(guest_user) # Add HostUser to Database
-    db.session.commit() 
+    guest_users = GuestUser.__table__
+    insert_guest_user = insert(guest_users).values(id=phone_number, phone_number=phone_number, user_type='guest_users')
+    upsert = insert_guest_user \
+      .on_conflict_do_update(index_elements=[guest_users.c.phone_number], set_={"phone_number": insert_guest_user.excluded.phone_number}) \
+      .returning(*guest_users.c)
+    guest_user = db.session.execute(select(GuestUser).from_statement(upsert)).scalar_one()
 
-  return guest_user # return the HostUser object
+  return guest_user # return the GuestUser object (a HostUser if it's a host's phone number)
 
 
-def create_playlist(host_user, title, key):
+def create_playlist(host_user, title, key, allow_duplicates=False):
   """Create a playlist on the users account"""
 
   # Data for created playlist
@@ -203,11 +322,12 @@ def create_playlist(host_user, title, key):
   playlist_endpoint = playlist_data['href'] # Used for adding tracks
   owner_id = playlist_data['owner']['id'] # Use the same owner id as spotify
 
-  new_playlist = Playlist(id=id, title=title, key=key, url=url, endpoint=playlist_endpoint, owner_id=owner_id)
+  new_playlist = Playlist(id=id, title=title, key=key, url=url, endpoint=playlist_endpoint, owner_id=owner_id, allow_duplicates=allow_duplicates)
   db.session.add(new_playlist)
 
   host_user.active_playlist_id = new_playlist.id
   db.session.add(host_user)
+  invalidate_guest_user(host_user.phone_number) # The host's active playlist changed
   db.session.commit() # commit to database
 
   playlist_key_success_notification(phone_number=host_user.phone_number, playlist=new_playlist) # Send a message to the user
@@ -217,83 +337,259 @@ def create_playlist(host_user, title, key):
 
 
 def get_or_create_track(host_user, track_id):
-  """Make an API call to get rack data"""
+  """Make an API call to get rack data. The caller is responsible for committing"""
 
-  track = Track.query.filter_by(id=track_id).first() # Check if the Track is already in the Database
-  
-  if not track:
-    get_track_endpoint = SPOTIFY_API_URL + '/tracks/' + track_id
-    track_data = make_authorized_api_call(
-      host_user=host_user, 
-      method='GET', 
-      endpoint=get_track_endpoint
+  return get_or_create_tracks(host_user=host_user, track_ids=[track_id]).get(track_id)
+
+
+def get_or_create_tracks(host_user, track_ids):
+  """Get the Track for every track_id, making as few API calls as possible
+
+  Tracks already in the database are found with one query. The rest are requested from
+  Spotify's multiple tracks endpoint TRACKS_PER_LOOKUP at a time and upserted with a single
+  statement that returns every row, including ones someone else inserted at the same time.
+  The caller is responsible for committing.
+
+  Returns a dictionary of track_id -> Track. Track ids Spotify doesn't recognize are left out"""
+
+  track_ids = list(dict.fromkeys(track_ids)) # Drop repeats, keeping order
+  if not track_ids:
+    return {}
+
+  # Check which Tracks are already in the database
+  tracks = {track.id: track for track in Track.query.filter(Track.id.in_(track_ids))}
+  missing_ids = [track_id for track_id in track_ids if track_id not in tracks]
+
+  new_track_rows = [] # Rows for the tracks that need to be inserted
+  for start in range(0, len(missing_ids), TRACKS_PER_LOOKUP):
+    batch = missing_ids[start:start + TRACKS_PER_LOOKUP]
+    tracks_data = make_authorized_api_call(
+      host_user=host_user,
+      method='GET',
+      endpoint=SPOTIFY_API_URL + '/tracks',
+      params={"ids": ','.join(batch)}
     )
     # if the request was successful
-    if track_data:
+    if tracks_data:
+      # Spotify returns the tracks in the order they were requested, with null for unknown ids
+      new_track_rows.extend(track_row(track_data) for track_data in tracks_data['tracks'] if track_data)
 
-      id = track_data['id'] # Use same id as spotify
-      name = track_data['name']
-      artist = track_data['artists'][0]['name']
-      track = Track(id=id, name=name, artist=artist)
-      db.session.add(track)
-      db.session.commit()
-    
-  return track
+  if new_track_rows:
+    # Upsert every new track in one statement and get the Track objects back from it
+    insert_tracks = insert(Track).values(new_track_rows)
+    upsert_tracks = insert_tracks \
+      .on_conflict_do_update(index_elements=[Track.id], set_={"name": insert_tracks.excluded.name, "artist": insert_tracks.excluded.artist}) \
+      .returning(*Track.__table__.c)
+    for track in db.session.execute(select(Track).from_statement(upsert_tracks).execution_options(populate_existing=True)).scalars():
+      tracks[track.id] = track
 
-# -------------------------- OTHER REQUESTS ---------------------------
+  return tracks
 
-def get_track_ids_from_message(message):
-  """Returns a list of Spotify track URLs in a string"""
 
-  track_ids = [] # List of track_ids to return
+def save_tracks(tracks_data):
+  """Insert a Track for each of Spotify's track objects, skipping ones already saved
+
+  Used for the tracks on album and playlist pages, so they don't have to be looked up again"""
+
+  rows = [track_row(track_data) for track_data in tracks_data]
+  if rows:
+    db.session.execute(insert(Track).values(rows).on_conflict_do_nothing())
 
-  urls = re.findall('https:\/\/open.spotify.com\/track\/+[^? ]*', message) # Regex for finding track urls
-  
-  # Iterate over found urls
-  for url in urls:
-    track_id = url.replace('https://open.spotify.com/track/', '') # replace the begining to get the track id
-    track_ids.append(track_id) # Append track_id to our list to return
 
-  return track_ids
+def track_row(track_data):
+  """The Track columns from Spotify's track object"""
+
+  return {
+    "id": track_data['id'],
+    "name": track_data['name'],
+    "artist": track_data['artists'][0]['name']
+  }
+
+# -------------------------- OTHER REQUESTS ---------------------------
+
+def get_track_ids_from_message(message):
+  """Returns a list of the Spotify track ids linked in a string"""
+
+  return parse_message(message).track_ids
 
 
 def get_playlist_key_from_message(message):
   """Returns the first playlist key in a message"""
 
-  keys = re.findall('#+[^? ]*', message)  # find all words starting with "#"
+  return parse_message(message).key
 
-  # if keys were found
-  if keys:
-    return keys[0].replace('#', '').lower() # return the first key in lowercase
-  else:
-    return None
 
+def get_message_track_ids(host_user, parsed, limit=MAX_TRACKS_PER_MESSAGE):
+  """Yield the tracks linked in a parsed message, then the tracks on each linked album and playlist
 
-def add_tracks_to_playlist(playlist, track_ids, added_by=None):
-  """Make a post request to add the track_ids to the Spotify playlist"""
+  Album and playlist pages are only requested as the tracks before them are used, and no
+  more than limit tracks are yielded"""
 
-  add_tracks_endpoint = playlist.endpoint + "/tracks"
-  
-  # For all track_ids after the first (track_ids[1:]) add them with a comma seperator
+  track_ids = chain(
+    parsed.track_ids,
+    *(get_album_track_ids(host_user, album_id) for album_id in parsed.album_ids),
+    *(get_playlist_track_ids(host_user, playlist_id) for playlist_id in parsed.playlist_ids)
+  )
+  return islice(unique(track_ids), limit)
+
+
+def get_album_track_ids(host_user, album_id):
+  """Yield the id of every track on an album, a page at a time"""
+
+  endpoint = f"{SPOTIFY_API_URL}/albums/{album_id}/tracks"
+  for tracks_data in get_pages(host_user, endpoint, params={"limit": ALBUM_TRACKS_PER_PAGE}):
+    save_tracks(tracks_data)
+    yield from (track_data['id'] for track_data in tracks_data)
+
+
+def get_playlist_track_ids(host_user, playlist_id, required=False):
+  """Yield the id of every track on a playlist, a page at a time. Podcast episodes and local files are skipped
+
+  required is passed on to get_pages"""
+
+  endpoint = f"{SPOTIFY_API_URL}/playlists/{playlist_id}/tracks"
+  params = {
+    "limit": PLAYLIST_TRACKS_PER_PAGE,
+    "fields": "next,items(track(id,name,type,is_local,artists(name)))" # Only what we need, to keep pages small
+  }
+  for items in get_pages(host_user, endpoint, params=params, required=required):
+    tracks_data = [item['track'] for item in items
+                   if item['track'] and item['track']['type'] == 'track' and item['track']['id'] and not item['track']['is_local']]
+    save_tracks(tracks_data)
+    yield from (track_data['id'] for track_data in tracks_data)
+
+
+def get_pages(host_user, endpoint, params=None, required=False):
+  """Yield the items on each page of one of Spotify's paginated endpoints, requesting each page when it's needed
+
+  Stops at a page Spotify won't return, or raises SpotifyPageError if required is set, for
+  callers that can't act on only some of the pages"""
+
+  while endpoint:
+    page = make_authorized_api_call(host_user=host_user, method='GET', endpoint=endpoint, params=params)
+    if not page:
+      if required:
+        raise SpotifyPageError(f"Spotify wouldn't return {endpoint}")
+      return
+    yield page['items']
+    endpoint, params = page['next'], None # The next url already has the query string
+
+
+def unique(track_ids):
+  """Yield each track id the first time it's seen, keeping the order"""
+
+  seen = set()
   for track_id in track_ids:
-    uris_string = 'spotify:track:' + track_id # Format the first track track_ids[0]
+    if track_id not in seen:
+      seen.add(track_id)
+      yield track_id
+
+
+def batched(iterable, size):
+  """Yield lists of up to size items, only taking items from iterable as each list is needed"""
+
+  iterator = iter(iterable)
+  while batch := list(islice(iterator, size)):
+    yield batch
+
+
+def add_tracks_to_playlist(playlist, track_ids, added_by=None, tracks_done=0, record_progress=None):
+  """Add the track_ids to the Spotify playlist in as few requests as possible
+
+  track_ids can be any iterable, such as get_message_track_ids, and is consumed a batch at a
+  time. Tracks are sent in batches of up to MAX_TRACKS_PER_ADD uris in the JSON body of each
+  request, and the PlaylistTrack rows for each batch are written as soon as it's added, so
+  if Spotify starts rate limiting or failing part way through SpotifyDeferred is raised without
+  losing the batches already added. Only a batch Spotify refuses (a 4xx) is reported as failed.
+
+  Tracks already on the playlist are skipped without calling Spotify, unless the playlist
+  allows duplicates.
 
-    # Make the post request to add the tracks to the playlist
+  added_by is the phone number that sent the tracks, or a dictionary of track_id -> phone
+  number when they were sent by several people (see coalesce.py).
+
+  A queued message that's retried picks up where it left off with tracks_done, the number of
+  its tracks an earlier attempt added, which are skipped. record_progress(tracks_done) is
+  called as each batch is recorded, so the count is committed with the batch. That matters
+  only when the playlist allows duplicates, otherwise tracks on the playlist are skipped anyway.
+
+  Returns a dictionary of track_id -> TRACK_ADDED, TRACK_FAILED or TRACK_ON_PLAYLIST, in
+  the order the tracks were received"""
+
+  lock_playlist(playlist) # Adds to a playlist go one at a time, adds to different playlists in parallel
+
+  add_tracks_endpoint = playlist.endpoint + "/tracks"
+  outcomes = {} # Outcome of each track_id to return
+
+  track_ids = unique(track_ids) # Drop repeated links
+  if playlist.allow_duplicates:
+    track_ids = islice(track_ids, tracks_done, None) # Added by an earlier attempt at the same message
+  else:
+    track_ids = skip_tracks_on_playlist(playlist, track_ids, outcomes)
+
+  # Send the track_ids to spotify in batches
+  for batch in batched(track_ids, MAX_TRACKS_PER_ADD):
+    # Make the post request to add the batch of tracks to the playlist
     response = make_authorized_api_call(
-      host_user=playlist.owner, 
-      endpoint=add_tracks_endpoint, 
-      params={"uris": uris_string}  # Pass the track_ids to spotify in the query string with the key "uris"
+      host_user=playlist.owner,
+      endpoint=add_tracks_endpoint,
+      json={"uris": ['spotify:track:' + track_id for track_id in batch]}, # Spotify takes a list of uris in the body
+      defer_server_errors=True # Retry the batch later rather than drop it
     )
-    # If the request was successful
-    if response:
-      track = get_or_create_track(host_user=playlist.owner, track_id=track_id)
-      new_playlist_track = PlaylistTrack(
-        playlist_id=playlist.id, 
-        track_id=track.id,
-        added_by=added_by
-      )
-      db.session.add(new_playlist_track)
-      db.session.commit()
-      return new_playlist_track
-  
-  return None
\ No newline at end of file
+    # Spotify adds a whole batch or none of it
+    batch_outcomes = {track_id: TRACK_ADDED if response else TRACK_FAILED for track_id in batch}
+    record_playlist_tracks(playlist, batch_outcomes, added_by)
+    outcomes.update(batch_outcomes)
+
+    tracks_done += len(batch)
+    if record_progress and playlist.allow_duplicates:
+      record_progress(tracks_done)
+
+  return outcomes
+
+
+def lock_playlist(playlist):
+  """Wait for other transactions adding to the playlist to finish, and hold it until this one finishes
+
+  The queue already processes a playlist's messages in order (see jobs.py). This covers the
+  messages that turn out to be headed somewhere other than the lane they were queued in"""
+
+  db.session.execute(select(func.pg_advisory_xact_lock(PLAYLIST_LOCK_NAMESPACE, func.hashtext(playlist.id))))
+
+
+def try_lock_playlist(playlist_id):
+  """Take the lock lock_playlist waits for, without waiting. Returns True if this transaction holds it"""
+
+  return db.session.scalar(select(func.pg_try_advisory_xact_lock(PLAYLIST_LOCK_NAMESPACE, func.hashtext(playlist_id))))
+
+
+def skip_tracks_on_playlist(playlist, track_ids, outcomes):
+  """Yield the track_ids that aren't on the playlist yet, checking MAX_TRACKS_PER_ADD of them per query
+
+  The ids that are skipped are reported as TRACK_ON_PLAYLIST in outcomes"""
+
+  for batch in batched(track_ids, MAX_TRACKS_PER_ADD):
+    on_playlist = set(db.session.scalars(
+      select(PlaylistTrack.track_id).where(PlaylistTrack.playlist_id == playlist.id, PlaylistTrack.track_id.in_(batch))
+    ))
+    for track_id in batch:
+      if track_id in on_playlist:
+        outcomes[track_id] = TRACK_ON_PLAYLIST
+      else:
+        yield track_id
+
+
+def record_playlist_tracks(playlist, outcomes, added_by=None):
+  """Save a PlaylistTrack for every track in a batch add_tracks_to_playlist added, in a single statement
+
+  Tracks that already have a PlaylistTrack (a duplicate, or added by someone else at the same
+  time) keep the one they have"""
+
+  # Get the track data for the tracks that made it onto the playlist
+  added_ids = [track_id for track_id, outcome in outcomes.items() if outcome == TRACK_ADDED]
+  tracks = get_or_create_tracks(host_user=playlist.owner, track_ids=added_ids)
+
+  added_by_track = added_by if isinstance(added_by, dict) else dict.fromkeys(added_ids, added_by)
+  rows = [{"playlist_id": playlist.id, "track_id": track_id, "added_by": added_by_track.get(track_id)} for track_id in added_ids if track_id in tracks]
+  if rows:
+    db.session.execute(insert(PlaylistTrack).values(rows).on_conflict_do_nothing()) # Committed with the rest of the message by the worker
@@ -0,0 +1,328 @@
+"""Shared HTTP client for the Spotify API and Accounts Service"""
+
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+SPOTIFY_POOL_CONNECTIONS = int(os.environ.get('SPOTIFY_POOL_CONNECTIONS', 2)) # Hosts to keep pools for (accounts.spotify.com and api.spotify.com)
+SPOTIFY_POOL_MAXSIZE = int(os.environ.get('SPOTIFY_POOL_MAXSIZE', 10)) # Keep-alive connections per host, should cover the threads in a process
+SPOTIFY_CONNECT_TIMEOUT = float(os.environ.get('SPOTIFY_CONNECT_TIMEOUT', 3.05)) # Seconds to wait for a connection
+SPOTIFY_READ_TIMEOUT = float(os.environ.get('SPOTIFY_READ_TIMEOUT', 10)) # Seconds to wait for a response
+
+SPOTIFY_APP_REQUESTS_PER_SECOND = float(os.environ.get('SPOTIFY_APP_REQUESTS_PER_SECOND', 10)) # Shared by every request from this process
+SPOTIFY_USER_REQUESTS_PER_SECOND = float(os.environ.get('SPOTIFY_USER_REQUESTS_PER_SECOND', 3)) # Per host user
+SPOTIFY_USER_BUCKETS_SWEEP_SIZE = int(os.environ.get('SPOTIFY_USER_BUCKETS_SWEEP_SIZE', 1000)) # Host users' buckets kept before the idle ones are forgotten
+SPOTIFY_MAX_WAIT_SECONDS = float(os.environ.get('SPOTIFY_MAX_WAIT_SECONDS', 5)) # Longest we'll block for a rate limit before deferring
+SPOTIFY_MAX_RETRIES = int(os.environ.get('SPOTIFY_MAX_RETRIES', 3)) # Retries for GET requests
+SPOTIFY_RETRY_BACKOFF_SECONDS = float(os.environ.get('SPOTIFY_RETRY_BACKOFF_SECONDS', 0.5)) # Delay before the first retry, doubled after
+SPOTIFY_BREAKER_FAILURES = int(os.environ.get('SPOTIFY_BREAKER_FAILURES', 5)) # Failures in a row that open the circuit breaker
+SPOTIFY_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('SPOTIFY_BREAKER_COOLDOWN_SECONDS', 30)) # How long the breaker stays open
+SPOTIFY_SERVER_ERROR_RETRY_SECONDS = float(os.environ.get('SPOTIFY_SERVER_ERROR_RETRY_SECONDS', 30)) # Wait before retrying a request Spotify failed
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD'} # Safe to retry
+
+
+class SpotifyDeferred(Exception):
+  """Spotify can't take the request right now. Try again in retry_after seconds"""
+
+  def __init__(self, message, retry_after):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+
+class SpotifyRateLimited(SpotifyDeferred):
+  """Spotify responded with 429, or our own rate limit would have made us wait too long"""
+
+
+class SpotifyUnavailable(SpotifyDeferred):
+  """The circuit breaker is open because Spotify keeps failing"""
+
+
+class SpotifyServerError(SpotifyDeferred):
+  """Spotify responded with a 5xx, or couldn't be reached in time"""
+
+
+class TokenBucket:
+  """Allows rate requests per second on average, with bursts of up to capacity"""
+
+  def __init__(self, rate, capacity=None):
+    self.rate = rate
+    self.capacity = capacity or max(1, rate)
+    self.tokens = self.capacity
+    self.updated_at = time.monotonic()
+    self.paused_until = 0 # Set from Retry-After
+    self.lock = threading.Lock()
+
+  def reserve(self, max_wait):
+    """Take a token and return how many seconds to wait before using it
+
+    Raises SpotifyRateLimited without taking a token if the wait would be longer than max_wait"""
+
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+      self.updated_at = now
+
+      wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+      if wait > max_wait:
+        raise SpotifyRateLimited(f"Rate limited for {wait:.1f}s", retry_after=wait)
+
+      self.tokens -= 1 # Can go negative, which queues the requests after this one behind it
+      return wait
+
+  def refund(self):
+    """Give back a token taken by reserve for a request that wasn't made"""
+
+    with self.lock:
+      self.tokens = min(self.capacity, self.tokens + 1)
+
+  def pause(self, seconds):
+    """Hold every request for the next `seconds`"""
+
+    with self.lock:
+      self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+  def state(self):
+    return {"tokens": self.tokens, "paused_for": max(0, self.paused_until - time.monotonic())}
+
+  def idle(self):
+    """Check if the bucket has refilled and isn't paused, so a new bucket would behave the same"""
+
+    with self.lock:
+      now = time.monotonic()
+      return self.tokens + (now - self.updated_at) * self.rate >= self.capacity and self.paused_until <= now
+
+
+class CircuitBreaker:
+  """Fails fast after `failures` failed requests in a row, until `cooldown` seconds have passed
+
+  After the cooldown one trial request is let through (half open). If it succeeds the breaker
+  closes, otherwise it opens again."""
+
+  CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+  def __init__(self, failures=SPOTIFY_BREAKER_FAILURES, cooldown=SPOTIFY_BREAKER_COOLDOWN_SECONDS):
+    self.max_failures = failures
+    self.cooldown = cooldown
+    self.failures = 0 # Failures in a row
+    self.opened_at = None
+    self.trial_running = False
+    self.lock = threading.Lock()
+
+  @property
+  def state(self):
+    if self.opened_at is None:
+      return self.CLOSED
+    if time.monotonic() - self.opened_at < self.cooldown:
+      return self.OPEN
+    return self.HALF_OPEN
+
+  def check(self):
+    """Raise SpotifyUnavailable if requests shouldn't be made right now"""
+
+    with self.lock:
+      state = self.state
+      if state == self.CLOSED:
+        return
+      if state == self.HALF_OPEN and not self.trial_running:
+        self.trial_running = True # Let this one request through to test the water
+        return
+
+      retry_after = max(self.cooldown - (time.monotonic() - self.opened_at), 1)
+      raise SpotifyUnavailable(f"Spotify circuit breaker is {state}", retry_after=retry_after)
+
+  def cancel_trial(self):
+    """Let another request be the trial, when the one check let through failed before reaching Spotify"""
+
+    with self.lock:
+      self.trial_running = False
+
+  def record_success(self):
+    with self.lock:
+      self.failures = 0
+      self.opened_at = None
+      self.trial_running = False
+
+  def record_failure(self):
+    with self.lock:
+      self.failures += 1
+      if self.trial_running or self.failures >= self.max_failures:
+        self.opened_at = time.monotonic()
+      self.trial_running = False
+
+
+class SpotifyClient:
+  """Makes requests to Spotify over a pooled, keep-alive requests.Session
+
+  Every request gets a connect and read timeout unless one is passed in. The session is
+  created on first use in each process, so gunicorn workers forked from a preloaded app
+  don't share sockets.
+
+  Requests wait for a token from the app wide bucket and, when a rate_limit_key (the host
+  user's id) is given, from that user's bucket. A 429 pauses the buckets for Retry-After.
+  GET requests are retried with jittered backoff; anything that would need a long wait raises
+  a SpotifyDeferred so the caller can try again later instead of dropping the request.
+  Each host gets a CircuitBreaker that fails fast while Spotify is erroring."""
+
+  def __init__(self, pool_connections=SPOTIFY_POOL_CONNECTIONS, pool_maxsize=SPOTIFY_POOL_MAXSIZE,
+               connect_timeout=SPOTIFY_CONNECT_TIMEOUT, read_timeout=SPOTIFY_READ_TIMEOUT,
+               app_rate=SPOTIFY_APP_REQUESTS_PER_SECOND, user_rate=SPOTIFY_USER_REQUESTS_PER_SECOND,
+               max_wait=SPOTIFY_MAX_WAIT_SECONDS, max_retries=SPOTIFY_MAX_RETRIES):
+    self.pool_connections = pool_connections
+    self.pool_maxsize = pool_maxsize
+    self.timeout = (connect_timeout, read_timeout)
+    self.user_rate = user_rate
+    self.max_wait = max_wait
+    self.max_retries = max_retries
+    self._session = None
+    self._session_pid = None # Process the session was created in
+
+    self.app_bucket = TokenBucket(app_rate)
+    self.user_buckets = {} # host user id -> TokenBucket
+    self.sweep_size = SPOTIFY_USER_BUCKETS_SWEEP_SIZE # Forget idle user buckets once there are this many
+    self.breakers = {} # hostname -> CircuitBreaker
+    self.lock = threading.Lock()
+
+  @property
+  def session(self):
+    """The requests.Session for this process"""
+
+    if self._session is None or self._session_pid != os.getpid():
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      self._session, self._session_pid = session, os.getpid()
+
+    return self._session
+
+  def request(self, method, url, rate_limit_key=None, **kwargs):
+    """Make a request, reusing a kept-alive connection when there is one"""
+
+    kwargs.setdefault('timeout', self.timeout)
+    breaker = self.breaker(urlsplit(url).hostname)
+    buckets = self.buckets(rate_limit_key)
+    retries = self.max_retries if method in IDEMPOTENT_METHODS else 0
+
+    for attempt in range(retries + 1):
+      time.sleep(self.reserve(buckets))
+
+      # Checked right before the first attempt, so a half open breaker's trial always reaches
+      # Spotify. Retries are part of the same request, and it counts once for the breaker
+      if attempt == 0:
+        try:
+          breaker.check()
+        except SpotifyUnavailable:
+          for bucket in buckets:
+            bucket.refund()
+          raise
+
+      try:
+        response = self.session.request(method, url, **kwargs)
+      except (ConnectionError, Timeout):
+        if attempt == retries:
+          breaker.record_failure()
+          raise
+        time.sleep(backoff(attempt))
+        continue
+      except Exception:
+        breaker.cancel_trial() # Our request was bad, which says nothing about Spotify
+        raise
+
+      if response.status_code == 429:
+        breaker.record_success() # Spotify is up, just busy
+        retry_after = parse_retry_after(response)
+        for bucket in buckets:
+          bucket.pause(retry_after) # Hold back the requests behind this one too
+        if attempt == retries or retry_after > self.max_wait:
+          raise SpotifyRateLimited(f"Spotify rate limited {method} {url}", retry_after=retry_after)
+        continue # The bucket waits out Retry-After
+
+      if response.status_code >= 500:
+        if attempt < retries:
+          time.sleep(backoff(attempt))
+          continue
+        breaker.record_failure()
+        return response
+
+      breaker.record_success()
+      return response
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def reserve(self, buckets):
+    """Take a token from every bucket and return how long to wait before using them
+
+    If one of the buckets raises SpotifyRateLimited, the tokens already taken are given back"""
+
+    waits = []
+    try:
+      for bucket in buckets:
+        waits.append(bucket.reserve(self.max_wait))
+    except SpotifyRateLimited:
+      for bucket in buckets[:len(waits)]:
+        bucket.refund()
+      raise
+    return max(waits)
+
+  def breaker(self, host):
+    """The circuit breaker for a host"""
+
+    with self.lock:
+      return self.breakers.setdefault(host, CircuitBreaker())
+
+  def buckets(self, rate_limit_key):
+    """The token buckets a request has to take a token from"""
+
+    if rate_limit_key is None:
+      return [self.app_bucket]
+
+    with self.lock:
+      user_bucket = self.user_buckets.setdefault(rate_limit_key, TokenBucket(self.user_rate))
+
+      # Forget the buckets of users who haven't made a request for a while. The next sweep waits
+      # for at least twice as many buckets as this one kept, so the cost per request stays constant
+      if len(self.user_buckets) >= self.sweep_size:
+        for key in [key for key, bucket in self.user_buckets.items() if bucket is not user_bucket and bucket.idle()]:
+          del self.user_buckets[key]
+        self.sweep_size = max(self.sweep_size, 2 * len(self.user_buckets))
+    return [self.app_bucket, user_bucket]
+
+  def state(self):
+    """Circuit breaker and rate limit state, for metrics"""
+
+    with self.lock:
+      user_buckets = list(self.user_buckets.values())
+
+    return {
+      "breakers": {host: {"state": breaker.state, "failures": breaker.failures} for host, breaker in self.breakers.items()},
+      "app_bucket": self.app_bucket.state(),
+      "rate_limited_users": sum(1 for bucket in user_buckets if bucket.state()["paused_for"] > 0)
+    }
+
+
+def parse_retry_after(response):
+  """Seconds to wait from a 429 response's Retry-After header"""
+
+  try:
+    return max(float(response.headers.get('Retry-After', 1)), 0)
+  except ValueError:
+    return 1 # Spotify sends seconds, but don't fail on anything else
+
+
+def backoff(attempt):
+  """Seconds to wait before retry number attempt + 1, with jitter"""
+
+  return SPOTIFY_RETRY_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1)
+
+
+spotify_client = SpotifyClient() # Used for every call to Spotify
@@ -0,0 +1,144 @@
+"""Sync playlists with Spotify
+
+Hosts edit their playlists in the Spotify app too, so every playlist is synced every
+SYNC_INTERVAL_SECONDS. A sync asks Spotify for the playlist's snapshot_id only, and stops
+there if it's the one we saw last time. Otherwise it pages through the playlist's tracks
+and applies the difference to playlist_tracks with one INSERT and one DELETE.
+
+The worker runs SYNC_CONCURRENCY sync threads, so at most that many syncs per worker
+process are talking to Spotify at once however many hosts there are. Threads claim due
+playlists with SELECT ... FOR UPDATE SKIP LOCKED, so worker processes never sync the same
+playlist at once. request_sync makes a playlist due right away, and `flask sync-playlists`
+syncs from the command line."""
+
+import logging
+import os
+from datetime import timedelta
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models import Playlist, PlaylistTrack, db
+from spotify import get_playlist_track_ids, lock_playlist, make_authorized_api_call, unique
+from spotify_client import SpotifyDeferred
+
+SYNC_INTERVAL_SECONDS = int(os.environ.get('SYNC_INTERVAL_SECONDS', 3600)) # How often each playlist is checked for changes
+SYNC_CONCURRENCY = int(os.environ.get('SYNC_CONCURRENCY', 2)) # Syncs at once per worker process, off when 0
+SYNC_POLL_INTERVAL_SECONDS = float(os.environ.get('SYNC_POLL_INTERVAL_SECONDS', 10)) # Wait between checks when no playlist is due
+
+logger = logging.getLogger(__name__)
+
+
+def claim_due_playlist():
+  """Claim the playlist that has gone longest without a sync, if it's due. Returns its id or None
+
+  Claiming sets synced_at, so a sync that fails isn't tried again until the next interval"""
+
+  due = or_(Playlist.synced_at == None, Playlist.synced_at <= func.now() - timedelta(seconds=SYNC_INTERVAL_SECONDS))
+  next_id = select(Playlist.id) \
+    .where(due) \
+    .order_by(Playlist.synced_at.asc().nullsfirst()) \
+    .limit(1) \
+    .with_for_update(skip_locked=True, key_share=True) \
+    .scalar_subquery()
+
+  playlist_id = db.session.scalar(
+    update(Playlist)
+      .where(Playlist.id == next_id)
+      .values(synced_at=func.now())
+      .returning(Playlist.id)
+      .execution_options(synchronize_session=False)
+  )
+  db.session.commit()
+  return playlist_id
+
+
+def request_sync(playlist_id):
+  """Make a playlist due for a sync, so the next free sync thread picks it up. The caller commits"""
+
+  db.session.execute(update(Playlist).where(Playlist.id == playlist_id).values(synced_at=None).execution_options(synchronize_session=False))
+
+
+def sync_playlist(playlist_id):
+  """Bring a playlist's tracks in line with Spotify and commit. Returns True if it had changed
+
+  Spotify is asked for the snapshot and paged through without holding anything. Tracks added
+  here meanwhile have a later seq than any recorded before paging, so they're never mistaken
+  for ones the host removed. The playlist is only locked against adds to compare snapshots
+  and write, and its row is only written once that lock is released, so a sync never holds
+  one while waiting for the other"""
+
+  playlist = db.session.query(Playlist).populate_existing().get(playlist_id) # Not the cached copy, its snapshot_id may be old
+  if not playlist:
+    return False
+
+  data = make_authorized_api_call(host_user=playlist.owner, method='GET', endpoint=playlist.endpoint, params={"fields": "snapshot_id"})
+  if not data or data['snapshot_id'] == playlist.snapshot_id:
+    db.session.commit()
+    return False
+
+  last_seq = db.session.scalar(select(func.max(PlaylistTrack.seq)).where(PlaylistTrack.playlist_id == playlist_id)) # Tracks recorded before paging
+  remote_ids = list(unique(get_playlist_track_ids(playlist.owner, playlist_id, required=True))) # Every track, or SpotifyPageError
+  db.session.commit() # Keeps the tracks saved from the pages, and ends the transaction before waiting for the lock
+
+  lock_playlist(playlist)
+
+  # Another sync applied this snapshot while we were paging
+  if db.session.scalar(select(Playlist.snapshot_id).where(Playlist.id == playlist_id)) == data['snapshot_id']:
+    db.session.commit()
+    return False
+
+  local_tracks = db.session.execute(select(PlaylistTrack.track_id, PlaylistTrack.seq).where(PlaylistTrack.playlist_id == playlist_id)).all()
+  local_ids = {track.track_id for track in local_tracks}
+  paged_ids = {track.track_id for track in local_tracks if last_seq is not None and track.seq <= last_seq} # On the playlist before paging started
+
+  new_rows = [{"playlist_id": playlist_id, "track_id": track_id} for track_id in remote_ids if track_id not in local_ids]
+  removed_ids = paged_ids.difference(remote_ids)
+
+  if new_rows:
+    db.session.execute(insert(PlaylistTrack).values(new_rows).on_conflict_do_nothing()) # Added in the app, so by nobody we know
+  if removed_ids:
+    db.session.execute(delete(PlaylistTrack).where(PlaylistTrack.playlist_id == playlist_id, PlaylistTrack.track_id.in_(removed_ids)))
+
+  db.session.commit() # Releases the playlist
+
+  # If this is lost, the next sync finds nothing to change and saves it then
+  db.session.execute(
+    update(Playlist)
+      .where(Playlist.id == playlist_id)
+      .values(snapshot_id=data['snapshot_id']) # Changes made while paging have a newer snapshot, and are picked up next time
+      .execution_options(synchronize_session=False)
+  )
+  db.session.commit()
+
+  logger.info('Synced playlist %s: %s added, %s removed', playlist_id, len(new_rows), len(removed_ids))
+  return True
+
+
+def sync_next_playlist():
+  """Claim and sync one due playlist. Return False if none were due"""
+
+  playlist_id = claim_due_playlist()
+  if not playlist_id:
+    return False
+
+  try:
+    sync_playlist(playlist_id)
+  except SpotifyDeferred as error:
+    logger.warning('Skipping sync of playlist %s until the next interval: %s', playlist_id, error)
+    db.session.rollback()
+  except Exception:
+    logger.exception('Failed to sync playlist %s', playlist_id)
+    db.session.rollback()
+
+  return True
+
+
+def sync_playlists(playlist_ids=None):
+  """Sync the given playlists, or every playlist, one after another. For `flask sync-playlists`
+
+  Returns the number that had changed"""
+
+  if playlist_ids is None:
+    playlist_ids = db.session.scalars(select(Playlist.id).order_by(Playlist.id)).all()
+
+  return sum(sync_playlist(playlist_id) for playlist_id in playlist_ids)
@@ -0,0 +1,21 @@
+"""Helpers shared by the tests"""
+
+from contextlib import contextmanager
+from sqlalchemy import event
+
+from models import db
+
+
+@contextmanager
+def count_statements():
+  """Collect the SQL statements run inside the block. Yields the list they're added to"""
+
+  statements = []
+  def count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+  event.listen(db.engine, 'before_cursor_execute', count_statement)
+  try:
+    yield statements
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', count_statement)
@@ -0,0 +1,424 @@
+from unittest import TestCase
+from unittest.mock import patch
+from datetime import timedelta
+
+from api.api_routes import handle_message
+from app import create_app
+from cache import clear_caches
+from models import GuestUser, HostUser, InboundMessage, Playlist, PlaylistTrack, ReceivedMessage, Track, db
+from sqlalchemy import event, func, select
+import jobs
+import sms
+import worker
+from message_parser import parse_message
+from spotify_client import SpotifyRateLimited
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+track_link = 'https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC'
+
+
+def queue_message(phone_number, body):
+  """Queue a text message the way the webhook does. Returns its id"""
+
+  jobs.receive_message(message_sid=None, phone_number=phone_number, body=body, response='<Response/>', key=parse_message(body).key)
+  return db.session.scalar(select(func.max(InboundMessage.id)))
+
+
+class QueueTestCase(TestCase):
+  """Empties the queue and forgets received MessageSids after each test"""
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    InboundMessage.query.delete()
+    ReceivedMessage.query.delete()
+    GuestUser.query.filter_by(id='+12345678').delete()
+    db.session.commit()
+    jobs.received_responses.clear()
+
+
+class ReceiveSmsTests(QueueTestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.client = app.test_client()
+
+  def test_message_is_queued(self):
+    """Verify messages with a link are saved to the queue instead of being processed"""
+
+    with patch('api.api_routes.handle_message') as handle_message:
+      response = self.client.post('/api/receive_sms', data={'From': '+12345678', 'Body': f"listen {track_link}"})
+
+    self.assertEqual(response.status_code, 200)
+    self.assertIn(b'<Response', response.data)
+    handle_message.assert_not_called()
+
+    message = InboundMessage.query.one()
+    self.assertEqual(message.phone_number, '+12345678')
+    self.assertEqual(message.status, jobs.PENDING)
+
+  def test_chatter_is_not_queued(self):
+    """Verify messages without a key or link are ignored"""
+
+    response = self.client.post('/api/receive_sms', data={'From': '+12345678', 'Body': 'hello'})
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(InboundMessage.query.count(), 0)
+
+
+  def test_retried_delivery_is_not_queued_again(self):
+    """Verify a delivery Twilio retries gets the first response without queueing the message again"""
+
+    form = {'From': '+12345678', 'Body': f"listen {track_link}", 'MessageSid': 'SM_test_retry'}
+    first = self.client.post('/api/receive_sms', data=form)
+    retry = self.client.post('/api/receive_sms', data=form)
+
+    jobs.received_responses.clear() # As if the retry reached another process
+    with patch('jobs.db.session.add') as add:
+      other_process_retry = self.client.post('/api/receive_sms', data=form)
+
+    self.assertEqual(retry.data, first.data)
+    self.assertEqual(other_process_retry.data, first.data)
+    add.assert_not_called()
+    self.assertEqual(InboundMessage.query.count(), 1)
+
+  def test_old_message_sids_are_purged(self):
+    """Verify MessageSids older than the ttl are removed"""
+
+    db.session.add_all([
+      ReceivedMessage(sid='SM_test_old', response='<Response/>', received_at=db.func.now() - timedelta(seconds=jobs.MESSAGE_SID_TTL_SECONDS + 60)),
+      ReceivedMessage(sid='SM_test_new', response='<Response/>')
+    ])
+    db.session.commit()
+
+    self.assertEqual(jobs.purge_received_messages(), 1)
+    self.assertEqual([message.sid for message in ReceivedMessage.query], ['SM_test_new'])
+
+
+class HandleMessageTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.host_user = HostUser(id='handle_test_host', display_name='handle tester', email='handle_test_host@example.com',
+      url='https://open.spotify.com/user/handle_test_host', access_token='token')
+    self.playlist = Playlist(id='handle_party', title='Party', key='handleparty', url='https://open.spotify.com/playlist/handle_party',
+      endpoint='https://api.spotify.com/v1/playlists/handle_party', owner=self.host_user)
+    db.session.add_all([self.host_user, self.playlist, GuestUser(id='+1erin', phone_number='+1erin', active_playlist_id='handle_party')])
+    db.session.commit()
+    clear_caches()
+
+    self.texts = patch('sms.send_message').start()
+    self.api_call = patch('spotify.make_authorized_api_call', side_effect=self.fake_api_call).start()
+    self.addCleanup(patch.stopall)
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    PlaylistTrack.query.delete()
+    Track.query.delete()
+    GuestUser.query.filter(GuestUser.id.in_(['+1erin', '+1frank'])).delete(synchronize_session=False)
+    Playlist.query.filter_by(id='handle_party').delete()
+    HostUser.query.filter_by(id='handle_test_host').delete()
+    GuestUser.query.filter_by(id='handle_test_host').delete()
+    db.session.commit()
+    clear_caches()
+
+  def fake_api_call(self, host_user, endpoint, method='POST', params=None, **kwargs):
+    """Stand in for make_authorized_api_call that accepts every add and knows every track"""
+
+    if method == 'GET':
+      return {'tracks': [{'id': track_id, 'name': f"Song {track_id}", 'artists': [{'name': 'Artist'}]} for track_id in params['ids'].split(',')]}
+    return {'snapshot_id': 'abc'}
+
+  def posts(self):
+    return [call for call in self.api_call.call_args_list if call.kwargs.get('method', 'POST') == 'POST']
+
+  def text_bodies(self):
+    return [call.kwargs['body'] for call in self.texts.call_args_list]
+
+  def test_key_joins_the_playlist(self):
+    """Verify a guest who texts a playlist's key makes it their active playlist and is told so"""
+
+    handle_message(phone_number='+1frank', message='join #HandleParty')
+    db.session.commit()
+
+    self.assertEqual(GuestUser.query.get('+1frank').active_playlist_id, 'handle_party')
+    self.assertEqual(len(self.text_bodies()), 1)
+    self.assertIn('Success!', self.text_bodies()[0])
+    self.api_call.assert_not_called()
+
+  def test_link_is_added_to_the_active_playlist(self):
+    """Verify a link from a guest with an active playlist is added to it without a reply"""
+
+    handle_message(phone_number='+1erin', message=f"listen {track_link}")
+    db.session.commit()
+
+    self.assertEqual(len(self.posts()), 1)
+    self.assertEqual(self.posts()[0].kwargs['json'], {'uris': ['spotify:track:4uLU6hMCjMI75M1A2tKUQC']})
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id='handle_party').one().added_by, '+1erin')
+    self.texts.assert_not_called()
+
+  def test_tracks_on_the_playlist_are_skipped(self):
+    """Verify a link to a track that's already on the playlist isn't sent to Spotify again"""
+
+    handle_message(phone_number='+1erin', message=track_link)
+    db.session.commit()
+    handle_message(phone_number='+1erin', message=track_link)
+    db.session.commit()
+
+    self.assertEqual(len(self.posts()), 1)
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id='handle_party').count(), 1)
+
+  def test_guest_without_a_playlist_is_asked_for_a_key(self):
+    """Verify a link from a guest who hasn't joined a playlist gets a reply asking for a key"""
+
+    handle_message(phone_number='+1frank', message=track_link)
+    db.session.commit()
+
+    self.assertEqual(len(self.text_bodies()), 1)
+    self.assertIn('Which playlist', self.text_bodies()[0])
+    self.api_call.assert_not_called()
+    self.assertEqual(PlaylistTrack.query.count(), 0)
+
+  def test_guest_is_told_about_the_track_limit(self):
+    """Verify a guest whose message reaches MAX_TRACKS_PER_MESSAGE is told only that many were added"""
+
+    links = ' '.join(f"https://open.spotify.com/track/{track_id}" for track_id in ['4uLU6hMCjMI75M1A2tKUQC', '7ouMYWpwJ422jRcDASZB7P'])
+    with patch('api.api_routes.MAX_TRACKS_PER_MESSAGE', 2):
+      handle_message(phone_number='+1erin', message=links)
+    db.session.commit()
+
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id='handle_party').count(), 2)
+    self.assertEqual(self.text_bodies(), ["That's a lot of songs! Only the first 2 were added."])
+
+
+class WorkerTests(QueueTestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.message_id = queue_message(phone_number='+12345678', body='#party')
+
+  def test_processed_message_is_removed(self):
+    """Verify the worker hands the message to handle_message and removes it from the queue"""
+
+    with patch('worker.handle_message') as handle_message:
+      self.assertTrue(worker.process_next_message(app))
+
+    handle_message.assert_called_once()
+    self.assertEqual(handle_message.call_args.kwargs['phone_number'], '+12345678')
+    self.assertEqual(handle_message.call_args.kwargs['message'], '#party')
+    self.assertEqual(InboundMessage.query.count(), 0)
+    self.assertFalse(worker.process_next_message(app)) # Queue is empty
+
+  def test_message_is_committed_once(self):
+    """Verify the message's changes are committed together with its removal from the queue"""
+
+    commits = []
+    def count_commit(session):
+      commits.append(session)
+
+    def handle_message(phone_number, message, **kwargs):
+      db.session.add(GuestUser(id=phone_number, phone_number=phone_number))
+
+    event.listen(db.session, 'after_commit', count_commit)
+    try:
+      with patch('worker.handle_message', side_effect=handle_message):
+        worker.process_next_message(app)
+    finally:
+      event.remove(db.session, 'after_commit', count_commit)
+
+    self.assertEqual(len(commits), 2) # Claiming the message, then everything else
+    self.assertEqual(InboundMessage.query.count(), 0)
+    self.assertIsNotNone(GuestUser.query.get('+12345678'))
+
+  def test_deferred_message_keeps_its_progress(self):
+    """Verify what a message got done before Spotify asked us to slow down is kept"""
+
+    def handle_message(phone_number, message, **kwargs):
+      db.session.add(GuestUser(id=phone_number, phone_number=phone_number))
+      raise SpotifyRateLimited('429', retry_after=30)
+
+    with patch('worker.handle_message', side_effect=handle_message):
+      worker.process_next_message(app)
+
+    db.session.expire_all()
+    self.assertIsNotNone(GuestUser.query.get('+12345678'))
+    self.assertEqual(InboundMessage.query.get(self.message_id).status, jobs.PENDING)
+
+  def test_replies_are_sent_once_the_message_is_committed(self):
+    """Verify texts a message sends are held back until it's done, so a retry doesn't send them twice"""
+
+    attempts = []
+    def handle_message(phone_number, message, **kwargs):
+      sms.send_message(phone_number, body='Success!')
+      attempts.append(phone_number)
+      if len(attempts) == 1:
+        raise SpotifyRateLimited('429', retry_after=30)
+
+    with patch('worker.handle_message', side_effect=handle_message), patch('sms.dispatcher') as dispatcher:
+      worker.process_next_message(app)
+      dispatcher.send.assert_not_called()
+
+      self.make_ready()
+      worker.process_next_message(app)
+
+    dispatcher.send.assert_called_once_with(to='+12345678', body='Success!')
+    self.assertEqual(InboundMessage.query.count(), 0)
+
+  def test_retry_starts_after_the_tracks_already_added(self):
+    """Verify the tracks a deferred message got added are counted, and the retry is told to skip them"""
+
+    skipped = []
+    def handle_message(phone_number, message, tracks_done=0, record_progress=None):
+      skipped.append(tracks_done)
+      record_progress(tracks_done + 100) # Another batch made it to Spotify
+      raise SpotifyRateLimited('429', retry_after=30)
+
+    with patch('worker.handle_message', side_effect=handle_message):
+      worker.process_next_message(app)
+      self.make_ready()
+      worker.process_next_message(app)
+
+    db.session.expire_all()
+    self.assertEqual(skipped, [0, 100])
+    self.assertEqual(InboundMessage.query.get(self.message_id).tracks_done, 200)
+
+  def test_running_message_is_kept_locked(self):
+    """Verify a message that runs past LOCK_TIMEOUT_SECONDS isn't reclaimed while its worker is alive"""
+
+    def handle_message(phone_number, message, **kwargs):
+      self.assertEqual(worker.running, {self.message_id})
+      InboundMessage.query.filter_by(id=self.message_id) \
+        .update({'locked_at': db.func.now() - timedelta(seconds=jobs.LOCK_TIMEOUT_SECONDS + 1)}, synchronize_session=False)
+      db.session.commit() # As if it had been running that long
+
+      jobs.extend_locks(list(worker.running)) # The heartbeat thread comes round
+      self.assertIsNone(jobs.claim_message())
+
+    with patch('worker.handle_message', side_effect=handle_message):
+      worker.process_next_message(app)
+
+    self.assertEqual(worker.running, set())
+    self.assertEqual(InboundMessage.query.count(), 0)
+
+  def make_ready(self):
+    """Let the message be claimed again without waiting out its delay"""
+
+    InboundMessage.query.filter_by(id=self.message_id).update({'run_at': db.func.now()})
+    db.session.commit()
+
+  def test_failed_message_is_retried_later(self):
+    """Verify a failed message goes back in the queue with a delay"""
+
+    with patch('worker.handle_message', side_effect=RuntimeError('Spotify is down')):
+      worker.process_next_message(app)
+
+    message = InboundMessage.query.get(self.message_id)
+    self.assertEqual(message.status, jobs.PENDING)
+    self.assertEqual(message.attempts, 1)
+    self.assertIn('Spotify is down', message.last_error)
+    self.assertIsNone(jobs.claim_message()) # Not ready until the backoff has passed
+
+  def test_rate_limited_message_is_deferred(self):
+    """Verify a message Spotify asked us to slow down for is retried without using up an attempt"""
+
+    with patch('worker.handle_message', side_effect=SpotifyRateLimited('429', retry_after=30)):
+      worker.process_next_message(app)
+
+    message = InboundMessage.query.get(self.message_id)
+    self.assertEqual(message.status, jobs.PENDING)
+    self.assertEqual(message.attempts, 0)
+
+  def test_message_is_dead_lettered(self):
+    """Verify a message that keeps failing is dead-lettered after MAX_ATTEMPTS"""
+
+    InboundMessage.query.filter_by(id=self.message_id).update({'attempts': jobs.MAX_ATTEMPTS - 1})
+    db.session.commit()
+
+    with patch('worker.handle_message', side_effect=RuntimeError('Spotify is down')):
+      worker.process_next_message(app)
+
+    db.session.expire_all()
+    self.assertEqual(InboundMessage.query.get(self.message_id).status, jobs.DEAD)
+
+
+class LaneTests(QueueTestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    host_user = HostUser(id='lane_test_host', display_name='lane tester', email='lane_test_host@example.com',
+      url='https://open.spotify.com/user/lane_test_host')
+    playlist = Playlist(id='lane_party', title='Party', key='laneparty', url='https://open.spotify.com/playlist/lane_party',
+      endpoint='https://api.spotify.com/v1/playlists/lane_party', owner=host_user)
+    guests = [GuestUser(id=phone_number, phone_number=phone_number, active_playlist_id='lane_party') for phone_number in ('+1alice', '+1bob')]
+    db.session.add_all([host_user, playlist, *guests])
+    db.session.commit()
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    super().tearDown()
+    GuestUser.query.filter(GuestUser.id.in_(['+1alice', '+1bob'])).delete(synchronize_session=False)
+    Playlist.query.filter_by(id='lane_party').delete()
+    HostUser.query.filter_by(id='lane_test_host').delete()
+    GuestUser.query.filter_by(id='lane_test_host').delete()
+    db.session.commit()
+
+  def test_messages_are_queued_in_their_playlists_lane(self):
+    """Verify a message's lane is the playlist of its key, else the sender's active playlist, else the phone number"""
+
+    client = app.test_client()
+    client.post('/api/receive_sms', data={'From': '+1alice', 'Body': track_link})
+    client.post('/api/receive_sms', data={'From': '+1carol', 'Body': 'join #LaneParty'})
+    client.post('/api/receive_sms', data={'From': '+1dave', 'Body': track_link})
+
+    lanes = {message.phone_number: message.lane for message in InboundMessage.query}
+    self.assertEqual(lanes, {'+1alice': 'lane_party', '+1carol': 'lane_party', '+1dave': '+1dave'})
+
+  def test_one_message_per_lane_at_a_time(self):
+    """Verify a playlist's messages are claimed in order, one at a time, while other lanes carry on"""
+
+    first = queue_message('+1alice', track_link)
+    second = queue_message('+1bob', track_link)
+    other_lane = queue_message('+1dave', track_link)
+
+    self.assertEqual(jobs.claim_message().id, first)
+    self.assertEqual(jobs.claim_message().id, other_lane)
+    self.assertIsNone(jobs.claim_message()) # second waits for first
+
+    jobs.complete_message(first)
+    self.assertEqual(jobs.claim_message().id, second)
+
+  def test_messages_from_one_phone_stay_in_order(self):
+    """Verify a sender's messages are claimed in order even when they're in different lanes"""
+
+    key = queue_message('+1dave', '#laneparty')
+    queue_message('+1dave', track_link) # Queued in dave's own lane, his key hasn't been handled yet
+
+    self.assertEqual(jobs.claim_message().id, key)
+    self.assertIsNone(jobs.claim_message())
+
+  def test_dead_messages_do_not_block_their_lane(self):
+    """Verify a dead-lettered message doesn't hold up the messages behind it"""
+
+    first = queue_message('+1alice', track_link)
+    second = queue_message('+1bob', track_link)
+    InboundMessage.query.filter_by(id=first).update({'status': jobs.DEAD})
+    db.session.commit()
+
+    self.assertEqual(jobs.claim_message().id, second)
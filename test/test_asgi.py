@@ -0,0 +1,96 @@
+from unittest import IsolatedAsyncioTestCase
+from urllib.parse import urlencode
+
+from app import create_app
+from models import InboundMessage, ReceivedMessage, db
+import asgi
+import jobs
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+track_link = 'https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC'
+
+
+class ReceiveSmsTests(IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    """Before every test"""
+
+    self.app = asgi.create_app({'DATABASE_URL': 'postgresql:///spotify_sms_playlist_test'})
+
+  async def asyncTearDown(self):
+    """Clean up test database"""
+
+    await self.app.engine.dispose()
+    db.session.rollback()
+    InboundMessage.query.delete()
+    ReceivedMessage.query.delete()
+    db.session.commit()
+    jobs.received_responses.clear()
+
+  async def request(self, method, path, form=None):
+    """Send one request through the app. Returns its status and body"""
+
+    body = urlencode(form or {}).encode()
+    requests = [{'type': 'http.request', 'body': body[:10], 'more_body': True}, {'type': 'http.request', 'body': body[10:]}]
+    sent = []
+
+    async def receive():
+      return requests.pop(0)
+
+    async def send(message):
+      sent.append(message)
+
+    await self.app({'type': 'http', 'method': method, 'path': path, 'headers': []}, receive, send)
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+  async def test_message_is_queued(self):
+    """Verify messages with a link are saved to the queue"""
+
+    status, body = await self.request('POST', '/api/receive_sms', {'From': '+12345678', 'Body': f"listen {track_link}"})
+
+    self.assertEqual(status, 200)
+    self.assertIn(b'<Response', body)
+
+    message = InboundMessage.query.one()
+    self.assertEqual(message.phone_number, '+12345678')
+    self.assertEqual(message.status, jobs.PENDING)
+
+  async def test_chatter_is_not_queued(self):
+    """Verify messages without a key or link are ignored"""
+
+    status, body = await self.request('POST', '/api/receive_sms', {'From': '+12345678', 'Body': 'hello'})
+
+    self.assertEqual(status, 200)
+    self.assertEqual(InboundMessage.query.count(), 0)
+
+  async def test_retried_delivery_is_not_queued_again(self):
+    """Verify a delivery Twilio retries gets the first response without queueing the message again"""
+
+    form = {'From': '+12345678', 'Body': f"listen {track_link}", 'MessageSid': 'SM_test_retry'}
+    first = await self.request('POST', '/api/receive_sms', form)
+    retry = await self.request('POST', '/api/receive_sms', form)
+
+    jobs.received_responses.clear() # As if the retry reached another process
+    other_process_retry = await self.request('POST', '/api/receive_sms', form)
+
+    self.assertEqual(retry, first)
+    self.assertEqual(other_process_retry, first)
+    self.assertEqual(InboundMessage.query.count(), 1)
+    self.assertEqual(ReceivedMessage.query.one().sid, 'SM_test_retry')
+
+  async def test_bad_requests(self):
+    """Verify missing fields, other methods and other paths are refused"""
+
+    self.assertEqual((await self.request('POST', '/api/receive_sms', {'From': '+12345678'}))[0], 400)
+    self.assertEqual((await self.request('GET', '/api/receive_sms'))[0], 405)
+    self.assertEqual((await self.request('GET', '/user'))[0], 404)
+    self.assertEqual(InboundMessage.query.count(), 0)
@@ -0,0 +1,140 @@
+from unittest import TestCase
+from unittest.mock import patch
+import threading
+import time
+
+from app import create_app
+from models import GuestUser, HostUser, Playlist, db
+from sqlalchemy import text
+import cache
+from test.helpers import count_statements
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+
+class TTLCacheTests(TestCase):
+
+  def test_least_recently_used_entry_is_evicted(self):
+    """Verify the cache stays under maxsize by dropping the entry used longest ago"""
+
+    ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2)
+    ttl_cache.get('a')
+    ttl_cache.set('c', 3)
+
+    self.assertEqual(ttl_cache.get('a'), 1)
+    self.assertIs(ttl_cache.get('b'), cache.MISSING)
+    self.assertEqual(ttl_cache.stats(), {'hits': 2, 'misses': 1, 'size': 2})
+
+  def test_entries_expire(self):
+    """Verify entries are dropped once their ttl has passed"""
+
+    ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+    ttl_cache.set('a', 1)
+
+    with patch('cache.time.monotonic', return_value=time.monotonic() + 61):
+      self.assertIs(ttl_cache.get('a'), cache.MISSING)
+
+
+class CachedLookupTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    cache.clear_caches()
+    self.host_user = HostUser(id='cache_test_host',
+      display_name='cache tester',
+      email='cache_test_host@example.com',
+      url='https://open.spotify.com/user/cache_test_host')
+    self.playlist = Playlist(id='cache_party', title='Party', key='cacheparty', url='https://open.spotify.com/playlist/cache_party',
+      endpoint='https://api.spotify.com/v1/playlists/cache_party', owner=self.host_user)
+    self.guest_user = GuestUser(id='+15555550101', phone_number='+15555550101', active_playlist_id='cache_party')
+    db.session.add_all([self.host_user, self.playlist, self.guest_user])
+    db.session.commit()
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    GuestUser.query.filter_by(id='+15555550101').delete()
+    Playlist.query.filter_by(id='cache_party').delete()
+    HostUser.query.filter_by(id='cache_test_host').delete()
+    GuestUser.query.filter_by(id='cache_test_host').delete()
+    db.session.commit()
+    cache.clear_caches()
+
+  def test_cached_lookups_do_not_query(self):
+    """Verify repeat lookups are served from the cache as usable persistent objects"""
+
+    cache.get_playlist_by_key('cacheparty')
+    cache.get_guest_user_by_phone('+15555550101')
+    db.session.remove() # Next message, new session
+
+    with count_statements() as statements:
+      playlist = cache.get_playlist_by_key('cacheparty')
+      guest_user = cache.get_guest_user_by_phone('+15555550101')
+
+    self.assertEqual(statements, [])
+    self.assertEqual(playlist.title, 'Party')
+    self.assertIn(guest_user, db.session)
+    self.assertEqual(cache.cache_stats()['playlists_by_key']['hits'], 1)
+
+    # Changes to a cached object are saved normally
+    guest_user.active_playlist_id = None
+    db.session.commit()
+    self.assertIsNone(GuestUser.query.get('+15555550101').active_playlist_id)
+
+  def test_invalidate_playlist(self):
+    """Verify invalidating a playlist forgets it and the guest users who have it active, once the change is committed"""
+
+    cache.get_playlist('cache_party')
+    cache.get_playlist_by_key('cacheparty')
+    cache.get_guest_user_by_phone('+15555550101')
+
+    cache.invalidate_playlist(self.playlist)
+    self.assertEqual(cache.cache_stats()['playlists_by_id']['size'], 1) # Another thread would cache the old row again until then
+    db.session.commit()
+
+    self.assertEqual(cache.cache_stats()['playlists_by_id']['size'], 0)
+    self.assertEqual(cache.cache_stats()['playlists_by_key']['size'], 0)
+    self.assertEqual(cache.cache_stats()['guest_users_by_phone']['size'], 0)
+
+  def test_rolled_back_invalidation_keeps_the_entry(self):
+    """Verify a change that's rolled back doesn't forget the cached row, or a later commit's"""
+
+    cache.get_guest_user_by_phone('+15555550101')
+
+    cache.invalidate_guest_user('+15555550101')
+    db.session.rollback()
+    db.session.commit()
+
+    self.assertEqual(cache.cache_stats()['guest_users_by_phone']['size'], 1)
+
+  def test_invalidations_reach_other_processes(self):
+    """Verify an invalidation committed elsewhere is received over LISTEN/NOTIFY"""
+
+    with patch('cache.CACHE_NOTIFY_CHANNEL', 'cache_test'):
+      url = db.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+      threading.Thread(target=cache.listen, args=(url,), daemon=True).start()
+      time.sleep(0.5) # Give the listener time to connect
+      cache.get_guest_user_by_phone('+15555550101')
+
+      # Another process changes the guest user
+      with db.engine.begin() as connection:
+        connection.execute(text("""SELECT pg_notify('cache_test', '{"phone_number": "+15555550101"}')"""))
+
+      for i in range(50):
+        if not cache.cache_stats()['guest_users_by_phone']['size']:
+          break
+        time.sleep(0.1)
+
+    self.assertEqual(cache.cache_stats()['guest_users_by_phone']['size'], 0)
@@ -0,0 +1,168 @@
+from unittest import TestCase
+from unittest.mock import patch
+from datetime import timedelta
+
+from app import create_app
+from models import GuestUser, HostUser, PendingAdd, Playlist, PlaylistTrack, Track, db
+from sqlalchemy import func, select, update
+from spotify import PLAYLIST_LOCK_NAMESPACE
+from spotify_client import SpotifyRateLimited
+import coalesce
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+
+def fake_api_call(host_user, endpoint, method='POST', params=None, **kwargs):
+  """Stand in for make_authorized_api_call that accepts every add and knows every track"""
+
+  if method == 'GET':
+    return {'tracks': [{'id': track_id, 'name': f"Song {track_id}", 'artists': [{'name': 'Artist'}]} for track_id in params['ids'].split(',')]}
+  return {'snapshot_id': 'abc'}
+
+
+class CoalesceTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.host_user = HostUser(id='coalesce_test_host',
+      display_name='coalesce tester',
+      email='coalesce_test_host@example.com',
+      url='https://open.spotify.com/user/coalesce_test_host',
+      access_token='token')
+    self.playlist = Playlist(id='coalesce_party', title='Party', key='coalesceparty', url='https://open.spotify.com/playlist/coalesce_party',
+      endpoint='https://api.spotify.com/v1/playlists/coalesce_party', owner=self.host_user)
+    db.session.add_all([self.host_user, self.playlist])
+    db.session.commit()
+
+    self.api_call = patch('spotify.make_authorized_api_call', side_effect=fake_api_call).start()
+    self.notification = patch('coalesce.tracks_added_notification').start()
+    self.failed_notification = patch('coalesce.tracks_failed_notification').start()
+    self.addCleanup(patch.stopall)
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    PendingAdd.query.delete()
+    PlaylistTrack.query.delete()
+    Track.query.delete()
+    Playlist.query.delete()
+    HostUser.query.filter_by(id='coalesce_test_host').delete()
+    GuestUser.query.filter_by(id='coalesce_test_host').delete()
+    db.session.commit()
+    coalesce.deferred_until.clear()
+
+  def add_calls(self):
+    return [call.kwargs['json']['uris'] for call in self.api_call.call_args_list if call.kwargs.get('method', 'POST') == 'POST']
+
+  def test_burst_is_added_in_one_request(self):
+    """Verify texts from several people are added with one Spotify request, in the order they arrived, with one summary each"""
+
+    coalesce.buffer_tracks(self.playlist, ['a1', 'a2'], added_by='+1alice')
+    coalesce.buffer_tracks(self.playlist, ['b1'], added_by='+1bob')
+    coalesce.buffer_tracks(self.playlist, ['a3', 'b1'], added_by='+1alice')
+    db.session.commit()
+
+    with patch('coalesce.COALESCE_SUMMARY_TEXTS', True):
+      self.assertEqual(coalesce.flush_playlist('coalesce_party'), 5)
+
+    self.assertEqual(self.add_calls(), [['spotify:track:a1', 'spotify:track:a2', 'spotify:track:b1', 'spotify:track:a3']])
+    self.assertEqual({row.track_id: row.added_by for row in PlaylistTrack.query}, {'a1': '+1alice', 'a2': '+1alice', 'b1': '+1bob', 'a3': '+1alice'})
+    self.assertEqual(PendingAdd.query.count(), 0)
+    self.assertEqual(sorted((call.args[0], call.kwargs['added']) for call in self.notification.call_args_list), [('+1alice', 3), ('+1bob', 1)])
+
+  def test_playlists_are_due_after_the_window_or_when_full(self):
+    """Verify a playlist is flushed once its oldest track has waited long enough, or enough tracks are waiting"""
+
+    coalesce.buffer_tracks(self.playlist, ['a1', 'a2'], added_by='+1alice')
+    db.session.commit()
+
+    with patch('coalesce.COALESCE_WINDOW_SECONDS', 60):
+      self.assertEqual(coalesce.due_playlist_ids(), [])
+
+      with patch('coalesce.COALESCE_MAX_TRACKS', 2):
+        self.assertEqual(coalesce.due_playlist_ids(), ['coalesce_party'])
+
+      PendingAdd.query.update({'created_at': db.func.now() - timedelta(seconds=61)}, synchronize_session=False)
+      db.session.commit()
+      self.assertEqual(coalesce.due_playlist_ids(), ['coalesce_party'])
+
+  def test_rate_limited_flush_keeps_what_was_added(self):
+    """Verify batches Spotify added before it asked us to slow down are kept, and the rest waits its turn"""
+
+    coalesce.buffer_tracks(self.playlist, [f"track{i}" for i in range(150)], added_by='+1alice')
+    db.session.commit()
+
+    def rate_limit_second_add(host_user, endpoint, method='POST', params=None, **kwargs):
+      if method == 'POST' and len(self.add_calls()) > 1:
+        raise SpotifyRateLimited('429', retry_after=30)
+      return fake_api_call(host_user, endpoint, method=method, params=params)
+
+    self.api_call.side_effect = rate_limit_second_add
+    with patch('coalesce.COALESCE_WINDOW_SECONDS', 0.001), patch('coalesce.COALESCE_SUMMARY_TEXTS', True):
+      coalesce.flush_due()
+      self.assertEqual(coalesce.flush_due(), 0) # Waiting for Spotify
+
+    db.session.expire_all()
+    self.assertEqual(PlaylistTrack.query.count(), 100)
+    self.assertEqual([row.track_id for row in PendingAdd.query.order_by(PendingAdd.id)], [f"track{i}" for i in range(100, 150)])
+    self.assertIn('coalesce_party', coalesce.deferred_until)
+    self.notification.assert_called_once()
+
+  def test_summaries_are_off_by_default(self):
+    """Verify flushing doesn't text anyone unless summaries are turned on, as adds aren't confirmed without coalescing"""
+
+    coalesce.buffer_tracks(self.playlist, ['a1'], added_by='+1alice')
+    db.session.commit()
+
+    self.assertEqual(coalesce.flush_playlist('coalesce_party'), 1)
+    self.notification.assert_not_called()
+
+  def test_failing_flush_backs_off_then_gives_up(self):
+    """Verify a playlist that keeps failing is retried with backoff, then dead-lettered and its senders told"""
+
+    coalesce.buffer_tracks(self.playlist, ['a1', 'a2'], added_by='+1alice')
+    coalesce.buffer_tracks(self.playlist, ['b1'], added_by='+1bob')
+    db.session.commit()
+    self.api_call.side_effect = RuntimeError('refresh token revoked')
+
+    with patch('coalesce.COALESCE_WINDOW_SECONDS', 0.001), patch('coalesce.MAX_ATTEMPTS', 2):
+      coalesce.flush_due()
+      self.assertEqual(coalesce.due_playlist_ids(), []) # Backing off
+
+      PendingAdd.query.update({'run_at': db.func.now()}, synchronize_session=False)
+      db.session.commit()
+      coalesce.flush_due()
+      self.assertEqual(coalesce.due_playlist_ids(), []) # Dead-lettered
+
+    db.session.expire_all()
+    self.assertEqual([(row.attempts, 'refresh token revoked' in row.last_error) for row in PendingAdd.query], [(2, True)] * 3)
+    self.assertEqual(sorted((call.args[0], call.kwargs['failed']) for call in self.failed_notification.call_args_list), [('+1alice', 2), ('+1bob', 1)])
+
+  def test_flush_leaves_the_playlist_row_unlocked(self):
+    """Verify the web app can change a playlist while it's being flushed, and a second flush skips it"""
+
+    coalesce.buffer_tracks(self.playlist, ['a1'], added_by='+1alice')
+    db.session.commit()
+    during_flush = {}
+
+    def add_while_the_app_updates(host_user, endpoint, method='POST', params=None, **kwargs):
+      with db.engine.begin() as connection:
+        connection.exec_driver_sql("SET LOCAL lock_timeout = '1s'")
+        connection.execute(update(Playlist).where(Playlist.id == 'coalesce_party').values(allow_duplicates=True))
+        during_flush['locked'] = not connection.scalar(select(func.pg_try_advisory_xact_lock(PLAYLIST_LOCK_NAMESPACE, func.hashtext('coalesce_party'))))
+      return fake_api_call(host_user, endpoint, method=method, params=params)
+
+    self.api_call.side_effect = add_while_the_app_updates
+
+    self.assertEqual(coalesce.flush_playlist('coalesce_party'), 1)
+    self.assertTrue(during_flush['locked'])
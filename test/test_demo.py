@@ -1,5 +1,8 @@
 from unittest import TestCase
-from app import app
+from app import create_app
+
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test'}) # Test database
+
 
 class DemoTests(TestCase):
 
@@ -0,0 +1,83 @@
+import os
+from unittest import TestCase
+
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import upgrade
+from app import create_app
+from models import GuestUser, InboundMessage, Playlist, PlaylistTrack, db
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.dialects import postgresql
+
+MIGRATED_SCHEMA = 'migrated_test' # Built by the migrations, next to the tables the other tests create with db.create_all()
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'options': f"-c search_path={MIGRATED_SCHEMA}"}},
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+
+# Lookups made by the webhook and the UI on every request
+hot_queries = {
+  'guest user by phone number': select(GuestUser).filter_by(phone_number='+12345678'),
+  'guest users by active playlist': select(GuestUser).filter_by(active_playlist_id='playlist'),
+  'playlist by key': select(Playlist).filter(db.func.lower(Playlist.key) == 'party'),
+  'playlist by id': select(Playlist).filter_by(id='playlist'),
+  'playlists by owner': select(Playlist).filter_by(owner_id='host'),
+  'playlist tracks by playlist': select(PlaylistTrack).filter_by(playlist_id='playlist').order_by(PlaylistTrack.seq),
+  'playlist tracks by track': select(PlaylistTrack).filter_by(track_id='track'),
+  'earlier messages in a lane': select(InboundMessage).filter(InboundMessage.lane == 'playlist', InboundMessage.id < 100),
+  'earlier messages from a phone number': select(InboundMessage).filter(InboundMessage.phone_number == '+12345678', InboundMessage.id < 100),
+}
+
+
+class IndexTests(TestCase):
+  """Checks the schema `flask db upgrade` builds, since production's indexes come from the migrations"""
+
+  @classmethod
+  def setUpClass(cls):
+    """Migrate an empty schema to the latest revision"""
+
+    # Made before the app connects, so the schema is its default schema from the start
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+    with engine.begin() as connection:
+      connection.execute(text(f"DROP SCHEMA IF EXISTS {MIGRATED_SCHEMA} CASCADE"))
+      connection.execute(text(f"CREATE SCHEMA {MIGRATED_SCHEMA}"))
+    engine.dispose()
+
+    cls.app_context = app.app_context()
+    cls.app_context.push()
+    upgrade(directory=MIGRATIONS_DIRECTORY)
+
+  @classmethod
+  def tearDownClass(cls):
+    with db.engine.begin() as connection:
+      connection.execute(text(f"DROP SCHEMA {MIGRATED_SCHEMA} CASCADE"))
+    db.get_engine().dispose()
+    cls.app_context.pop()
+
+  def explain(self, query):
+    """Return the query plan Postgres would use if it had a choice between an index and a sequential scan"""
+
+    sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+    with db.engine.connect() as connection:
+      connection.execute(text('SET enable_seqscan = off')) # Tables are tiny in tests, so only scan when there's no index
+      return '\n'.join(row[0] for row in connection.execute(text(f"EXPLAIN {sql}")))
+
+  def test_hot_queries_use_indexes(self):
+    """Verify none of the hot path lookups fall back to a sequential scan"""
+
+    for name, query in hot_queries.items():
+      with self.subTest(name):
+        self.assertNotIn('Seq Scan', self.explain(query))
+
+  def test_migrations_match_the_models(self):
+    """Verify the migrated schema has every table, column and index the models declare"""
+
+    with db.engine.connect() as connection:
+      differences = compare_metadata(MigrationContext.configure(connection), db.metadata)
+
+    self.assertEqual(differences, [])
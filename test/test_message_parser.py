@@ -0,0 +1,124 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+import random
+import string
+
+import message_parser
+from message_parser import parse_message, resolve_short_links
+
+TRACK_ID = '4uLU6hMCjMI75M1A2tKUQC'
+ALBUM_ID = '1ATL5GLyefJaxhQzSPVrLX'
+PLAYLIST_ID = '37i9dQZF1DXcBWIGoYBM5M'
+
+
+class ParseMessageTests(TestCase):
+
+  def test_link_forms(self):
+    """Verify every form of track link a phone shares is found"""
+
+    messages = [
+      f"https://open.spotify.com/track/{TRACK_ID}",
+      f"https://open.spotify.com/track/{TRACK_ID}?si=abc123",
+      f"open.spotify.com/track/{TRACK_ID}",
+      f"http://open.spotify.com/track/{TRACK_ID}",
+      f"https://open.spotify.com/intl-de/track/{TRACK_ID}?si=abc",
+      f"https://open.spotify.com/intl-pt_br/track/{TRACK_ID}",
+      f"https://open.spotify.com/embed/track/{TRACK_ID}",
+      f"spotify:track:{TRACK_ID}",
+      f"play this!! https://open.spotify.com/track/{TRACK_ID}.",
+      f"(https://open.spotify.com/track/{TRACK_ID}), thanks",
+      f"https://open.spotify.com/track/{TRACK_ID}\nhttps://open.spotify.com/track/{TRACK_ID}",
+    ]
+    for message in messages:
+      with self.subTest(message=message):
+        self.assertEqual(parse_message(message).track_ids, [TRACK_ID])
+
+  def test_everything_in_one_message(self):
+    """Verify keys, tracks, albums, playlists and short links are found together, in order"""
+
+    parsed = parse_message(f"#Party spotify:album:{ALBUM_ID} https://open.spotify.com/playlist/{PLAYLIST_ID}?si=1 "
+                           f"https://spotify.link/aBc123XyZ https://open.spotify.com/track/{TRACK_ID} #other")
+
+    self.assertEqual(parsed.keys, ['party', 'other'])
+    self.assertEqual(parsed.key, 'party')
+    self.assertEqual(parsed.track_ids, [TRACK_ID])
+    self.assertEqual(parsed.album_ids, [ALBUM_ID])
+    self.assertEqual(parsed.playlist_ids, [PLAYLIST_ID])
+    self.assertEqual(parsed.short_links, ['https://spotify.link/aBc123XyZ'])
+
+  def test_keys(self):
+    """Verify keys are lowercased and cut at a '?' or a trailing '.', and a '#' inside a word isn't a key"""
+
+    self.assertEqual(parse_message('#Party?').key, 'party')
+    self.assertEqual(parse_message('##party').key, 'party')
+    self.assertEqual(parse_message('join #my-party.2024 now').key, 'my-party.2024')
+    self.assertEqual(parse_message('#party.').key, 'party')
+    self.assertEqual(parse_message('join #party... see you').key, 'party')
+    self.assertIsNone(parse_message('https://example.com/page#section').key)
+    self.assertIsNone(parse_message('# nope').key)
+    self.assertFalse(parse_message('hey whats the key'))
+
+  def test_fuzz(self):
+    """Verify random text never breaks the parser, and links planted in it are always found"""
+
+    rng = random.Random(12) # Fixed seed so failures can be reproduced
+    alphabet = string.ascii_letters + string.digits + string.punctuation + ' \n\t' + 'éü🎵'
+    separators = [' ', '\n', ' (', ', ', '! ']
+
+    for i in range(500):
+      noise = [''.join(rng.choice(alphabet) for i in range(rng.randint(0, 30))) for i in range(4)]
+      track_id = ''.join(rng.choice(string.ascii_letters + string.digits) for i in range(22))
+      link = rng.choice([
+        f"https://open.spotify.com/track/{track_id}",
+        f"https://open.spotify.com/intl-fr/track/{track_id}?si={noise[3][:5]}",
+        f"spotify:track:{track_id}",
+      ])
+      message = noise[0] + rng.choice(separators) + link + rng.choice(['', '.', '!', ')', '?', ' ']) + ' ' + noise[1] + ' #' + noise[2]
+
+      with self.subTest(message=message):
+        parsed = parse_message(message)
+        self.assertIn(track_id, parsed.track_ids)
+        for id in parsed.track_ids + parsed.album_ids + parsed.playlist_ids:
+          self.assertRegex(id, r'^[0-9A-Za-z]{22}$')
+        for key in parsed.keys:
+          self.assertRegex(key, r'^[\w.@+-]+$')
+          self.assertEqual(key, key.lower())
+
+
+class ResolveShortLinksTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    message_parser.short_links.clear()
+    self.response = Mock(url=f"https://open.spotify.com/track/{TRACK_ID}?si=xyz&utm_source=copy-link")
+    self.request = patch('message_parser.spotify_client.request', return_value=self.response).start()
+    self.addCleanup(patch.stopall)
+    self.addCleanup(message_parser.short_links.clear)
+
+  def test_short_links_are_resolved_once(self):
+    """Verify a short link is followed to the track it points to, and the result is cached"""
+
+    for i in range(2):
+      parsed = resolve_short_links(parse_message('spotify.link/aBc123XyZ'))
+      self.assertEqual(parsed.track_ids, [TRACK_ID])
+      self.assertEqual(parsed.short_links, [])
+
+    self.request.assert_called_once_with('HEAD', 'https://spotify.link/aBc123XyZ', allow_redirects=True)
+
+  def test_resolving_can_be_turned_off(self):
+    """Verify short links are left alone when RESOLVE_SHORT_LINKS is off"""
+
+    with patch('message_parser.RESOLVE_SHORT_LINKS', False):
+      parsed = resolve_short_links(parse_message('https://spotify.link/aBc123XyZ'))
+
+    self.assertEqual(parsed.track_ids, [])
+    self.request.assert_not_called()
+
+  def test_failed_resolves_are_not_cached(self):
+    """Verify a short link that couldn't be followed is tried again next time"""
+
+    self.request.side_effect = [ConnectionError(), self.response]
+
+    self.assertEqual(resolve_short_links(parse_message('https://spotify.link/aBc123XyZ')).track_ids, [])
+    self.assertEqual(resolve_short_links(parse_message('https://spotify.link/aBc123XyZ')).track_ids, [TRACK_ID])
@@ -0,0 +1,110 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from app import create_app
+from models import HostUser, db
+from prometheus_client import REGISTRY
+from sms import SmsDispatcher
+from spotify_client import CircuitBreaker, spotify_client
+from twilio.base.exceptions import TwilioRestException
+import cache
+import metrics
+import spotify
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+
+def sample(name, **labels):
+  """Current value of a metric sample, 0 if it hasn't been recorded"""
+
+  return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.client = app.test_client()
+
+  def test_routes_are_timed_by_template(self):
+    """Verify requests are counted under their route's template, not their url"""
+
+    before = sample('http_request_duration_seconds_count', method='GET', route='/user/<string:id>/all', status='302')
+    self.client.get('/user/not_a_playlist/all')
+
+    self.assertEqual(sample('http_request_duration_seconds_count', method='GET', route='/user/<string:id>/all', status='302'), before + 1)
+
+  def test_queries_are_timed(self):
+    """Verify SQL statements are timed by operation"""
+
+    before = sample('db_query_duration_seconds_count', operation='SELECT')
+    with app.app_context():
+      HostUser.query.filter_by(id='nobody').first()
+
+    self.assertEqual(sample('db_query_duration_seconds_count', operation='SELECT'), before + 1)
+
+  def test_spotify_calls_are_timed_by_endpoint(self):
+    """Verify Spotify calls are timed under the endpoint with its ids replaced"""
+
+    host_user = HostUser(id='metrics_host', access_token='token')
+    labels = {'method': 'POST', 'endpoint': '/v1/playlists/{id}/tracks', 'outcome': '201'}
+    before = sample('spotify_api_call_duration_seconds_count', **labels)
+
+    with patch('spotify.ensure_fresh_access_token'), patch('spotify.spotify_client.request', return_value=Mock(status_code=201)):
+      spotify.make_authorized_api_call(host_user, 'https://api.spotify.com/v1/playlists/37i9dQZF1DXcBWIGoYBM5M/tracks')
+
+    self.assertEqual(sample('spotify_api_call_duration_seconds_count', **labels), before + 1)
+
+  def test_failed_twilio_sends_are_not_counted_as_sent(self):
+    """Verify a send Twilio refuses is timed under the error, and one it accepts under sent"""
+
+    before_sent = sample('twilio_send_duration_seconds_count', outcome='sent')
+    before_failed = sample('twilio_send_duration_seconds_count', outcome='TwilioRestException')
+
+    with patch('sms.client') as client:
+      SmsDispatcher(messages_per_second=0).deliver('+12345678', 'hi')
+      client.messages.create.side_effect = TwilioRestException(400, '/Messages')
+      with self.assertRaises(TwilioRestException):
+        SmsDispatcher(messages_per_second=0).deliver('not a number', 'hi')
+
+    self.assertEqual(sample('twilio_send_duration_seconds_count', outcome='sent'), before_sent + 1)
+    self.assertEqual(sample('twilio_send_duration_seconds_count', outcome='TwilioRestException'), before_failed + 1)
+
+  def test_client_and_cache_state_are_exported(self):
+    """Verify the circuit breakers, rate limits and cache counts are read when /metrics is scraped"""
+
+    with patch.dict(spotify_client.breakers, {'api.example.com': CircuitBreaker(failures=1)}):
+      spotify_client.breakers['api.example.com'].record_failure()
+      with patch.dict(cache.caches, {'example': Mock(stats=Mock(return_value={'hits': 3, 'misses': 1, 'size': 2}))}):
+        response = self.client.get('/metrics')
+
+    self.assertIn(b'spotify_circuit_breaker_state{host="api.example.com",state="open"} 1.0', response.data)
+    self.assertIn(b'spotify_circuit_breaker_failures{host="api.example.com"} 1.0', response.data)
+    self.assertIn(b'spotify_rate_limit_tokens ', response.data)
+    self.assertIn(b'cache_hits_total{cache="example"} 3.0', response.data)
+    self.assertIn(b'cache_entries{cache="example"} 2.0', response.data)
+
+  def test_metrics_endpoint(self):
+    """Verify /metrics serves the Prometheus text format, and requires the token when one is set"""
+
+    response = self.client.get('/metrics')
+    self.assertEqual(response.status_code, 200)
+    self.assertIn(b'# TYPE http_request_duration_seconds histogram', response.data)
+
+    with patch('metrics.METRICS_TOKEN', 'secret'):
+      self.assertEqual(self.client.get('/metrics').status_code, 401)
+      self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+  def test_endpoint_template(self):
+    self.assertEqual(metrics.endpoint_template('https://api.spotify.com/v1/albums/1ATL5GLyefJaxhQzSPVrLX/tracks?limit=50'), '/v1/albums/{id}/tracks')
+    self.assertEqual(metrics.endpoint_template('https://api.spotify.com/v1/tracks'), '/v1/tracks')
+    self.assertEqual(metrics.endpoint_template('https://api.spotify.com/v1/users/djobrad/playlists'), '/v1/users/{id}/playlists')
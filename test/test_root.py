@@ -1,7 +1,10 @@
 from unittest import TestCase
-from app import app
+from app import create_app
 from flask import session
 
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test'}) # Test database
+
+
 class RootTests(TestCase):
 
   def setUp(self):
@@ -0,0 +1,79 @@
+from unittest import TestCase
+from unittest.mock import patch
+import threading
+import time
+
+from prometheus_client import REGISTRY
+from twilio.base.exceptions import TwilioRestException
+from sms import SmsDispatcher
+
+
+class SmsDispatcherTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.client = patch('sms.client').start() # Don't send real messages
+    patch('sms.time.sleep').start() # Don't wait between sends or retries
+    self.addCleanup(patch.stopall)
+
+  def test_flush_waits_for_every_message(self):
+    """Verify flush returns once all queued messages were handed to Twilio"""
+
+    dispatcher = SmsDispatcher(max_workers=2, messages_per_second=0)
+    for i in range(5):
+      dispatcher.send(to='+12345678', body=f"message {i}")
+
+    self.assertTrue(dispatcher.flush(timeout=5))
+    self.assertEqual(self.client.messages.create.call_count, 5)
+    self.assertFalse(dispatcher.pending)
+
+  def test_transient_errors_are_retried(self):
+    """Verify a send that fails with a Twilio server error is tried again"""
+
+    self.client.messages.create.side_effect = [TwilioRestException(503, '/Messages'), 'sent']
+
+    future = SmsDispatcher(messages_per_second=0).send(to='+12345678', body='hi')
+
+    self.assertEqual(future.result(timeout=5), 'sent')
+    self.assertEqual(self.client.messages.create.call_count, 2)
+
+  def test_permanent_errors_are_not_retried(self):
+    """Verify a send rejected by Twilio (e.g. an invalid number) is not tried again"""
+
+    self.client.messages.create.side_effect = TwilioRestException(400, '/Messages')
+
+    future = SmsDispatcher(messages_per_second=0).send(to='not a number', body='hi')
+
+    self.assertIsInstance(future.exception(timeout=5), TwilioRestException)
+    self.assertEqual(self.client.messages.create.call_count, 1)
+
+  def test_messages_per_second_cap(self):
+    """Verify sends are given slots at least 1/messages_per_second apart"""
+
+    dispatcher = SmsDispatcher(messages_per_second=10)
+    start = time.monotonic()
+    for i in range(3):
+      dispatcher.wait_for_send_slot()
+
+    self.assertAlmostEqual(dispatcher.next_send_at - start, 0.3, delta=0.05)
+
+  def test_full_queue_blocks_then_drops(self):
+    """Verify send waits for room in a full queue, and drops the message if none is made in time"""
+
+    sending = threading.Event()
+    self.client.messages.create.side_effect = lambda **kwargs: sending.wait(5)
+    dispatcher = SmsDispatcher(max_workers=1, messages_per_second=0, max_queued=1, queue_wait=0.05)
+
+    self.assertIsNotNone(dispatcher.send(to='+12345678', body='being sent'))
+    self.assertIsNotNone(dispatcher.send(to='+12345678', body='queued'))
+    shed = REGISTRY.get_sample_value('sms_messages_shed_total')
+    self.assertIsNone(dispatcher.send(to='+12345678', body='dropped'))
+    self.assertEqual(REGISTRY.get_sample_value('sms_messages_shed_total'), shed + 1)
+
+    sending.set()
+    self.assertTrue(dispatcher.flush(timeout=5))
+    dispatcher.queue_wait = 5 # Room is made just after each send finishes
+    self.assertIsNotNone(dispatcher.send(to='+12345678', body='room again'))
+    self.assertTrue(dispatcher.flush(timeout=5))
+    self.assertEqual(self.client.messages.create.call_count, 3)
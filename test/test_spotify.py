@@ -0,0 +1,550 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from datetime import datetime, timedelta
+
+from app import create_app
+from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
+from sqlalchemy import func, select
+from message_parser import parse_message
+import spotify
+from requests.exceptions import Timeout
+from spotify_client import CircuitBreaker, SpotifyClient, SpotifyRateLimited, SpotifyServerError, SpotifyUnavailable, TokenBucket
+from test.helpers import count_statements
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+test_host_user_id = 'spotify_test_host'
+test_playlist_id = '6hKkMi8kOl44uM8AJUtw6s'
+
+
+def fake_track_data(track_id):
+  """Track data shaped like Spotify's track object"""
+
+  return {'id': track_id, 'name': f"Song {track_id}", 'artists': [{'name': 'Artist'}]}
+
+
+def fake_api_call(host_user, endpoint, method='POST', params=None, **kwargs):
+  """Stand in for make_authorized_api_call that accepts every add and knows every track"""
+
+  if method == 'GET':
+    return {'tracks': [fake_track_data(track_id) for track_id in params['ids'].split(',')]}
+  return {'snapshot_id': 'abc'}
+
+
+class PlaylistTestCase(TestCase):
+  """Creates a host user and playlist for each test"""
+
+  def setUp(self):
+    """Before every test"""
+
+    self.host_user = HostUser(id=test_host_user_id,
+      display_name='djobrad',
+      email='spotify_test_host@example.com',
+      url=f"https://open.spotify.com/user/{test_host_user_id}",
+      access_token='token')
+    self.playlist = Playlist(id=test_playlist_id,
+      title='test playlist',
+      key='test',
+      url=f"https://open.spotify.com/playlist/{test_playlist_id}",
+      endpoint=f"https://api.spotify.com/v1/playlists/{test_playlist_id}",
+      owner=self.host_user)
+
+    db.session.add_all([self.host_user, self.playlist])
+    db.session.commit()
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    PlaylistTrack.query.delete()
+    Track.query.delete()
+    Playlist.query.delete()
+    HostUser.query.filter_by(id=test_host_user_id).delete()
+    GuestUser.query.filter_by(id=test_host_user_id).delete()
+    db.session.commit()
+
+
+class AddTracksTests(PlaylistTestCase):
+
+  @patch('spotify.make_authorized_api_call')
+  def test_add_tracks_batches_uris(self, api_call):
+    """Verify every link is sent to Spotify in batches of at most 100 uris in the request body"""
+
+    track_ids = [f"track{i}" for i in range(150)]
+    api_call.side_effect = fake_api_call
+
+    outcomes = spotify.add_tracks_to_playlist(self.playlist, track_ids, added_by='+12345678')
+
+    posts = [call for call in api_call.call_args_list if call.kwargs.get('method', 'POST') == 'POST']
+    self.assertEqual(len(posts), 2)
+    self.assertEqual(len(posts[0].kwargs['json']['uris']), 100)
+    self.assertEqual(posts[1].kwargs['json']['uris'][-1], 'spotify:track:track149')
+    self.assertEqual(list(outcomes), track_ids)
+    self.assertTrue(all(outcome == spotify.TRACK_ADDED for outcome in outcomes.values()))
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id=test_playlist_id).count(), 150)
+
+  @patch('spotify.make_authorized_api_call')
+  def test_add_tracks_reports_failed_batches(self, api_call):
+    """Verify tracks in a rejected batch are reported as failed and not recorded"""
+
+    api_call.return_value = None
+
+    outcomes = spotify.add_tracks_to_playlist(self.playlist, ['one', 'two', 'one'])
+
+    self.assertEqual(outcomes, {'one': spotify.TRACK_FAILED, 'two': spotify.TRACK_FAILED})
+    self.assertEqual(PlaylistTrack.query.count(), 0)
+    self.assertEqual(Track.query.count(), 0)
+
+  @patch('spotify.ensure_fresh_access_token')
+  @patch('spotify.spotify_client')
+  def test_add_tracks_is_deferred_when_spotify_fails(self, client, ensure_fresh_access_token):
+    """Verify a batch Spotify failed or didn't answer is retried later instead of reported as failed"""
+
+    for failure in [Mock(status_code=503), Timeout('read timed out')]:
+      client.request.side_effect = [failure]
+
+      with self.assertRaises(SpotifyServerError):
+        spotify.add_tracks_to_playlist(self.playlist, ['one', 'two'], added_by='+12345678')
+
+    db.session.rollback()
+    self.assertEqual(PlaylistTrack.query.count(), 0)
+
+  @patch('spotify.make_authorized_api_call')
+  def test_tracks_on_playlist_are_skipped(self, api_call):
+    """Verify tracks already on the playlist are filtered out with one query, before calling Spotify"""
+
+    api_call.side_effect = fake_api_call
+    spotify.add_tracks_to_playlist(self.playlist, ['hit'], added_by='+12345678')
+    api_call.reset_mock()
+
+    with count_statements() as statements:
+      outcomes = spotify.add_tracks_to_playlist(self.playlist, ['hit'], added_by='+10000000')
+
+    self.assertEqual(outcomes, {'hit': spotify.TRACK_ON_PLAYLIST})
+    api_call.assert_not_called()
+    self.assertEqual(len([statement for statement in statements if 'playlist_tracks' in statement]), 1)
+    self.assertEqual(PlaylistTrack.query.filter_by(track_id='hit').one().added_by, '+12345678')
+
+  @patch('spotify.make_authorized_api_call')
+  def test_duplicates_can_be_allowed(self, api_call):
+    """Verify a playlist that allows duplicates sends tracks already on it to Spotify again"""
+
+    api_call.side_effect = fake_api_call
+    self.playlist.allow_duplicates = True
+    db.session.commit()
+
+    spotify.add_tracks_to_playlist(self.playlist, ['hit'])
+    outcomes = spotify.add_tracks_to_playlist(self.playlist, ['hit'])
+
+    self.assertEqual(outcomes, {'hit': spotify.TRACK_ADDED})
+    posts = [call for call in api_call.call_args_list if call.kwargs.get('method', 'POST') == 'POST']
+    self.assertEqual(len(posts), 2)
+    self.assertEqual(PlaylistTrack.query.filter_by(track_id='hit').count(), 1)
+
+
+  @patch('spotify.make_authorized_api_call')
+  def test_retry_skips_batches_already_added(self, api_call):
+    """Verify a retried add to a playlist that allows duplicates doesn't send the batches Spotify already took again"""
+
+    def fail_second_batch(host_user, endpoint, method='POST', json=None, **kwargs):
+      if method == 'POST' and json['uris'][0] == 'spotify:track:track100':
+        raise SpotifyServerError('503', retry_after=30)
+      return fake_api_call(host_user, endpoint, method, **kwargs)
+
+    api_call.side_effect = fail_second_batch
+    self.playlist.allow_duplicates = True
+    db.session.commit()
+    track_ids = [f"track{i}" for i in range(150)]
+    progress = []
+
+    with self.assertRaises(SpotifyServerError):
+      spotify.add_tracks_to_playlist(self.playlist, track_ids, record_progress=progress.append)
+    self.assertEqual(progress, [100])
+
+    api_call.reset_mock()
+    api_call.side_effect = fake_api_call
+    spotify.add_tracks_to_playlist(self.playlist, track_ids, tracks_done=progress[-1], record_progress=progress.append)
+
+    posts = [call for call in api_call.call_args_list if call.kwargs.get('method', 'POST') == 'POST']
+    self.assertEqual([len(call.kwargs['json']['uris']) for call in posts], [50])
+    self.assertEqual(progress, [100, 150])
+
+
+class GetOrCreateTracksTests(PlaylistTestCase):
+
+  @patch('spotify.make_authorized_api_call')
+  def test_known_tracks_are_not_requested(self, api_call):
+    """Verify only tracks missing from the database are requested, 50 ids at a time"""
+
+    db.session.add(Track(id='known', name='Known Song', artist='Artist'))
+    db.session.commit()
+    api_call.side_effect = fake_api_call
+
+    tracks = spotify.get_or_create_tracks(self.host_user, ['known'] + [f"track{i}" for i in range(60)])
+    db.session.commit()
+
+    self.assertEqual(api_call.call_count, 2)
+    requested_ids = [id for call in api_call.call_args_list for id in call.kwargs['params']['ids'].split(',')]
+    self.assertNotIn('known', requested_ids)
+    self.assertEqual(len(requested_ids), 60)
+    self.assertEqual(tracks['known'].name, 'Known Song')
+    self.assertEqual(tracks['track59'].name, 'Song track59')
+    self.assertEqual(Track.query.count(), 61)
+
+  @patch('spotify.make_authorized_api_call')
+  def test_unknown_tracks_are_left_out(self, api_call):
+    """Verify ids Spotify returns null for are not stored"""
+
+    api_call.return_value = {'tracks': [fake_track_data('real'), None]}
+
+    tracks = spotify.get_or_create_tracks(self.host_user, ['real', 'fake'])
+
+    self.assertEqual(list(tracks), ['real'])
+
+
+class MessageTrackIdsTests(PlaylistTestCase):
+
+  def fake_pages(self, host_user, endpoint, method='POST', params=None, **kwargs):
+    """Stand in for make_authorized_api_call serving a 250 track album and a playlist with a local file and an episode"""
+
+    if method == 'POST':
+      return {'snapshot_id': 'abc'}
+
+    if '/albums/' in endpoint:
+      offset = int(endpoint.split('offset=')[1]) if 'offset=' in endpoint else 0
+      self.album_pages_served += 1
+      return {
+        'items': [fake_track_data(f"album{i}") for i in range(offset, min(offset + 50, 250))],
+        'next': f"https://api.spotify.com/v1/albums/album/tracks?offset={offset + 50}" if offset + 50 < 250 else None
+      }
+
+    if '/playlists/' in endpoint:
+      local_file = dict(fake_track_data(None), type='track', is_local=True)
+      episode = dict(fake_track_data('episode'), type='episode', is_local=False)
+      return {
+        'items': [{'track': dict(fake_track_data('listed'), type='track', is_local=False)}, {'track': local_file}, {'track': episode}, {'track': None}],
+        'next': None
+      }
+
+    return fake_api_call(host_user, endpoint, method=method, params=params)
+
+  def setUp(self):
+    """Before every test"""
+
+    super().setUp()
+    self.album_pages_served = 0
+    self.api_call = patch('spotify.make_authorized_api_call', side_effect=self.fake_pages).start()
+    self.addCleanup(patch.stopall)
+
+  def test_albums_and_playlists_are_expanded(self):
+    """Verify linked tracks come first, then album and playlist tracks, saved from the pages without looking them up again"""
+
+    parsed = parse_message('https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC https://open.spotify.com/album/1ATL5GLyefJaxhQzSPVrLX '
+                           'spotify:playlist:37i9dQZF1DXcBWIGoYBM5M')
+
+    outcomes = spotify.add_tracks_to_playlist(self.playlist, spotify.get_message_track_ids(self.host_user, parsed))
+
+    track_ids = list(outcomes)
+    self.assertEqual(len(track_ids), 252)
+    self.assertEqual(track_ids[:2], ['4uLU6hMCjMI75M1A2tKUQC', 'album0'])
+    self.assertEqual(track_ids[-1], 'listed')
+    lookups = [call for call in self.api_call.call_args_list if call.kwargs['endpoint'] == spotify.SPOTIFY_API_URL + '/tracks']
+    self.assertEqual(len(lookups), 1) # Only the directly linked track
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id=test_playlist_id).count(), 252)
+
+  def test_pages_are_requested_as_needed(self):
+    """Verify pages past the per message limit are never requested"""
+
+    parsed = parse_message('https://open.spotify.com/album/1ATL5GLyefJaxhQzSPVrLX')
+
+    outcomes = spotify.add_tracks_to_playlist(self.playlist, spotify.get_message_track_ids(self.host_user, parsed, limit=120))
+
+    self.assertEqual(len(outcomes), 120)
+    self.assertEqual(self.album_pages_served, 3)
+
+
+class RefreshAccessTokenTests(PlaylistTestCase):
+
+  def token_response(self, access_token):
+    """Response from Spotify's token endpoint"""
+
+    return Mock(status_code=200, json=Mock(return_value={'access_token': access_token, 'expires_in': 3600}))
+
+  @patch('spotify.spotify_client')
+  def test_token_is_refreshed_before_it_expires(self, client):
+    """Verify a token about to expire is refreshed before the request instead of after a 401"""
+
+    self.host_user.token_expires_at = datetime.utcnow() + timedelta(seconds=10)
+    db.session.commit()
+    client.post.return_value = self.token_response('new token')
+    client.request.return_value = Mock(status_code=200, json=Mock(return_value={}))
+
+    spotify.make_authorized_api_call(self.host_user, 'https://api.spotify.com/v1/me', method='GET')
+
+    client.post.assert_called_once()
+    self.assertEqual(client.request.call_args.kwargs['headers'], {'Authorization': 'Bearer new token'})
+    db.session.expire_all()
+    self.assertEqual(HostUser.query.get(test_host_user_id).access_token, 'new token')
+    self.assertGreater(self.host_user.token_expires_at, datetime.utcnow() + timedelta(minutes=59))
+
+  @patch('spotify.spotify_client')
+  def test_token_refreshed_elsewhere_is_reused(self, client):
+    """Verify a token another worker already refreshed is used instead of refreshing again"""
+
+    self.host_user.token_expires_at = datetime.utcnow() - timedelta(seconds=10)
+    db.session.commit()
+    # Another worker refreshes the token behind this session's back
+    with db.engine.begin() as connection:
+      connection.execute(HostUser.__table__.update()
+        .where(HostUser.__table__.c.id == test_host_user_id)
+        .values(access_token='their token', token_expires_at=datetime.utcnow() + timedelta(hours=1)))
+
+    spotify.refresh_access_token(self.host_user)
+
+    client.post.assert_not_called()
+    self.assertEqual(self.host_user.access_token, 'their token')
+    self.assertNotIn(self.host_user, db.session.dirty)
+
+  @patch('spotify.spotify_client')
+  def test_failed_refresh_raises(self, client):
+    """Verify an error from the token endpoint is raised instead of saving a bad token"""
+
+    client.post.return_value = Mock(status_code=400, text='{"error": "invalid_grant"}')
+
+    with self.assertRaises(spotify.SpotifyAuthError):
+      spotify.refresh_access_token(self.host_user, force=True)
+
+    self.assertEqual(self.host_user.access_token, 'token')
+
+  def test_refresh_locks_are_shared_out(self):
+    """Verify a user always gets the same refresh lock, from a fixed set however many users there are"""
+
+    locks = {id(spotify.refresh_lock(f"host{i}")) for i in range(1000)}
+
+    self.assertIs(spotify.refresh_lock(test_host_user_id), spotify.refresh_lock(test_host_user_id))
+    self.assertLessEqual(len(locks), spotify.REFRESH_LOCK_STRIPES)
+
+
+class LockPlaylistTests(PlaylistTestCase):
+
+  @patch('spotify.make_authorized_api_call', side_effect=fake_api_call)
+  def test_playlist_is_held_until_the_adds_are_committed(self, make_authorized_api_call):
+    """Verify another transaction can't add to the playlist until this one's adds are committed"""
+
+    def lock_is_free():
+      with db.engine.connect() as connection:
+        return connection.scalar(select(func.pg_try_advisory_xact_lock(spotify.PLAYLIST_LOCK_NAMESPACE, func.hashtext(test_playlist_id))))
+
+    spotify.add_tracks_to_playlist(self.playlist, ['hit'], added_by='+12345678')
+    self.assertFalse(lock_is_free())
+
+    db.session.commit()
+    self.assertTrue(lock_is_free())
+
+
+class GetOrCreateUserTests(PlaylistTestCase):
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    GuestUser.query.filter_by(id='+15555550102').delete()
+    db.session.commit()
+    super().tearDown()
+
+  @patch('spotify.spotify_client')
+  def test_logging_in_again_updates_the_host_user(self, client):
+    """Verify a host user who logs in again gets new tokens and keeps their playlists"""
+
+    client.get.return_value = Mock(status_code=200, json=Mock(return_value={
+      'id': test_host_user_id,
+      'display_name': 'new name',
+      'email': 'spotify_test_host@example.com',
+      'external_urls': {'spotify': f"https://open.spotify.com/user/{test_host_user_id}"}
+    }))
+
+    host_user = spotify.get_or_create_host_user({'access_token': 'new token', 'refresh_token': 'refresh', 'expires_in': 3600})
+
+    db.session.expire_all()
+    self.assertEqual(host_user.display_name, 'new name')
+    self.assertEqual(host_user.access_token, 'new token')
+    self.assertEqual([playlist.id for playlist in host_user.playlists], [test_playlist_id])
+    self.assertEqual(HostUser.query.filter_by(id=test_host_user_id).count(), 1)
+
+  @patch('spotify.get_guest_user_by_phone', return_value=None)
+  def test_concurrent_first_texts_get_the_same_guest_user(self, get_guest_user_by_phone):
+    """Verify a guest user inserted by someone else at the same time is returned instead of raising"""
+
+    # Another worker creates the guest user after this one looked for it
+    with db.engine.begin() as connection:
+      connection.execute(GuestUser.__table__.insert().values(id='+15555550102', phone_number='+15555550102',
+        user_type='guest_users', active_playlist_id=test_playlist_id))
+
+    guest_user = spotify.get_or_create_guest_user('+15555550102')
+
+    self.assertEqual(guest_user.active_playlist_id, test_playlist_id)
+    self.assertEqual(GuestUser.query.filter_by(phone_number='+15555550102').count(), 1)
+
+
+class SpotifyClientTests(TestCase):
+
+  def test_session_is_reused(self):
+    """Verify requests share one pooled session per process"""
+
+    client = SpotifyClient(pool_maxsize=7)
+
+    self.assertIs(client.session, client.session)
+    self.assertEqual(client.session.get_adapter('https://api.spotify.com')._pool_maxsize, 7)
+
+  def test_requests_have_timeouts(self):
+    """Verify every request gets a connect and read timeout unless one is given"""
+
+    client = SpotifyClient(connect_timeout=1, read_timeout=2)
+
+    with patch.object(client.session, 'request', return_value=Mock(status_code=200)) as request:
+      client.get('https://api.spotify.com/v1/me')
+      client.post('https://accounts.spotify.com/api/token', timeout=5)
+
+    self.assertEqual(request.call_args_list[0].kwargs['timeout'], (1, 2))
+    self.assertEqual(request.call_args_list[1].kwargs['timeout'], 5)
+
+
+class RateLimitTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.client = SpotifyClient(max_wait=5)
+    self.request = patch.object(self.client.session, 'request').start()
+    self.sleep = patch('spotify_client.time.sleep').start()
+    self.addCleanup(patch.stopall)
+
+  def test_get_waits_out_retry_after(self):
+    """Verify a rate limited GET is retried after Retry-After"""
+
+    self.request.side_effect = [Mock(status_code=429, headers={'Retry-After': '2'}), Mock(status_code=200)]
+
+    response = self.client.get('https://api.spotify.com/v1/tracks', rate_limit_key='host')
+
+    self.assertEqual(response.status_code, 200)
+    self.assertGreaterEqual(max(call.args[0] for call in self.sleep.call_args_list), 1.9)
+
+  def test_post_is_deferred(self):
+    """Verify a rate limited POST raises so the caller can retry it later"""
+
+    self.request.return_value = Mock(status_code=429, headers={'Retry-After': '3'})
+
+    with self.assertRaises(SpotifyRateLimited) as raised:
+      self.client.post('https://api.spotify.com/v1/playlists/abc/tracks')
+
+    self.assertEqual(raised.exception.retry_after, 3)
+    self.assertEqual(self.request.call_count, 1)
+
+  def test_long_retry_after_is_deferred(self):
+    """Verify requests are deferred instead of blocking for longer than max_wait"""
+
+    self.request.return_value = Mock(status_code=429, headers={'Retry-After': '60'})
+
+    with self.assertRaises(SpotifyRateLimited):
+      self.client.get('https://api.spotify.com/v1/tracks')
+    with self.assertRaises(SpotifyRateLimited): # The bucket is paused for everyone
+      self.client.get('https://api.spotify.com/v1/me')
+
+    self.assertEqual(self.request.call_count, 1)
+
+  def test_server_errors_open_the_breaker(self):
+    """Verify the breaker fails fast after Spotify keeps failing"""
+
+    self.client.breakers['api.spotify.com'] = CircuitBreaker(failures=2, cooldown=30)
+    self.request.return_value = Mock(status_code=503)
+
+    response = self.client.post('https://api.spotify.com/v1/playlists/abc/tracks')
+    self.client.post('https://api.spotify.com/v1/playlists/abc/tracks')
+
+    self.assertEqual(response.status_code, 503)
+    with self.assertRaises(SpotifyUnavailable):
+      self.client.post('https://api.spotify.com/v1/playlists/abc/tracks')
+    self.assertEqual(self.request.call_count, 2)
+    self.assertEqual(self.client.state()['breakers']['api.spotify.com']['state'], CircuitBreaker.OPEN)
+
+  def test_retried_server_errors_count_once(self):
+    """Verify a GET that fails every retry is one failure for the breaker, not one per attempt"""
+
+    breaker = self.client.breakers['api.spotify.com'] = CircuitBreaker(failures=2, cooldown=30)
+    self.request.return_value = Mock(status_code=503)
+
+    response = self.client.get('https://api.spotify.com/v1/me')
+
+    self.assertEqual(response.status_code, 503)
+    self.assertEqual(self.request.call_count, self.client.max_retries + 1)
+    self.assertEqual(breaker.failures, 1)
+    self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+  def test_half_open_trial_is_retried(self):
+    """Verify a half open breaker's trial GET gets its retries, and closes the breaker when one succeeds"""
+
+    breaker = self.client.breakers['api.spotify.com'] = CircuitBreaker(failures=1, cooldown=0)
+    breaker.record_failure()
+    self.request.side_effect = [Mock(status_code=503), Mock(status_code=200)]
+
+    self.assertEqual(self.client.get('https://api.spotify.com/v1/me').status_code, 200)
+    self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+  def test_rate_limited_trial_does_not_hold_the_breaker_open(self):
+    """Verify a half open breaker's trial that's deferred by a rate limit lets the next request be the trial"""
+
+    breaker = self.client.breakers['api.spotify.com'] = CircuitBreaker(failures=1, cooldown=0)
+    breaker.record_failure()
+    self.client.app_bucket.pause(60)
+
+    with self.assertRaises(SpotifyRateLimited):
+      self.client.get('https://api.spotify.com/v1/me')
+
+    self.client.app_bucket.paused_until = 0
+    self.request.return_value = Mock(status_code=200)
+    self.assertEqual(self.client.get('https://api.spotify.com/v1/me').status_code, 200)
+    self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+  def test_rate_limited_user_gets_the_app_token_back(self):
+    """Verify a request deferred by its host's bucket doesn't use up a token from the app bucket"""
+
+    self.client.buckets('host')[1].pause(60)
+    tokens = self.client.app_bucket.tokens
+
+    with self.assertRaises(SpotifyRateLimited):
+      self.client.get('https://api.spotify.com/v1/me', rate_limit_key='host')
+
+    self.assertAlmostEqual(self.client.app_bucket.tokens, tokens, delta=0.01)
+    self.request.assert_not_called()
+
+  def test_idle_user_buckets_are_forgotten(self):
+    """Verify only the buckets of users who are rate limited or made a request recently are kept"""
+
+    self.client.sweep_size = 10
+    self.client.buckets('paused')[1].pause(60)
+    self.client.buckets('recent')[1].reserve(max_wait=5)
+    for i in range(100):
+      self.client.buckets(f"host{i}")
+
+    self.assertIn('paused', self.client.user_buckets)
+    self.assertIn('recent', self.client.user_buckets)
+    self.assertLessEqual(len(self.client.user_buckets), 10)
+
+  def test_token_bucket_spaces_requests(self):
+    """Verify requests beyond the burst capacity have to wait their turn"""
+
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    waits = [bucket.reserve(max_wait=5) for i in range(4)]
+
+    self.assertEqual(waits[:2], [0, 0])
+    self.assertAlmostEqual(waits[2], 0.1, delta=0.01)
+    self.assertAlmostEqual(waits[3], 0.2, delta=0.01)
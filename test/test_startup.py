@@ -0,0 +1,37 @@
+from unittest import TestCase
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_SECONDS = 1.5 # About 0.3s on a laptop, leave room for slow CI machines
+
+# Creates the app in a fresh interpreter with Postgres connections refused
+CREATE_APP = """
+import time
+start = time.perf_counter()
+
+import psycopg2
+def refuse(*args, **kwargs):
+  raise AssertionError('Connected to Postgres while creating the app')
+psycopg2.connect = refuse
+
+from app import create_app
+create_app()
+
+import sms
+assert sms.client is None, 'Twilio client was created at import'
+print(time.perf_counter() - start)
+"""
+
+
+class StartupTests(TestCase):
+
+  def test_create_app_is_fast_and_lazy(self):
+    """Verify importing and creating the app stays under budget without touching Postgres or Twilio"""
+
+    environment = {name: value for name, value in os.environ.items() if not name.startswith('TWILIO_')} # No credentials needed to boot
+    result = subprocess.run([sys.executable, '-c', CREATE_APP], cwd=ROOT, env=environment, capture_output=True, text=True, timeout=60)
+
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertLess(float(result.stdout), IMPORT_BUDGET_SECONDS)
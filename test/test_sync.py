@@ -0,0 +1,172 @@
+from unittest import TestCase
+from unittest.mock import patch
+from datetime import timedelta
+from sqlalchemy import event, text
+
+from app import create_app
+from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
+from spotify import SpotifyPageError
+import sync
+
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
+
+db.drop_all()
+db.create_all()
+
+
+class SyncTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.host_user = HostUser(id='sync_test_host',
+      display_name='sync tester',
+      email='sync_test_host@example.com',
+      url='https://open.spotify.com/user/sync_test_host',
+      access_token='token')
+    self.playlist = Playlist(id='sync_party', title='Party', key='syncparty', url='https://open.spotify.com/playlist/sync_party',
+      endpoint='https://api.spotify.com/v1/playlists/sync_party', owner=self.host_user, snapshot_id='v1')
+    db.session.add_all([self.host_user, self.playlist, Track(id='kept', name='Kept', artist='Artist'), Track(id='removed', name='Removed', artist='Artist')])
+    db.session.flush()
+    db.session.add_all([PlaylistTrack(playlist_id='sync_party', track_id='kept', added_by='+1alice'),
+                        PlaylistTrack(playlist_id='sync_party', track_id='removed', added_by='+1alice')])
+    db.session.commit()
+
+    self.remote = {'snapshot_id': 'v1', 'pages': [['kept', 'removed']]}
+    self.api_call = patch('spotify.make_authorized_api_call', side_effect=self.fake_api_call).start()
+    patch('sync.make_authorized_api_call', new=self.api_call).start()
+    self.addCleanup(patch.stopall)
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    PlaylistTrack.query.delete()
+    Track.query.delete()
+    Playlist.query.delete()
+    HostUser.query.filter_by(id='sync_test_host').delete()
+    GuestUser.query.filter_by(id='sync_test_host').delete()
+    db.session.commit()
+
+  def fake_api_call(self, host_user, endpoint, method='POST', params=None, **kwargs):
+    """Stand in for make_authorized_api_call that serves self.remote, a page per request"""
+
+    if endpoint == self.playlist.endpoint:
+      return {'snapshot_id': self.remote['snapshot_id']}
+
+    page = int(endpoint.rpartition('page=')[2]) if 'page=' in endpoint else 0
+    if self.remote['pages'][page] is None:
+      return None
+    return {
+      'items': [{'track': {'id': track_id, 'name': f"Song {track_id}", 'type': 'track', 'is_local': False, 'artists': [{'name': 'Artist'}]}}
+                for track_id in self.remote['pages'][page]],
+      'next': f"{endpoint}?page={page + 1}" if page + 1 < len(self.remote['pages']) else None
+    }
+
+  def local_track_ids(self):
+    db.session.expire_all()
+    return {row.track_id: row.added_by for row in PlaylistTrack.query.filter_by(playlist_id='sync_party')}
+
+  def test_unchanged_playlist_takes_one_request(self):
+    """Verify a playlist whose snapshot_id hasn't changed isn't paged through"""
+
+    self.assertFalse(sync.sync_playlist('sync_party'))
+
+    self.assertEqual(self.api_call.call_count, 1)
+    self.assertEqual(self.api_call.call_args.kwargs['params'], {'fields': 'snapshot_id'})
+
+  def test_changed_playlist_is_brought_in_line(self):
+    """Verify tracks added in Spotify are recorded, tracks removed there are dropped, and tracks we knew keep who added them"""
+
+    self.remote = {'snapshot_id': 'v2', 'pages': [['kept', 'new1'], ['new2']]}
+
+    self.assertTrue(sync.sync_playlist('sync_party'))
+
+    self.assertEqual(self.local_track_ids(), {'kept': '+1alice', 'new1': None, 'new2': None})
+    self.assertEqual(Playlist.query.get('sync_party').snapshot_id, 'v2')
+    self.assertEqual(self.api_call.call_count, 3)
+
+  def test_playlist_row_is_written_after_the_lock_is_released(self):
+    """Verify the snapshot_id isn't saved while the playlist's advisory lock is held, so a sync can't deadlock with a flush"""
+
+    self.remote = {'snapshot_id': 'v2', 'pages': [['kept']]}
+    held_locks = []
+
+    def check_locks(conn, cursor, statement, parameters, context, executemany):
+      if statement.startswith('UPDATE playlists'):
+        locks = cursor.connection.cursor()
+        locks.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+        held_locks.append(locks.fetchone()[0])
+
+    event.listen(db.engine, 'before_cursor_execute', check_locks)
+    try:
+      sync.sync_playlist('sync_party')
+    finally:
+      event.remove(db.engine, 'before_cursor_execute', check_locks)
+
+    self.assertEqual(held_locks, [0])
+    self.assertEqual(Playlist.query.get('sync_party').snapshot_id, 'v2')
+
+  def test_pages_are_fetched_without_the_lock(self):
+    """Verify the playlist isn't locked against adds while Spotify is paged through"""
+
+    self.remote = {'snapshot_id': 'v2', 'pages': [['kept'], ['new1']]}
+    held_locks = []
+
+    def fake_api_call(host_user, endpoint, **kwargs):
+      held_locks.append(db.session.scalar(text("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")))
+      return self.fake_api_call(host_user, endpoint, **kwargs)
+
+    self.api_call.side_effect = fake_api_call
+    self.assertTrue(sync.sync_playlist('sync_party'))
+
+    self.assertEqual(held_locks, [0, 0, 0])
+
+  def test_tracks_added_while_paging_are_kept(self):
+    """Verify a track added in the app while Spotify is paged through isn't mistaken for one the host removed"""
+
+    self.remote = {'snapshot_id': 'v2', 'pages': [['kept'], ['new1']]}
+
+    def fake_api_call(host_user, endpoint, **kwargs):
+      if 'page=' in endpoint:
+        with db.engine.begin() as connection: # Another worker adds a track, after the first page
+          connection.execute(text("INSERT INTO tracks (id, name, artist) VALUES ('late', 'Late', 'Artist')"))
+          connection.execute(text("INSERT INTO playlist_tracks (playlist_id, track_id, added_by) VALUES ('sync_party', 'late', '+1bob')"))
+      return self.fake_api_call(host_user, endpoint, **kwargs)
+
+    self.api_call.side_effect = fake_api_call
+    self.assertTrue(sync.sync_playlist('sync_party'))
+
+    self.assertEqual(self.local_track_ids(), {'kept': '+1alice', 'new1': None, 'late': '+1bob'})
+
+  def test_missing_page_changes_nothing(self):
+    """Verify a sync that can't see every page leaves the playlist as it was, to try again next time"""
+
+    self.remote = {'snapshot_id': 'v2', 'pages': [['kept'], None]}
+
+    with self.assertRaises(SpotifyPageError):
+      sync.sync_playlist('sync_party')
+    db.session.rollback()
+
+    self.assertEqual(self.local_track_ids(), {'kept': '+1alice', 'removed': '+1alice'})
+    self.assertEqual(Playlist.query.get('sync_party').snapshot_id, 'v1')
+
+  def test_recently_synced_playlists_are_not_claimed(self):
+    """Verify a playlist is claimed once per interval, and again as soon as a sync is asked for"""
+
+    self.assertEqual(sync.claim_due_playlist(), 'sync_party') # Never synced
+    self.assertIsNone(sync.claim_due_playlist())
+
+    Playlist.query.update({'synced_at': db.func.now() - timedelta(seconds=sync.SYNC_INTERVAL_SECONDS + 1)}, synchronize_session=False)
+    db.session.commit()
+    self.assertEqual(sync.claim_due_playlist(), 'sync_party')
+
+    sync.request_sync('sync_party')
+    db.session.commit()
+    self.assertTrue(sync.sync_next_playlist())
+    self.assertFalse(sync.sync_next_playlist())
@@ -1,14 +1,20 @@
 from unittest import TestCase
+from unittest.mock import patch
 
 import phonenumbers
-from app import app
-from models import HostUser, db
+from app import create_app
+from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
 from flask import session
+from ui.ui_routes import get_host_user_from_session
+from test.helpers import count_statements
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotify_sms_playlist_test' # Test database
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['WTF_CSRF_ENABLED'] = False # Don't req CSRF for testing
-app.config['TESTING'] = True
+app = create_app({
+  'SQLALCHEMY_DATABASE_URI': 'postgresql:///spotify_sms_playlist_test', # Test database
+  'SQLALCHEMY_ECHO': False,
+  'WTF_CSRF_ENABLED': False, # Don't req CSRF for testing
+  'TESTING': True
+})
+db.app = app # Let the tests use the models outside of requests
 
 db.drop_all()
 db.create_all()
@@ -117,3 +123,145 @@ class UITests(TestCase):
     self.assertEqual(response.status_code, 302)
     self.assertEqual(response.location, f"/user/{test_playlist_id}")
 
+
+class PlaylistPageTests(TestCase):
+
+  def setUp(self):
+    """Before every test"""
+
+    self.host_user = HostUser(id='page_test_host',
+      display_name='page tester',
+      email='page_test_host@example.com',
+      url='https://open.spotify.com/user/page_test_host',
+      phone_number='+15555550100')
+    self.party = Playlist(id='party', title='Party', key='party', url='https://open.spotify.com/playlist/party',
+      endpoint='https://api.spotify.com/v1/playlists/party', owner=self.host_user)
+    self.wedding = Playlist(id='wedding', title='Wedding', key='wedding', url='https://open.spotify.com/playlist/wedding',
+      endpoint='https://api.spotify.com/v1/playlists/wedding', owner=self.host_user)
+    tracks = [Track(id=f"track{i}", name=f"Song {i}", artist='Artist') for i in range(20)]
+    db.session.add_all([self.host_user, self.party, self.wedding] + tracks)
+    db.session.flush()
+
+    self.host_user.active_playlist_id = 'party'
+    db.session.add_all([PlaylistTrack(playlist_id='party', track_id=track.id, added_by='+1party') for track in tracks])
+    db.session.add_all([PlaylistTrack(playlist_id='wedding', track_id=track.id, added_by='+1wedding') for track in tracks])
+    db.session.commit()
+
+    self.client = app.test_client()
+    with self.client.session_transaction() as sess:
+      sess['host_user_id'] = 'page_test_host'
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    PlaylistTrack.query.delete()
+    Track.query.delete()
+    Playlist.query.delete()
+    HostUser.query.filter_by(id='page_test_host').delete()
+    GuestUser.query.filter_by(id='page_test_host').delete()
+    db.session.commit()
+
+  def test_playlist_page_queries_do_not_grow_with_tracks(self):
+    """Verify the playlist page shows who added each track to that playlist with a fixed number of queries"""
+
+    with count_statements() as statements:
+      response = self.client.get('/user/wedding')
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.data.count(b'+1wedding'), 20)
+    self.assertNotIn(b'+1party', response.data)
+    self.assertLessEqual(len(statements), 3) # The host user and their active playlist, the playlist, its tracks
+
+  def test_active_playlist_page_is_loaded_with_the_host_user(self):
+    """Verify the active playlist comes with the host user, so only its tracks need another query"""
+
+    with count_statements() as statements:
+      response = self.client.get('/user/party')
+
+    self.assertEqual(response.status_code, 200)
+    self.assertIn(b'add songs to this playlist', response.data)
+    self.assertEqual(len(statements), 2)
+
+  def test_playlists_page_queries_do_not_grow_with_playlists(self):
+    """Verify every playlist on the playlists page is loaded together"""
+
+    db.session.add_all([Playlist(id=f"extra{i}", title=f"Extra {i}", key=f"extra{i}", url=f"https://open.spotify.com/playlist/extra{i}",
+      endpoint=f"https://api.spotify.com/v1/playlists/extra{i}", owner_id='page_test_host') for i in range(10)])
+    db.session.commit()
+
+    with count_statements() as statements:
+      response = self.client.get('/user/playlists')
+
+    self.assertEqual(response.status_code, 200)
+    self.assertIn(b'Extra 9', response.data)
+    self.assertEqual(len(statements), 2) # The host user, then all of their playlists
+
+  def test_delete_playlist(self):
+    """Verify deleting a playlist clears it from guests and removes its tracks from it, but keeps tracks other playlists share"""
+
+    db.session.add(GuestUser(id='+15555550103', phone_number='+15555550103', active_playlist_id='wedding'))
+    db.session.commit()
+
+    with count_statements() as statements:
+      response = self.client.post('/user/wedding/delete')
+
+    db.session.expire_all()
+    self.assertEqual(response.location, '/user/playlists')
+    self.assertIsNone(Playlist.query.get('wedding'))
+    self.assertIsNone(GuestUser.query.get('+15555550103').active_playlist_id)
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id='wedding').count(), 0)
+    self.assertEqual(PlaylistTrack.query.filter_by(playlist_id='party').count(), 20)
+    self.assertEqual(Track.query.count(), 20)
+    self.assertLessEqual(len(statements), 3) # Get the playlist, then one UPDATE and one DELETE whatever its size
+
+    GuestUser.query.filter_by(id='+15555550103').delete()
+    db.session.commit()
+
+  def test_sync_playlist(self):
+    """Verify the owner can ask for a playlist to be synced with Spotify"""
+
+    Playlist.query.update({'synced_at': db.func.now()}, synchronize_session=False)
+    db.session.commit()
+
+    response = self.client.post('/user/wedding/sync')
+
+    db.session.expire_all()
+    self.assertEqual(response.location, '/user/wedding')
+    self.assertIsNone(Playlist.query.get('wedding').synced_at)
+    self.assertIsNotNone(Playlist.query.get('party').synced_at)
+
+  def test_host_user_is_loaded_once_per_request(self):
+    """Verify the host user is kept on flask.g for the rest of the request"""
+
+    with app.test_request_context():
+      session['host_user_id'] = 'page_test_host'
+      with patch('ui.ui_routes.HostUser.query') as query:
+        self.assertIs(get_host_user_from_session(), get_host_user_from_session())
+
+    query.options.assert_called_once()
+
+  def test_playlist_pages(self):
+    """Verify the playlist page shows one page of tracks in the order they were added, with a link to the next page"""
+
+    with patch('ui.ui_routes.PLAYLIST_PAGE_SIZE', 8):
+      first_page = self.client.get('/user/wedding')
+      next_after = PlaylistTrack.query.filter_by(playlist_id='wedding').order_by(PlaylistTrack.seq).all()[7].seq
+      last_page = self.client.get(f"/user/wedding?after={next_after + 8}")
+
+    self.assertEqual(first_page.data.count(b'+1wedding'), 8)
+    self.assertLess(first_page.data.index(b'Song 0<'), first_page.data.index(b'Song 7<'))
+    self.assertNotIn(b'Song 8<', first_page.data)
+    self.assertIn(f"/user/wedding?after={next_after}".encode(), first_page.data)
+    self.assertEqual(last_page.data.count(b'+1wedding'), 4)
+    self.assertNotIn(b'Next Page', last_page.data)
+
+  def test_streamed_playlist(self):
+    """Verify the streamed page sends every track"""
+
+    with patch('ui.ui_routes.PLAYLIST_PAGE_SIZE', 8):
+      response = self.client.get('/user/wedding/all')
+
+    self.assertTrue(response.is_streamed)
+    self.assertEqual(response.data.count(b'+1wedding'), 20)
+    self.assertIn(b'Song 19<', response.data)
@@ -1,11 +1,11 @@
 """WTForms"""
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField
+from wtforms import BooleanField, StringField, SubmitField
 from wtforms.validators import InputRequired, ValidationError, DataRequired, Regexp, Length
 import phonenumbers
 
-from models import Playlist
+from models import Playlist, db
 
 class PhoneForm(FlaskForm):
   """PhoneForm was provided by Twilio"""
@@ -27,11 +27,12 @@ class CreatePlaylistForm(FlaskForm):
 
   title = StringField("Playlist Title", description="My Playlist", validators=[InputRequired()])
   key = StringField("Playlist Password", description="bops", validators=[DataRequired(), Regexp(r'^[\w.@+-]+$',message='Key cannot have spaces'), Length(min=3, max=12)])
+  allow_duplicates = BooleanField("Allow duplicate songs", description="Add songs again even if they're already on the playlist")
 
   def validate_key(self, key):
     """Check that the key is not already taken"""
     
-    playlist = Playlist.query.filter_by(key=key.data.lower()).first() # Get phone number's first playlist
+    playlist = Playlist.query.filter(db.func.lower(Playlist.key) == key.data.lower()).first() # Get phone number's first playlist
     # If playlist exists
     if playlist:
       raise ValidationError('Key is already taken!')
@@ -1,12 +1,18 @@
 """ User interface """
 
-from flask import Blueprint, flash, redirect, render_template, session
+import os
+from flask import Blueprint, Response, current_app, flash, g, redirect, render_template, request, session, stream_with_context
+from sqlalchemy import delete, update
+from sqlalchemy.orm import joinedload, selectinload
 
 from .ui_forms import CreatePlaylistForm, PhoneForm
-from models import GuestUser, HostUser, Playlist
+from cache import invalidate_guest_user, invalidate_playlist
+from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
 from spotify import create_playlist
-from app import db
 from sms import MY_TWILIO_NUMBER, playlist_key_success_notification
+from sync import request_sync
+
+PLAYLIST_PAGE_SIZE = int(os.environ.get('PLAYLIST_PAGE_SIZE', 100)) # Tracks shown per page of a playlist
 
 ui = Blueprint("ui", __name__, template_folder="templates")
 
@@ -47,6 +53,8 @@ def get_phone_number():
   form = PhoneForm() # Form for getting phone numbers
 
   if form.validate_on_submit():
+    invalidate_guest_user(host_user.phone_number) # Forget the old phone number
+    invalidate_guest_user(form.phone.data) # The phone number is about to belong to the host user
     guest_user = GuestUser.query.filter_by(phone_number=form.phone.data).first()
     # if there is a guest user with that phone number
     if guest_user:
@@ -65,20 +73,65 @@ def get_phone_number():
 
 @ui.route('/<string:id>', methods=['GET', 'POST'])
 def show_playlist(id):
-  """Show a user's playlist"""
+  """Show a page of a user's playlist
+
+  Pages are PLAYLIST_PAGE_SIZE tracks long. The ?after= query string is the seq of the last
+  track on the previous page, so each page is one index range scan however big the playlist is"""
   
-  host_user = get_host_user_from_session()
+  host_user = get_host_user_from_session(joinedload(HostUser.active_playlist)) # The page names the active playlist
 
   # Prevent users from jumping ahead to /user without first authorizing
   if not host_user:
     return redirect('/auth')
 
-  playlist = Playlist.query.filter_by(id = id).first() # Get the playlist
+  playlist = Playlist.query.get(id) # Get the playlist, no query if it's the active playlist
 
   if not playlist:
     return redirect("/user/playlists") # Redirect the user to the playlists page to create a playlist
 
-  return render_template('view_playlist.html', host_user=host_user, playlist=playlist, twilio_phone_number = MY_TWILIO_NUMBER)
+  after = request.args.get('after', 0, type=int) # seq of the last track already shown
+  tracks = playlist_tracks_query(playlist).filter(PlaylistTrack.seq > after).limit(PLAYLIST_PAGE_SIZE + 1).all()
+
+  # The extra track tells us if there is another page
+  next_after = tracks[PLAYLIST_PAGE_SIZE - 1].seq if len(tracks) > PLAYLIST_PAGE_SIZE else None
+
+  return render_template('view_playlist.html', host_user=host_user, playlist=playlist, tracks=tracks[:PLAYLIST_PAGE_SIZE],
+    next_after=next_after, twilio_phone_number = MY_TWILIO_NUMBER)
+
+
+@ui.route('/<string:id>/all')
+def stream_playlist(id):
+  """Show every track in a user's playlist, streaming rows to the browser as they are read"""
+
+  host_user = get_host_user_from_session(joinedload(HostUser.active_playlist)) # The page names the active playlist
+
+  # Prevent users from jumping ahead to /user without first authorizing
+  if not host_user:
+    return redirect('/auth')
+
+  playlist = Playlist.query.get(id) # Get the playlist, no query if it's the active playlist
+
+  if not playlist:
+    return redirect("/user/playlists") # Redirect the user to the playlists page to create a playlist
+
+  # Read the tracks through a server side cursor, PLAYLIST_PAGE_SIZE rows at a time
+  tracks = playlist_tracks_query(playlist).execution_options(stream_results=True).yield_per(PLAYLIST_PAGE_SIZE)
+
+  context = {"host_user": host_user, "playlist": playlist, "tracks": tracks, "twilio_phone_number": MY_TWILIO_NUMBER}
+  current_app.update_template_context(context)
+  template = current_app.jinja_env.get_template('view_playlist.html')
+
+  return Response(stream_with_context(template.generate(context)))
+
+
+def playlist_tracks_query(playlist):
+  """Query for every track's name, artist and who added it to the playlist, in the order they were added"""
+
+  return db.session.query(Track.name, Track.artist, PlaylistTrack.added_by, PlaylistTrack.seq) \
+    .join(PlaylistTrack, PlaylistTrack.track_id == Track.id) \
+    .filter(PlaylistTrack.playlist_id == playlist.id) \
+    .order_by(PlaylistTrack.seq)
+
 
 @ui.route('/<string:id>/delete', methods=['POST'])
 def delete_playlist(id):
@@ -87,14 +140,15 @@ def delete_playlist(id):
   playlist = Playlist.query.get_or_404(id) # Get the playlist
 
   # If the host user is the owner of the playlist
-  if playlist.owner_id == session['host_user_id']:
-    # Get users who have that playlist as their active playlist
-    guest_users = GuestUser.query.filter_by(active_playlist_id=id).all()
-    for guest_user in guest_users:
-      guest_user.active_playlist_id = None # Set thier active playlist id to None
-      db.session.add(guest_user)
-    
-    db.session.delete(playlist) # delete the playlist (This will not delete the playlist on spotify)
+  if playlist.owner_id == session.get('host_user_id'):
+    # Clear the active playlist of everyone who had it, in one statement
+    db.session.execute(
+      update(GuestUser).where(GuestUser.active_playlist_id == id).values(active_playlist_id=None).execution_options(synchronize_session=False)
+    )
+
+    invalidate_playlist(playlist) # Forget the playlist and the users who had it active
+    # delete the playlist (This will not delete the playlist on spotify). Postgres deletes its playlist_tracks, the tracks are kept
+    db.session.execute(delete(Playlist).where(Playlist.id == id).execution_options(synchronize_session=False))
     db.session.commit()
     flash('Playlist Deleted', 'warning')
     return redirect('/user/playlists')
@@ -116,6 +170,7 @@ def activate_playlist(id):
   if playlist:
     host_user.active_playlist_id = playlist.id
     db.session.add(host_user) 
+    invalidate_guest_user(host_user.phone_number) # The host's active playlist changed
     db.session.commit()
     playlist_key_success_notification(phone_number=host_user.phone_number, playlist=playlist) # Send a message to the user
     flash('Playlist activated, Spotify links recieved from you will be added here', 'success')
@@ -124,11 +179,46 @@ def activate_playlist(id):
   return redirect('/user')
 
 
+@ui.route('/<string:id>/duplicates', methods=['POST'])
+def toggle_duplicates(id):
+  """Turn adding songs that are already on a playlist on or off"""
+
+  playlist = Playlist.query.get_or_404(id) # Get the playlist
+
+  # If the host user is the owner of the playlist
+  if playlist.owner_id == session.get('host_user_id'):
+    playlist.allow_duplicates = not playlist.allow_duplicates
+    invalidate_playlist(playlist) # The cached playlist has the old setting
+    db.session.commit()
+    flash('Duplicate songs will be added' if playlist.allow_duplicates else 'Duplicate songs will be skipped', 'success')
+  else:
+    flash('You cannot change that playlist')
+
+  return redirect('/user/playlists')
+
+
+@ui.route('/<string:id>/sync', methods=['POST'])
+def sync_playlist(id):
+  """Ask for a playlist to be synced with Spotify soon, to show changes made in the Spotify app"""
+
+  playlist = Playlist.query.get_or_404(id) # Get the playlist
+
+  # If the host user is the owner of the playlist
+  if playlist.owner_id == session.get('host_user_id'):
+    request_sync(playlist.id)
+    db.session.commit()
+    flash('Changes made in Spotify will show here shortly', 'success')
+  else:
+    flash('You cannot change that playlist')
+
+  return redirect(f"/user/{playlist.id}")
+
+
 @ui.route('/playlists', methods = ['GET', 'POST'])
 def show_all_playlists():
   """Show all of users playlists and a """
 
-  host_user = get_host_user_from_session()
+  host_user = get_host_user_from_session(selectinload(HostUser.playlists)) # The page lists every playlist
 
   # Prevent users from jumping ahead without first authorizing
   if not host_user:
@@ -140,19 +230,25 @@ def show_all_playlists():
   if form.validate_on_submit():
     title = form.title.data # Get title from form
     key = form.key.data.lower()
-    create_playlist(host_user=host_user, title=title, key=key) # Create the playlist
+    create_playlist(host_user=host_user, title=title, key=key, allow_duplicates=form.allow_duplicates.data) # Create the playlist
     flash('Playlist Created', 'success')
     return redirect('/user')
 
   return render_template('all_playlists.html', host_user=host_user, form=form)
 
-def get_host_user_from_session():
-  """Prevent users from jumping ahead to /user without first authorizing"""
+def get_host_user_from_session(*options):
+  """Prevent users from jumping ahead to /user without first authorizing
+
+  The host user is loaded once per request and kept on flask.g. options are loader options
+  for the relationships the page is going to show, e.g. selectinload(HostUser.playlists)"""
 
   if 'host_user_id' not in session:
     return None
 
-  return HostUser.query.filter_by(id=session['host_user_id']).first() # Get host_user using host_user_id in session
+  if 'host_user' not in g:
+    g.host_user = HostUser.query.options(*options).filter_by(id=session['host_user_id']).first() # Get host_user using host_user_id in session
+
+  return g.host_user
 
 @ui.route('/tutorial', methods = ['GET', 'POST'])
 def tutorial():
@@ -0,0 +1,185 @@
+"""Worker process that drains the queue of received text messages
+
+Run with `python worker.py`. WORKER_CONCURRENCY threads each claim and process one message
+at a time, so a slow Spotify or Twilio call only holds up its own thread. When
+COALESCE_WINDOW_SECONDS is set, another thread adds the tracks coalesce.py held back, and
+SYNC_CONCURRENCY threads keep playlists in step with edits made in Spotify (see sync.py).
+A heartbeat thread keeps the messages being processed locked however long they take, so
+only a worker that died has its messages reclaimed."""
+
+import logging
+import os
+import signal
+import threading
+import traceback
+from functools import partial
+
+from app import create_app
+from api.api_routes import handle_message
+from coalesce import coalescing, flush_due
+from jobs import LOCK_TIMEOUT_SECONDS, MAX_ATTEMPTS, claim_message, complete_message, defer_message, extend_locks, fail_message, purge_received_messages, record_progress
+from metrics import start_metrics_server
+from models import db
+from sms import hold_messages, send_held
+from spotify_client import SpotifyDeferred
+from sync import SYNC_CONCURRENCY, SYNC_POLL_INTERVAL_SECONDS, sync_next_playlist
+
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 4)) # Messages processed at the same time
+POLL_INTERVAL_SECONDS = float(os.environ.get('WORKER_POLL_INTERVAL_SECONDS', 1)) # Wait between checks of an empty queue
+PURGE_INTERVAL_SECONDS = float(os.environ.get('WORKER_PURGE_INTERVAL_SECONDS', 3600)) # Wait between purges of old MessageSids
+HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get('WORKER_HEARTBEAT_INTERVAL_SECONDS', LOCK_TIMEOUT_SECONDS / 3)) # Wait between extensions of the locks on messages being processed
+METRICS_PORT = os.environ.get('WORKER_METRICS_PORT') # Port to serve Prometheus metrics on, off if not set
+
+logger = logging.getLogger('worker')
+stopping = threading.Event() # Set to let threads finish their current message and exit
+running = set() # Ids of the messages this process is working on, kept locked by heartbeat()
+running_lock = threading.Lock()
+
+
+def process_next_message(app):
+  """Claim and process one message from the queue. Return False if the queue was empty"""
+
+  with app.app_context():
+    message = claim_message()
+    if not message:
+      return False
+
+    # The message was reclaimed after crashing a worker too many times
+    if message.attempts > MAX_ATTEMPTS:
+      fail_message(message.id, message.attempts, error="Worker stopped while processing the message")
+      return True
+
+    with running_lock:
+      running.add(message.id)
+
+    # The message's changes and its removal (or retry) are committed together, in one transaction
+    try:
+      with hold_messages() as replies:
+        handle_message(phone_number=message.phone_number, message=message.body,
+                       tracks_done=message.tracks_done, record_progress=partial(record_progress, message.id))
+      complete_message(message.id)
+    except SpotifyDeferred as error:
+      logger.warning('Deferring message %s for %.1fs: %s', message.id, error.retry_after, error)
+      defer_message(message.id, error.retry_after) # Spotify is busy, try again once it has recovered. Keeps the tracks it already added
+    except Exception:
+      logger.exception('Failed to process message %s (attempt %s)', message.id, message.attempts)
+      keep_progress()
+      fail_message(message.id, message.attempts, error=traceback.format_exc())
+    else:
+      send_held(replies) # Only once the message is committed, so a retry doesn't text the sender twice
+    finally:
+      with running_lock:
+        running.discard(message.id)
+
+  return True
+
+
+def keep_progress():
+  """Commit what a failed message got done, such as the tracks Spotify already added, so a
+  retry doesn't add them again. Discard it if the failure left the transaction unusable"""
+
+  try:
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+
+
+def work(app):
+  """Process messages until the worker is stopped"""
+
+  while not stopping.is_set():
+    try:
+      found_message = process_next_message(app)
+    except Exception:
+      logger.exception('Could not reach the queue')
+      found_message = False
+
+    # Wait before checking an empty queue again
+    if not found_message:
+      stopping.wait(POLL_INTERVAL_SECONDS)
+
+
+def purge(app):
+  """Purge old MessageSids every PURGE_INTERVAL_SECONDS until the worker is stopped"""
+
+  while not stopping.is_set():
+    try:
+      with app.app_context():
+        logger.info('Purged %s old MessageSids', purge_received_messages())
+    except Exception:
+      logger.exception('Could not purge old MessageSids')
+
+    stopping.wait(PURGE_INTERVAL_SECONDS)
+
+
+def heartbeat(app):
+  """Extend the locks on the messages being processed every HEARTBEAT_INTERVAL_SECONDS, until the worker is stopped"""
+
+  while not stopping.wait(HEARTBEAT_INTERVAL_SECONDS):
+    with running_lock:
+      message_ids = list(running)
+    if not message_ids:
+      continue
+
+    try:
+      with app.app_context():
+        extend_locks(message_ids)
+    except Exception:
+      logger.exception('Could not extend the locks on messages %s', message_ids)
+
+
+def flush(app):
+  """Add the tracks held by the coalescing window once they're due, until the worker is stopped"""
+
+  while not stopping.is_set():
+    try:
+      with app.app_context():
+        flush_due()
+    except Exception:
+      logger.exception('Could not flush pending adds')
+
+    stopping.wait(POLL_INTERVAL_SECONDS)
+
+
+def sync(app):
+  """Sync playlists with Spotify as they fall due, until the worker is stopped"""
+
+  while not stopping.is_set():
+    try:
+      with app.app_context():
+        synced = sync_next_playlist()
+    except Exception:
+      logger.exception('Could not sync playlists')
+      synced = False
+
+    # Wait before checking again when no playlist is due
+    if not synced:
+      stopping.wait(SYNC_POLL_INTERVAL_SECONDS)
+
+
+def run(app):
+  """Start WORKER_CONCURRENCY threads and wait for them to finish"""
+
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set()) # Heroku sends SIGTERM before stopping a dyno
+  signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+  threads = [threading.Thread(target=work, args=(app,), name=f"worker-{i}") for i in range(WORKER_CONCURRENCY)]
+  threads.append(threading.Thread(target=purge, args=(app,), name='purge'))
+  threads.append(threading.Thread(target=heartbeat, args=(app,), name='heartbeat'))
+  if coalescing():
+    threads.append(threading.Thread(target=flush, args=(app,), name='flush'))
+  threads += [threading.Thread(target=sync, args=(app,), name=f"sync-{i}") for i in range(SYNC_CONCURRENCY)]
+  if METRICS_PORT:
+    start_metrics_server(int(METRICS_PORT))
+  for thread in threads:
+    thread.start()
+
+  logger.info('Worker started with %s threads', WORKER_CONCURRENCY)
+  while any(thread.is_alive() for thread in threads):
+    for thread in threads:
+      thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  run(create_app())